@@ -0,0 +1,244 @@
+# asthma-backend/analytics.py
+"""
+PEFR time-series aggregation for the graph screens.
+
+bucket_stats() produces per-bucket count/min/max/sum/sum of squares, morning sums and zone
+counts. Day and week buckets in the rollup's time zone are read from pefr_daily_rollup (one
+row per day); only partial days at the edges of the range, hour buckets and other time zones
+GROUP BY the raw readings over the (owner_id, recorded_at) index. aggregate() derives mean,
+spread, diurnal variability and % of baseline with NumPy, then reduces long ranges to at
+most `max_points` buckets with Largest-Triangle-Three-Buckets (LTTB) on the mean series,
+which keeps the peaks and dips a plain stride would skip.
+
+Readings are stored in UTC. Clients pass their UTC offset so buckets and the morning/evening
+split follow the patient's local day.
+"""
+
+import datetime
+import os
+
+import numpy as np
+from sqlalchemy import Integer, case, cast, func
+from sqlalchemy.orm import Session
+
+from app import models, rollup
+
+PEFR_AGGREGATE_MAX_POINTS = int(os.getenv("PEFR_AGGREGATE_MAX_POINTS", "200"))
+
+BUCKETS = ("hour", "day", "week")
+SUMS = ("count", "min", "max", "sum", "sum_sq", "morning_sum", "morning_count", "red", "yellow", "green")
+
+
+def _bucket_key(local_ts, bucket: str):
+    if bucket == "hour":
+        return func.strftime("%Y-%m-%d %H:00:00", local_ts)
+    if bucket == "day":
+        return func.date(local_ts)
+    # weeks start on Monday: step back 6 days, then forward to the next Monday
+    return func.date(local_ts, "-6 days", "weekday 1")
+
+
+def _to_arrays(rows):
+    """(bucket, *SUMS) rows -> dict of NumPy arrays."""
+    columns = list(zip(*rows)) if rows else [()] * (len(SUMS) + 1)
+    stats = {"start": np.array([str(v) for v in columns[0]], dtype="datetime64[s]")}
+    numbers = np.array(columns[1:], dtype=float).reshape(len(SUMS), len(rows))
+    stats.update(zip(SUMS, numbers))
+    return stats
+
+
+def _zone_count(zone: str):
+    return func.sum(case((models.PEFRRecord.zone == zone, 1), else_=0))
+
+
+def raw_bucket_stats(db: Session, owner_id: int, bucket: str, since=None, until=None,
+                     tz_offset_minutes: int = 0, before=None):
+    """Per-bucket sums straight from pefr_records (since <= recorded_at <= until, < before)."""
+    value = models.PEFRRecord.pefr_value
+    local_ts = func.datetime(models.PEFRRecord.recorded_at, f"{tz_offset_minutes:+d} minutes")
+    key = _bucket_key(local_ts, bucket).label("bucket")
+    morning = cast(func.strftime("%H", local_ts), Integer) < rollup.PEFR_MORNING_CUTOFF_HOUR
+
+    query = db.query(
+        key,
+        func.count(value),
+        func.min(value),
+        func.max(value),
+        func.sum(value),
+        func.sum(value * value),
+        func.sum(case((morning, value), else_=0)),
+        func.sum(case((morning, 1), else_=0)),
+        _zone_count("Red"),
+        _zone_count("Yellow"),
+        _zone_count("Green"),
+    ).filter(models.PEFRRecord.owner_id == owner_id)
+    if since is not None:
+        query = query.filter(models.PEFRRecord.recorded_at >= since)
+    if until is not None:
+        query = query.filter(models.PEFRRecord.recorded_at <= until)
+    if before is not None:
+        query = query.filter(models.PEFRRecord.recorded_at < before)
+    return _to_arrays(query.group_by(key).order_by(key).all())
+
+
+def rollup_bucket_stats(db: Session, owner_id: int, bucket: str, first_day=None, end_day=None):
+    """Per-bucket sums from pefr_daily_rollup for local days first_day <= day < end_day."""
+    R = models.PEFRDailyRollup
+    key = (R.day if bucket == "day" else func.date(R.day, "-6 days", "weekday 1")).label("bucket")
+    query = db.query(
+        key,
+        func.sum(R.count),
+        func.min(R.min),
+        func.max(R.max),
+        func.sum(R.sum),
+        func.sum(R.sum_sq),
+        func.sum(R.morning_sum),
+        func.sum(R.morning_count),
+        func.sum(R.red),
+        func.sum(R.yellow),
+        func.sum(R.green),
+    ).filter(R.owner_id == owner_id)
+    if first_day is not None:
+        query = query.filter(R.day >= first_day)
+    if end_day is not None:
+        query = query.filter(R.day < end_day)
+    return _to_arrays(query.group_by(key).order_by(key).all())
+
+
+def merge_stats(parts):
+    """Combine per-bucket sums from several sources into one ordered set of buckets."""
+    parts = [p for p in parts if len(p["start"])]
+    if not parts:
+        return _to_arrays([])
+    if len(parts) == 1:
+        return parts[0]
+    starts = np.concatenate([p["start"] for p in parts])
+    unique, slot = np.unique(starts, return_inverse=True)
+    merged = {"start": unique}
+    for name in SUMS:
+        values = np.concatenate([p[name] for p in parts])
+        if name == "min":
+            out = np.full(len(unique), np.inf)
+            np.minimum.at(out, slot, values)
+        elif name == "max":
+            out = np.full(len(unique), -np.inf)
+            np.maximum.at(out, slot, values)
+        else:
+            out = np.zeros(len(unique))
+            np.add.at(out, slot, values)
+        merged[name] = out
+    return merged
+
+
+def _midnight(ts: datetime.datetime):
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def bucket_stats(db: Session, owner_id: int, bucket: str, since=None, until=None, tz_offset_minutes: int = 0):
+    """Per-bucket sums as NumPy arrays, ordered by bucket start (local time)."""
+    if bucket == "hour" or tz_offset_minutes != rollup.PEFR_ROLLUP_TZ_OFFSET_MINUTES:
+        return raw_bucket_stats(db, owner_id, bucket, since, until, tz_offset_minutes)
+
+    # whole local days inside [since, until] come from the rollup, partial edge days from raw rows
+    offset = datetime.timedelta(minutes=tz_offset_minutes)
+    first_day = end_day = None
+    if since is not None:
+        first_day = _midnight(since + offset)
+        if first_day < since + offset:
+            first_day += datetime.timedelta(days=1)
+    if until is not None:
+        end_day = _midnight(until + offset)
+    if first_day is not None and end_day is not None and end_day <= first_day:
+        # no whole day in the range
+        return raw_bucket_stats(db, owner_id, bucket, since, until, tz_offset_minutes)
+
+    parts = [rollup_bucket_stats(
+        db, owner_id, bucket,
+        first_day.date() if first_day is not None else None,
+        end_day.date() if end_day is not None else None,
+    )]
+    if since is not None and first_day > since + offset:
+        parts.append(raw_bucket_stats(db, owner_id, bucket, since=since, before=first_day - offset,
+                                      tz_offset_minutes=tz_offset_minutes))
+    if until is not None:
+        parts.append(raw_bucket_stats(db, owner_id, bucket, since=end_day - offset, until=until,
+                                      tz_offset_minutes=tz_offset_minutes))
+    return merge_stats(parts)
+
+
+def _safe_divide(num, den):
+    out = np.full(num.shape, np.nan)
+    np.divide(num, den, out=out, where=den > 0)
+    return out
+
+
+def lttb(x, y, n_out: int):
+    """Indices of the `n_out` points of (x, y) kept by Largest-Triangle-Three-Buckets."""
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # interior points are split into n_out - 2 buckets; first and last points are always kept
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # the next bucket's average is the third vertex (the last point for the final bucket)
+        nxt_lo, nxt_hi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[nxt_lo:nxt_hi].mean(), y[nxt_lo:nxt_hi].mean()
+        ax, ay = x[keep[i]], y[keep[i]]
+        area = np.abs((ax - cx) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (cy - ay))
+        keep[i + 1] = lo + int(np.argmax(area))
+    return keep
+
+
+def aggregate(db: Session, owner_id: int, bucket: str, since=None, until=None,
+              tz_offset_minutes: int = 0, max_points: int = PEFR_AGGREGATE_MAX_POINTS):
+    stats = bucket_stats(db, owner_id, bucket, since, until, tz_offset_minutes)
+
+    baseline = db.query(models.BaselinePEFR.baseline_value).filter(
+        models.BaselinePEFR.owner_id == owner_id
+    ).scalar()
+
+    mean = _safe_divide(stats["sum"], stats["count"])
+    std = np.sqrt(np.maximum(_safe_divide(stats["sum_sq"], stats["count"]) - mean * mean, 0.0))
+    morning_mean = _safe_divide(stats["morning_sum"], stats["morning_count"])
+    evening_mean = _safe_divide(stats["sum"] - stats["morning_sum"], stats["count"] - stats["morning_count"])
+    # amplitude as % of the mean of highest and lowest (GINA diurnal variability); needs 2+ readings
+    variability = _safe_divide((stats["max"] - stats["min"]) * 200.0, stats["max"] + stats["min"])
+    variability[stats["count"] < 2] = np.nan
+    percent_of_baseline = mean * 100.0 / baseline if baseline else np.full(mean.shape, np.nan)
+
+    total = len(mean)
+    keep = lttb(stats["start"].astype("int64").astype(float), mean, max_points)
+
+    def value(array, i, digits=1):
+        v = array[i]
+        return None if np.isnan(v) else round(float(v), digits)
+
+    buckets = [
+        {
+            "start": stats["start"][i].astype(datetime.datetime),
+            "count": int(stats["count"][i]),
+            "min": int(stats["min"][i]),
+            "max": int(stats["max"][i]),
+            "mean": value(mean, i),
+            "std": value(std, i),
+            "morning_mean": value(morning_mean, i),
+            "evening_mean": value(evening_mean, i),
+            "diurnal_variability": value(variability, i),
+            "percent_of_baseline": value(percent_of_baseline, i),
+            "red": int(stats["red"][i]),
+            "yellow": int(stats["yellow"][i]),
+            "green": int(stats["green"][i]),
+        }
+        for i in keep
+    ]
+    return {
+        "bucket": bucket,
+        "baseline": baseline,
+        "total_buckets": total,
+        "downsampled": len(buckets) < total,
+        "buckets": buckets,
+    }
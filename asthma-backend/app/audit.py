@@ -0,0 +1,138 @@
+# asthma-backend/audit.py
+"""
+Audit events, written off the request path in compact form.
+
+log() used to add an AuditLog row with a free-text `details` string to the request's own
+transaction, so nearly every write endpoint paid for an extra row, and ml_predict stored the
+repr of its whole input and output. Now an event is:
+
+  - an action code (ACTIONS, a small integer; codes are never reused or renumbered);
+  - its details as compact JSON (None when there are none), e.g. {"value":410,"zone":"Green"}.
+
+log() holds the event on the session and hands it to a BatchWriter (app.batch_writer) only
+when the transaction commits; events of a rolled-back transaction or savepoint are dropped,
+as before. The writer inserts queued events every AUDIT_FLUSH_SECONDS in batches, into the
+monthly partition of their timestamp (app.audit_store).
+
+High-volume, low-value actions can be sampled: AUDIT_SAMPLE_RATES="LOGIN=0.2,ML_PREDICT=0.05"
+keeps that share of those events (default: every event is kept).
+"""
+
+import datetime
+import json
+import os
+import random
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import audit_store
+from app.batch_writer import BatchWriter
+
+AUDIT_FLUSH_SECONDS = float(os.getenv("AUDIT_FLUSH_SECONDS", "2"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "500"))
+AUDIT_MAX_QUEUE = int(os.getenv("AUDIT_MAX_QUEUE", "50000"))
+
+ACTIONS = {
+    "LEGACY": 0,  # free-text events of an unknown action, migrated from audit_logs
+    "SIGNUP": 1,
+    "LOGIN": 2,
+    "RESET_PASSWORD": 3,
+    "UPDATE_PROFILE": 4,
+    "CREATE_BASELINE": 5,
+    "UPDATE_BASELINE": 6,
+    "CREATE_BASELINE_AUTO": 7,
+    "UPDATE_BASELINE_AUTO": 8,
+    "RECORD_PEFR": 9,
+    "RECORD_PEFR_BULK": 10,
+    "RECORD_SYMPTOM": 11,
+    "RECORD_SYMPTOM_BULK": 12,
+    "ML_PREDICT": 13,
+    "LINK_DOCTOR": 14,
+    "UNLINK_DOCTOR": 15,
+    "DELETE_PATIENT_LINK": 16,
+    "PRESCRIBE_MEDICATION": 17,
+    "UPDATE_MEDICATION_STATUS": 18,
+    "UPDATE_MEDICATION_METADATA": 19,
+    "MEDICATION_TAKEN": 20,
+    "DELETE_MEDICATION": 21,
+}
+NAMES = {code: name for name, code in ACTIONS.items()}
+
+
+def _sample_rates(spec: str):
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        if name.strip() not in ACTIONS:
+            raise ValueError(f"AUDIT_SAMPLE_RATES: unknown action {name.strip()!r}")
+        rates[ACTIONS[name.strip()]] = float(rate)
+    return rates
+
+
+SAMPLE_RATES = _sample_rates(os.getenv("AUDIT_SAMPLE_RATES", ""))
+
+writer = BatchWriter("audit", AUDIT_FLUSH_SECONDS, AUDIT_BATCH_SIZE, AUDIT_MAX_QUEUE,
+                     prepare=audit_store.ensure_partitions)
+stats = writer.stats
+stats["sampled_out"] = 0
+
+
+def encode(details: dict):
+    details = {k: v for k, v in (details or {}).items() if v is not None}
+    return json.dumps(details, separators=(",", ":"), default=str) if details else None
+
+
+def decode(details: str) -> dict:
+    return json.loads(details) if details else {}
+
+
+def log(session: Session, user_id: int, action: str, details: dict = None):
+    """Record `action` by `user_id`; written once `session` commits (right away if session is None)."""
+    code = ACTIONS[action]
+    rate = SAMPLE_RATES.get(code)
+    if rate is not None and random.random() >= rate:
+        stats["sampled_out"] += 1
+        return
+    row = {"timestamp": datetime.datetime.utcnow(), "user_id": user_id, "action": code, "details": encode(details)}
+    if session is None:
+        writer.add(audit_store.table_for(row["timestamp"]), row)
+        return
+    session = getattr(session, "sync_session", session)  # AsyncSession
+    # tie the event to a transaction (begin one, as autobegin would) so a rollback drops it
+    transaction = session.get_nested_transaction() or session.get_transaction() or session.begin()
+    session.info.setdefault("audit_events", []).append((transaction, row))
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_events(session: Session, previous_transaction):
+    pending = session.info.get("audit_events")
+    if not pending:
+        return
+
+    def rolled_back(transaction):
+        while transaction is not None:
+            if transaction is previous_transaction:
+                return True
+            transaction = transaction.parent
+        return False
+
+    pending[:] = [item for item in pending if not rolled_back(item[0])]
+
+
+@event.listens_for(Session, "after_commit")
+def _write_events(session: Session):
+    for _, row in session.info.pop("audit_events", None) or ():
+        writer.add(audit_store.table_for(row["timestamp"]), row)
+
+
+def flush(engine) -> int:
+    return writer.flush(engine)
+
+
+def start(engine):
+    writer.start(engine)
+
+
+def stop(engine):
+    writer.stop(engine)
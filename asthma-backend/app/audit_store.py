@@ -0,0 +1,284 @@
+# asthma-backend/audit_store.py
+"""
+Monthly partitions of the audit log, their archive files, and the query over both.
+
+Audit events (app.audit) are appended to one table per calendar month (UTC),
+audit_events_YYYYMM, indexed on (user_id, timestamp), (action, timestamp) and timestamp.
+The audit writer creates a month's table along with its first event, so the log rolls over
+to a new partition by itself; nothing ever scans or rewrites a closed month.
+
+archive() moves a closed partition into its own SQLite file,
+AUDIT_ARCHIVE_DIR/audit_events_YYYYMM.db: the rows are copied through ATTACH, counted
+on both sides and only then dropped from the main database. The retention job archives
+partitions older than AUDIT_HOT_MONTHS (0 keeps everything online). The freed pages are
+reused by new rows; the main file only shrinks after a VACUUM
+(`python -m app.audit_store archive --vacuum`).
+
+read_page() serves /admin/audit-logs: newest first, filtered by user, action and time range,
+with the (timestamp, id) cursors of app.pagination. It reads the partitions that overlap
+the range one by one, newest first, and stops as soon as the page is full, so a query
+never touches more months than it returns rows from. Archived months are included when
+`include_archived` is set; each archive file is opened read-only on its own.
+"""
+
+import datetime
+import glob
+import os
+import re
+
+from sqlalchemy import (Column, DateTime, Index, Integer, MetaData, SmallInteger, Table, Text,
+                        create_engine, delete, func, select, text)
+
+AUDIT_HOT_MONTHS = int(os.getenv("AUDIT_HOT_MONTHS", "12"))
+AUDIT_ARCHIVE_DIR = os.getenv("AUDIT_ARCHIVE_DIR", "./audit_archive")
+
+PREFIX = "audit_events_"
+_MONTH = re.compile(r"^audit_events_(\d{6})$")
+
+_metadata = MetaData()
+_tables = {}
+_created = set()
+_archive_engines = {}
+
+
+# ------------------------------------------------------------
+# Partitions
+# ------------------------------------------------------------
+
+def month_of(ts: datetime.datetime) -> str:
+    return ts.strftime("%Y%m")
+
+
+def build_table(name: str, metadata: MetaData = None) -> Table:
+    """The layout shared by every partition (and by the pre-partitioning audit_events table)."""
+    return Table(
+        name, metadata if metadata is not None else MetaData(),
+        Column("id", Integer, primary_key=True),
+        Column("timestamp", DateTime, nullable=False),
+        Column("user_id", Integer, nullable=True),
+        Column("action", SmallInteger, nullable=False),  # audit.ACTIONS code
+        Column("details", Text, nullable=True),          # compact JSON
+        Index(f"ix_{name}_user_timestamp", "user_id", "timestamp"),
+        Index(f"ix_{name}_action_timestamp", "action", "timestamp"),
+        Index(f"ix_{name}_timestamp", "timestamp"),
+    )
+
+
+def table(month: str) -> Table:
+    if month not in _tables:
+        _tables[month] = build_table(PREFIX + month, _metadata)
+    return _tables[month]
+
+
+def table_for(ts: datetime.datetime) -> Table:
+    return table(month_of(ts))
+
+
+def create_partition(conn, month: str):
+    table(month).create(bind=conn, checkfirst=True)
+    _created.add(month)
+
+
+def ensure_partitions(conn, tables):
+    """BatchWriter hook: create the partitions a batch writes to (month rollover)."""
+    for t in tables:
+        month = _MONTH.match(t.name).group(1)
+        if month not in _created:
+            create_partition(conn, month)
+
+
+def online_months(conn) -> list:
+    names = conn.execute(text(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'audit\\_events\\_%' ESCAPE '\\'"
+    )).scalars()
+    return sorted(m.group(1) for m in map(_MONTH.match, names) if m)
+
+
+# ------------------------------------------------------------
+# Archive files
+# ------------------------------------------------------------
+
+def archive_path(month: str) -> str:
+    return os.path.join(AUDIT_ARCHIVE_DIR, f"{PREFIX}{month}.db")
+
+
+def archived_months() -> list:
+    paths = glob.glob(os.path.join(AUDIT_ARCHIVE_DIR, f"{PREFIX}*.db"))
+    return sorted(m.group(1) for m in (_MONTH.match(os.path.basename(p)[:-3]) for p in paths) if m)
+
+
+def _archive_engine(month: str):
+    if month not in _archive_engines:
+        path = os.path.abspath(archive_path(month))
+        _archive_engines[month] = create_engine(f"sqlite:///file:{path}?mode=ro&uri=true")
+    return _archive_engines[month]
+
+
+def archive(engine, month: str) -> int:
+    """Move partition `month` to its archive file. Returns the number of rows moved."""
+    if month >= month_of(datetime.datetime.utcnow()):
+        raise ValueError(f"Partition {month} is still open")
+    path = archive_path(month)
+    if os.path.exists(path):
+        raise ValueError(f"{path} already exists")
+    os.makedirs(AUDIT_ARCHIVE_DIR, exist_ok=True)
+    name = PREFIX + month
+
+    # the schema first, in the archive file's own connection
+    archive_engine = create_engine(f"sqlite:///{path}")
+    with archive_engine.begin() as conn:
+        build_table(name).create(bind=conn)
+    archive_engine.dispose()
+
+    with engine.connect() as conn:
+        conn.exec_driver_sql("ATTACH DATABASE ? AS audit_archive", (path,))
+        conn.commit()
+        try:
+            with conn.begin():
+                conn.exec_driver_sql(f"INSERT INTO audit_archive.{name} SELECT * FROM main.{name} ORDER BY id")
+                copied = conn.exec_driver_sql(f"SELECT count(*) FROM audit_archive.{name}").scalar()
+                online = conn.exec_driver_sql(f"SELECT count(*) FROM main.{name}").scalar()
+                if copied != online:
+                    raise RuntimeError(f"Archive of {name} has {copied} rows, expected {online}")
+                conn.exec_driver_sql(f"DROP TABLE main.{name}")
+        finally:
+            conn.exec_driver_sql("DETACH DATABASE audit_archive")
+            conn.commit()
+    _created.discard(month)
+    return copied
+
+
+def archive_old(engine, months: int = AUDIT_HOT_MONTHS) -> list:
+    """Archive every partition older than the last `months` months. Returns the months moved."""
+    if months <= 0:
+        return []
+    today = datetime.datetime.utcnow()
+    index = today.year * 12 + today.month - 1 - months
+    cutoff = f"{index // 12:04d}{index % 12 + 1:02d}"
+    with engine.connect() as conn:
+        old = [m for m in online_months(conn) if m <= cutoff]
+    for month in old:
+        rows = archive(engine, month)
+        print(f"[audit] Archived {rows} events of {month} to {archive_path(month)}")
+    return old
+
+
+def vacuum(engine):
+    with engine.connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("VACUUM")
+
+
+# ------------------------------------------------------------
+# Reads and account deletion
+# ------------------------------------------------------------
+
+def statement(month: str, user_id: int = None, action: int = None):
+    t = table(month)
+    stmt = select(t.c.id, t.c.timestamp, t.c.user_id, t.c.action, t.c.details)
+    if user_id is not None:
+        stmt = stmt.where(t.c.user_id == user_id)
+    if action is not None:
+        stmt = stmt.where(t.c.action == action)
+    return stmt
+
+
+def read_page(engine, page, user_id: int = None, action: int = None, include_archived: bool = False) -> list:
+    """Rows of one HistoryPage (newest first) across the partitions it overlaps; pass them to page.page()."""
+    with engine.connect() as conn:
+        online = online_months(conn)
+    sources = {month: engine for month in online}
+    if include_archived:
+        for month in archived_months():
+            sources.setdefault(month, None)
+
+    low = month_of(page.since) if page.since else None
+    high = month_of(page.until) if page.until else None
+    # a forward page continues below its cursor, a backward one above it
+    if page.after is not None:
+        high = min(high or "999999", month_of(page.after[0]))
+    if page.before is not None:
+        low = max(low or "000000", month_of(page.before[0]))
+    months = [m for m in sources if (low is None or m >= low) and (high is None or m <= high)]
+    months.sort(reverse=not page.backward)
+
+    rows = []
+    for month in months:
+        stmt = page.apply(statement(month, user_id, action), table(month).c.timestamp, table(month).c.id,
+                          newest_first=True)
+        source = sources[month] or _archive_engine(month)
+        with source.connect() as conn:
+            rows += conn.execute(stmt).all()
+        if len(rows) > page.limit:
+            break
+    return rows[:page.limit + 1]
+
+
+def delete_user(conn, user_id: int) -> int:
+    """Delete a user's events from the online partitions, in the caller's transaction."""
+    deleted = 0
+    for month in online_months(conn):
+        deleted += conn.execute(delete(table(month)).where(table(month).c.user_id == user_id)).rowcount
+    return deleted
+
+
+def delete_user_archived(user_id: int) -> int:
+    """Delete a user's events from the archive files (each in its own transaction)."""
+    deleted = 0
+    for month in archived_months():
+        archive_engine = create_engine(f"sqlite:///{archive_path(month)}")
+        with archive_engine.begin() as conn:
+            deleted += conn.execute(delete(table(month)).where(table(month).c.user_id == user_id)).rowcount
+        archive_engine.dispose()
+    return deleted
+
+
+def clear(conn) -> int:
+    """Delete every event from the online partitions, in the caller's transaction."""
+    return sum(conn.execute(delete(table(month))).rowcount for month in online_months(conn))
+
+
+def delete_archives() -> list:
+    """Remove every archive file. Returns the months removed."""
+    months = archived_months()
+    for month in months:
+        engine = _archive_engines.pop(month, None)
+        if engine is not None:
+            engine.dispose()
+        os.remove(archive_path(month))
+    return months
+
+
+def summary(engine) -> dict:
+    with engine.connect() as conn:
+        online = {m: conn.execute(select(func.count()).select_from(table(m))).scalar() for m in online_months(conn)}
+    return {"online": online, "archived": archived_months()}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from app.database import engine
+
+    parser = argparse.ArgumentParser(description="Audit log partitions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("list", help="online partitions with their row counts, and archived months")
+    arch = sub.add_parser("archive", help=f"archive partitions older than --months (default {AUDIT_HOT_MONTHS})")
+    arch.add_argument("--months", type=int, default=AUDIT_HOT_MONTHS)
+    arch.add_argument("--month", help="archive this closed month (YYYYMM) only")
+    arch.add_argument("--vacuum", action="store_true", help="VACUUM the main database afterwards")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        info = summary(engine)
+        for month, count in info["online"].items():
+            print(f"{month}  online    {count} events")
+        for month in info["archived"]:
+            print(f"{month}  archived  {archive_path(month)}")
+    else:
+        if args.month:
+            print(f"Archived {archive(engine, args.month)} events of {args.month}")
+        else:
+            print(f"Archived partitions: {archive_old(engine, args.months) or 'none'}")
+        if args.vacuum:
+            vacuum(engine)
+            print("Vacuumed the main database")
@@ -1,15 +1,39 @@
 # asthma-backend/auth.py
 
+"""
+Passwords, bearer tokens and the current-user dependencies.
+
+Two kinds of access token are accepted:
+  - legacy tokens carry only `sub` (the email) and are valid for ACCESS_TOKEN_EXPIRE_MINUTES;
+    the user's id and role are looked up (through app.identity_cache);
+  - claims tokens also carry `uid`, `role` and `name` and are valid for
+    CLAIMS_ACCESS_TOKEN_MINUTES; get_current_user answers from the token alone, with no
+    database round trip.
+
+AUTH_MODE selects what /auth/login issues: "legacy" (default) or "claims". In claims mode
+login also returns a refresh token, valid for REFRESH_TOKEN_DAYS, that /auth/refresh trades
+for a new access token and a new refresh token. Refresh tokens are opaque and stored
+server-side as their sha256 (models.RefreshToken); each one can be used once. Presenting a
+used one again means it leaked, so every token of that login is revoked. Logging out, a
+password reset and account deletion revoke refresh tokens too; an access token already
+issued stays valid until it expires, so keep CLAIMS_ACCESS_TOKEN_MINUTES short.
+"""
+
+import hashlib
+import os
+import secrets
+
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from datetime import datetime, timedelta, timezone
 from pydantic import EmailStr
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from typing import Optional # <-- THIS LINE WAS ADDED
 
-from app import database, models, schemas  # <-- CORRECTED IMPORT
+from app import database, identity_cache, models, password_pool, schemas  # <-- CORRECTED IMPORT
 
 # --- Configuration ---
 
@@ -19,8 +43,15 @@ SECRET_KEY = "09d25e094faa6ca2556c818166b7a9563b93f7099f6f0f4caa6cf63b88e8d3e7"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 # 1 day
 
-# Password Hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+AUTH_MODE = os.getenv("AUTH_MODE", "legacy")
+CLAIMS_ACCESS_TOKEN_MINUTES = int(os.getenv("CLAIMS_ACCESS_TOKEN_MINUTES", "15"))
+REFRESH_TOKEN_DAYS = int(os.getenv("REFRESH_TOKEN_DAYS", "30"))
+
+# Roles allowed on the /admin routes
+ADMIN_ROLES = {models.UserRole.DOCTOR}
+
+# Password Hashing (bcrypt runs on app.password_pool's worker processes)
+pwd_context = password_pool.context
 
 # OAuth2 Scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
@@ -29,10 +60,16 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 # --- Password Utilities ---
 
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_pool.verify_password(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_pool.hash_password(password)
+
+async def verify_password_async(plain_password, hashed_password):
+    return await password_pool.verify_password_async(plain_password, hashed_password)
+
+async def get_password_hash_async(password):
+    return await password_pool.hash_password_async(password)
 
 
 # --- JWT Utilities ---
@@ -47,15 +84,83 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def verify_token(token: str, credentials_exception):
+def decode_token(token: str, credentials_exception):
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
-            raise credentials_exception
-        return schemas.TokenData(email=email)
     except JWTError:
         raise credentials_exception
+    if payload.get("sub") is None:
+        raise credentials_exception
+    return payload
+
+def verify_token(token: str, credentials_exception):
+    return schemas.TokenData(email=decode_token(token, credentials_exception)["sub"])
+
+def create_claims_token(user):
+    """Access token carrying the user's identity (claims mode)."""
+    return create_access_token(
+        {"sub": user.email, "uid": user.id, "role": user.role.value, "name": user.name},
+        timedelta(minutes=CLAIMS_ACCESS_TOKEN_MINUTES),
+    )
+
+def identity_from_claims(payload: dict):
+    """The Identity in a claims token, or None for a legacy token."""
+    if "uid" not in payload or "role" not in payload:
+        return None
+    return identity_cache.Identity(payload["uid"], payload["sub"], models.UserRole(payload["role"]), payload.get("name"))
+
+
+# --- Refresh Tokens ---
+
+def _token_hash(token: str) -> bytes:
+    return hashlib.sha256(token.encode()).digest()
+
+def issue_tokens(db: Session, user, family: Optional[bytes] = None) -> dict:
+    """A claims access token and a new refresh token of `family` (a new one: a login).
+    The refresh token is added to `db` (a Session or AsyncSession); the caller commits."""
+    refresh_token = secrets.token_urlsafe(32)
+    db.add(models.RefreshToken(
+        token_hash=_token_hash(refresh_token),
+        user_id=user.id,
+        family=family or secrets.token_bytes(16),
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_DAYS),
+    ))
+    return {
+        "access_token": create_claims_token(user),
+        "refresh_token": refresh_token,
+        "expires_in": CLAIMS_ACCESS_TOKEN_MINUTES * 60,
+    }
+
+def rotate_refresh_token(db: Session, refresh_token: str):
+    """Use `refresh_token` once: returns (user, tokens) and commits, or raises 401."""
+    credentials_exception = _credentials_exception()
+    row = db.get(models.RefreshToken, _token_hash(refresh_token or ""))
+    if row is None or row.expires_at <= datetime.utcnow():
+        raise credentials_exception
+    # claim the token; a concurrent refresh with the same token finds it used
+    claimed = db.query(models.RefreshToken).filter(
+        models.RefreshToken.token_hash == row.token_hash, models.RefreshToken.used_at.is_(None)
+    ).update({"used_at": datetime.utcnow()}, synchronize_session=False)
+    if not claimed:
+        print(f"[auth] Refresh token reused; revoking its family (user {row.user_id})")
+        db.query(models.RefreshToken).filter(models.RefreshToken.family == row.family).delete()
+        db.commit()
+        raise credentials_exception
+    user = db.get(models.User, row.user_id)
+    if user is None:
+        raise credentials_exception
+    tokens = issue_tokens(db, user, family=row.family)
+    db.commit()
+    return user, tokens
+
+def revoke_refresh_token(db: Session, refresh_token: str):
+    """Revoke the login `refresh_token` belongs to (every token of its family)."""
+    row = db.get(models.RefreshToken, _token_hash(refresh_token or ""))
+    if row is not None:
+        db.query(models.RefreshToken).filter(models.RefreshToken.family == row.family).delete()
+
+def revoke_user_refresh_tokens(db: Session, user_id: int):
+    db.query(models.RefreshToken).filter(models.RefreshToken.user_id == user_id).delete()
 
 
 # --- User Dependency ---
@@ -63,14 +168,76 @@ def verify_token(token: str, credentials_exception):
 def get_user(db: Session, email: EmailStr):
     return db.query(models.User).filter(models.User.email == email).first()
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
-    credentials_exception = HTTPException(
+async def get_user_async(db: AsyncSession, email: EmailStr):
+    result = await db.execute(select(models.User).filter(models.User.email == email))
+    return result.scalars().first()
+
+def _credentials_exception():
+    return HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    token_data = verify_token(token, credentials_exception)
-    user = get_user(db, email=token_data.email)
-    if user is None:
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(database.get_db)):
+    """The identity (id, email, role, name) of the token's user: from the token's claims, or
+    else from app.identity_cache / the users table. Not a session-bound User: load the row
+    when the endpoint needs more."""
+    credentials_exception = _credentials_exception()
+    payload = decode_token(token, credentials_exception)
+    identity = identity_from_claims(payload) or identity_cache.users.get(payload["sub"])
+    if identity is None:
+        generation = identity_cache.users.generation()
+        user = get_user(db, email=payload["sub"])
+        if user is None:
+            raise credentials_exception
+        identity = identity_cache.identity(user)
+        identity_cache.users.put(payload["sub"], identity, generation)
+    return identity
+
+def get_admin_user(current_user=Depends(get_current_user)):
+    """get_current_user for the /admin routes. There is no separate admin role: staff
+    (doctors) may use them, patients get 403."""
+    if current_user.role not in ADMIN_ROLES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
+async def get_current_user_async(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(database.get_async_db)):
+    """Async twin of get_current_user."""
+    credentials_exception = _credentials_exception()
+    payload = decode_token(token, credentials_exception)
+    return identity_from_claims(payload) or await _identity_async(db, payload["sub"], credentials_exception)
+
+async def _identity_async(db: AsyncSession, email: str, credentials_exception):
+    identity = identity_cache.users.get(email)
+    if identity is None:
+        generation = identity_cache.users.generation()
+        user = await get_user_async(db, email=email)
+        if user is None:
+            raise credentials_exception
+        identity = identity_cache.identity(user)
+        identity_cache.users.put(email, identity, generation)
+    return identity
+
+async def authenticate_token_async(token: Optional[str]):
+    """Resolve a bearer token with a short-lived session, for long-lived connections
+    (SSE / WebSocket) that must not hold a database connection while idle."""
+    credentials_exception = _credentials_exception()
+    if not token:
         raise credentials_exception
-    return user
+    payload = decode_token(token, credentials_exception)
+    identity = identity_from_claims(payload)
+    if identity is not None:
+        return identity
+    async with database.AsyncSessionLocal() as db:  # connects only on a cache miss
+        return await _identity_async(db, payload["sub"], credentials_exception)
+
+def token_subject(authorization: Optional[str]):
+    """The subject of a valid `Bearer` Authorization header, or None. No database access."""
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM]).get("sub")
+    except JWTError:
+        return None
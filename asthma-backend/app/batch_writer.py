@@ -0,0 +1,135 @@
+# asthma-backend/batch_writer.py
+"""
+Bounded in-process queue of rows that a background task writes in batched INSERTs.
+
+Used for tables that are written often, read rarely and don't need to be durable the
+moment the row is produced (delivery logs, audit events). add() never blocks: when the
+queue is full the row is dropped and counted. The queue is drained every `flush_seconds`,
+or as soon as `batch_size` rows are waiting, with one multi-row INSERT per target table in
+a single transaction (after `prepare(conn, tables)`, if given, e.g. to create a table). A batch the database rejects is retried row by row, so only the
+failing rows are lost. stop() writes what is still queued; a crash loses at most the rows
+of the last interval.
+"""
+
+import asyncio
+import queue
+import threading
+
+from sqlalchemy import insert
+from sqlalchemy.exc import SQLAlchemyError
+from starlette.concurrency import run_in_threadpool
+
+
+class BatchWriter:
+    def __init__(self, name: str, flush_seconds: float, batch_size: int, max_queue: int, prepare=None):
+        self.name = name
+        self.prepare = prepare
+        self.flush_seconds = flush_seconds
+        self.batch_size = batch_size
+        self.stats = {"queued": 0, "written": 0, "dropped": 0, "rejected": 0, "flushes": 0,
+                      "failed_flushes": 0, "max_depth": 0}
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._flush_lock = threading.Lock()
+        self._task = None
+        self._loop = None
+        self._wakeup = None
+
+    def add(self, table, row: dict) -> bool:
+        """Queue one row for `table` (a model or Table). Returns False if it was dropped."""
+        try:
+            self._queue.put_nowait((table, row))
+        except queue.Full:
+            self.stats["dropped"] += 1
+            return False
+        self.stats["queued"] += 1
+        depth = self._queue.qsize()
+        self.stats["max_depth"] = max(self.stats["max_depth"], depth)
+        if depth >= self.batch_size:
+            self._wake()
+        return True
+
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def _wake(self):
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and wakeup is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def _take(self):
+        batch = []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, engine, batch) -> int:
+        by_table = {}
+        for table, row in batch:
+            by_table.setdefault(table, []).append(row)
+        try:
+            with engine.begin() as conn:
+                if self.prepare:
+                    self.prepare(conn, list(by_table))
+                for table, rows in by_table.items():
+                    conn.execute(insert(table), rows)
+            return len(batch)
+        except SQLAlchemyError as e:
+            print(f"[{self.name}] Batch of {len(batch)} rejected, retrying row by row: {getattr(e, 'orig', e)}")
+            self.stats["failed_flushes"] += 1
+        written = 0
+        for table, row in batch:
+            try:
+                with engine.begin() as conn:
+                    if self.prepare:
+                        self.prepare(conn, [table])
+                    conn.execute(insert(table), row)
+                written += 1
+            except SQLAlchemyError:
+                self.stats["rejected"] += 1
+        return written
+
+    def flush(self, engine) -> int:
+        """Write every queued row. Returns the number of rows written."""
+        total = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take()
+                if not batch:
+                    break
+                written = self._write(engine, batch)
+                self.stats["written"] += written
+                total += written
+        if total:
+            self.stats["flushes"] += 1
+        return total
+
+    async def _run(self, engine):
+        while True:
+            self._wakeup.clear()
+            try:
+                await run_in_threadpool(self.flush, engine)
+            except Exception as e:
+                print(f"[{self.name}] Flush failed: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, engine):
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._task = self._loop.create_task(self._run(engine))
+
+    def stop(self, engine):
+        """Stop the background flush and write what is still queued."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._loop = None
+        written = self.flush(engine)
+        if written:
+            print(f"[{self.name}] Wrote {written} queued rows on shutdown")
@@ -0,0 +1,162 @@
+# asthma-backend/changelog.py
+"""
+Change log behind the delta sync endpoint (/sync).
+
+Every flush that inserts, updates or deletes a tracked entity appends one `change_log` row
+per entity (owner, table name, id, deleted flag) in the same transaction. This happens in a
+Session after_flush hook, so no write path has to remember it. SQLite allows one writer at a
+time, so change ids become visible in increasing order and "all changes with id > token"
+never skips a committed change.
+
+Bulk statements (Query.update()/delete(), insert()/update()/delete()) bypass the ORM and
+have to call record_updated() / record_deleted() themselves. Deleting a medication implies deleting its
+status history, so those rows get no tombstones of their own.
+
+Rows older than CHANGE_LOG_RETENTION_DAYS are pruned by the retention job (app.retention),
+oldest first and never the newest row. A token older than the oldest remaining row may have
+missed changes, so /sync answers it with a full snapshot (see horizon()).
+"""
+
+import datetime
+import os
+from collections import defaultdict
+
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.orm import Session
+
+from app import models
+
+SYNC_MAX_CHANGES = int(os.getenv("SYNC_MAX_CHANGES", "2000"))
+CHANGE_LOG_RETENTION_DAYS = int(os.getenv("CHANGE_LOG_RETENTION_DAYS", "30"))
+
+TRACKED = (
+    models.PEFRRecord,
+    models.Symptom,
+    models.Medication,
+    models.MedicationStatusHistory,
+    models.Reminder,
+    models.EmergencyContact,
+    models.Notification,
+)
+ENTITIES = {model.__tablename__: model for model in TRACKED}
+
+
+# ------------------------------------------------------------
+# Writing
+# ------------------------------------------------------------
+
+def _owner_id(session: Session, obj, medication_owners: dict):
+    if isinstance(obj, models.MedicationStatusHistory):
+        med_id = obj.medication_id
+        if med_id not in medication_owners:
+            medication_owners[med_id] = session.connection().execute(
+                select(models.Medication.owner_id).where(models.Medication.id == med_id)
+            ).scalar()
+        return medication_owners[med_id]
+    return obj.owner_id
+
+
+@event.listens_for(Session, "after_flush")
+def _log_changes(session: Session, flush_context):
+    # new/dirty/deleted still describe what this flush wrote
+    changes = [(obj, False) for obj in session.new]
+    changes += [(obj, False) for obj in session.dirty if session.is_modified(obj, include_collections=False)]
+    changes += [(obj, True) for obj in session.deleted]
+
+    now = datetime.datetime.utcnow()
+    medication_owners = {}
+    rows = []
+    for obj, deleted in changes:
+        if not isinstance(obj, TRACKED):
+            continue
+        owner_id = _owner_id(session, obj, medication_owners)
+        if owner_id is None:
+            continue
+        rows.append({"owner_id": owner_id, "entity": obj.__tablename__, "entity_id": obj.id,
+                     "deleted": deleted, "changed_at": now})
+    if rows:
+        session.connection().execute(insert(models.ChangeLog), rows)
+
+
+def _record_bulk(session: Session, model, rows, deleted: bool):
+    now = datetime.datetime.utcnow()
+    values = [{"owner_id": owner_id, "entity": model.__tablename__, "entity_id": row_id,
+               "deleted": deleted, "changed_at": now} for row_id, owner_id in rows if owner_id is not None]
+    if values:
+        session.execute(insert(models.ChangeLog), values)
+
+
+def record_updated(session: Session, model, rows):
+    """Changes for a bulk insert or update. `rows` are the (id, owner_id) pairs it touched."""
+    _record_bulk(session, model, rows, deleted=False)
+
+
+def record_deleted(session: Session, model, rows):
+    """Tombstones for a bulk delete. `rows` are (id, owner_id) pairs selected before deleting.
+    `session` may also be a Connection (the retention job)."""
+    _record_bulk(session, model, rows, deleted=True)
+
+
+# ------------------------------------------------------------
+# Reading
+# ------------------------------------------------------------
+
+def current_token(session: Session) -> int:
+    return session.query(func.max(models.ChangeLog.id)).scalar() or 0
+
+
+def horizon(session: Session) -> int:
+    """The oldest token changes_since() can still answer; the changes up to it may be pruned."""
+    oldest = session.query(func.min(models.ChangeLog.id)).scalar()
+    return oldest - 1 if oldest else 0
+
+
+def _owned(session: Session, model, owner_id: int):
+    if model is models.MedicationStatusHistory:
+        med_ids = select(models.Medication.id).filter(models.Medication.owner_id == owner_id)
+        return session.query(model).filter(model.medication_id.in_(med_ids))
+    return session.query(model).filter(model.owner_id == owner_id)
+
+
+def snapshot(session: Session, owner_id: int):
+    """Everything the user owns, for a client without a token. Returns (token, upserts)."""
+    # read the token first: a change committed while we read is then sent again, never lost
+    token = current_token(session)
+    upserts = {name: _owned(session, model, owner_id).order_by(model.id).all() for name, model in ENTITIES.items()}
+    return token, upserts
+
+
+def changes_since(session: Session, owner_id: int, since: int, limit: int = None):
+    """The user's changes after `since` (at most `limit`, default SYNC_MAX_CHANGES), collapsed to
+    the last change per entity. Returns (token, has_more, upserts, deleted)."""
+    limit = limit or SYNC_MAX_CHANGES
+    rows = session.query(
+        models.ChangeLog.id, models.ChangeLog.entity, models.ChangeLog.entity_id, models.ChangeLog.deleted
+    ).filter(
+        models.ChangeLog.owner_id == owner_id, models.ChangeLog.id > since
+    ).order_by(models.ChangeLog.id).limit(limit + 1).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    token = rows[-1].id if rows else since
+
+    last = {}
+    for row in rows:
+        last[(row.entity, row.entity_id)] = row.deleted
+
+    live = defaultdict(list)
+    deleted = defaultdict(list)
+    for (entity, entity_id), is_deleted in last.items():
+        if entity not in ENTITIES:
+            continue
+        (deleted if is_deleted else live)[entity].append(entity_id)
+
+    upserts = {}
+    for entity, ids in live.items():
+        model = ENTITIES[entity]
+        found = session.query(model).filter(model.id.in_(ids)).order_by(model.id).all()
+        upserts[entity] = found
+        # gone since it was logged (e.g. history removed with its medication)
+        deleted[entity].extend(sorted(set(ids) - {obj.id for obj in found}))
+
+    return token, has_more, upserts, {entity: ids for entity, ids in deleted.items() if ids}
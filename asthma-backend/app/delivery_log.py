@@ -0,0 +1,53 @@
+# asthma-backend/delivery_log.py
+"""
+Buffered writes for delivery logs (push_logs, email_logs).
+
+Delivery logs are written often and read rarely (admin pages, debugging), and nothing
+depends on them being durable the moment a push or email goes out. Callers hand rows to
+add() instead of opening a session and committing; a BatchWriter (app.batch_writer) writes
+them every DELIVERY_LOG_FLUSH_SECONDS, or as soon as DELIVERY_LOG_BATCH_SIZE rows are
+waiting. At most DELIVERY_LOG_MAX_QUEUE rows are held; beyond that new rows are dropped
+and counted instead of blocking the caller. A push log whose recipient deleted their
+account while it was queued is rejected on its own, the rest of its batch is kept.
+
+stats holds the counters shown by /admin/delivery-log-stats.
+"""
+
+import datetime
+import os
+
+from app.batch_writer import BatchWriter
+
+DELIVERY_LOG_FLUSH_SECONDS = float(os.getenv("DELIVERY_LOG_FLUSH_SECONDS", "2"))
+DELIVERY_LOG_BATCH_SIZE = int(os.getenv("DELIVERY_LOG_BATCH_SIZE", "500"))
+DELIVERY_LOG_MAX_QUEUE = int(os.getenv("DELIVERY_LOG_MAX_QUEUE", "10000"))
+
+writer = BatchWriter("delivery_log", DELIVERY_LOG_FLUSH_SECONDS, DELIVERY_LOG_BATCH_SIZE, DELIVERY_LOG_MAX_QUEUE)
+stats = writer.stats
+
+
+def add(model, row: dict) -> bool:
+    """Queue one log row for `model`. Never blocks; returns False if the row was dropped."""
+    row.setdefault("created_at", datetime.datetime.utcnow())
+    return writer.add(model, row)
+
+
+def add_many(model, rows: list):
+    for row in rows:
+        add(model, row)
+
+
+def depth() -> int:
+    return writer.depth()
+
+
+def flush(engine) -> int:
+    return writer.flush(engine)
+
+
+def start(engine):
+    writer.start(engine)
+
+
+def stop(engine):
+    writer.stop(engine)
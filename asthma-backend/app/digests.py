@@ -0,0 +1,143 @@
+# asthma-backend/digests.py
+"""
+Per-recipient coalescing of routine notifications.
+
+A doctor with many patients used to get one Notification row and one push per reading and
+per medication change. Write paths now call notify() instead. Urgent events (red-zone
+readings) and event types without a window are delivered at once, as before. Routine
+events are merged into one `notification_digests` row per (recipient, event type): the first
+event opens a window of NOTIFY_COALESCE_SECONDS (NOTIFY_COALESCE_SECONDS_<TYPE> per type,
+0 turns coalescing off), later ones only bump its count and patients.
+
+When the window closes the background flush turns each row into one Notification and one
+push (via the outbox): the original message when a single event was held back, otherwise a
+summary such as "12 patients recorded readings". Pending digests live in the database, so a
+restart delays them by at most one flush interval. `python -m app.digests` flushes due
+digests by hand.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app import models, push
+
+NOTIFY_COALESCE_SECONDS = float(os.getenv("NOTIFY_COALESCE_SECONDS", "300"))
+NOTIFY_FLUSH_SECONDS = float(os.getenv("NOTIFY_FLUSH_SECONDS", "5"))
+
+# summary of a digest that merged events about several patients: (message, link)
+SUMMARIES = {
+    "pefr": ("{patients} patients recorded readings ({count} in total)", "/doctor/patients"),
+    "medication": ("{patients} patients updated their medications ({count} changes)", "/doctor/patients"),
+}
+DEFAULT_SUMMARY = ("{count} updates from {patients} patients", "/notifications")
+
+WINDOWS = {
+    kind: float(os.getenv(f"NOTIFY_COALESCE_SECONDS_{kind.upper()}", NOTIFY_COALESCE_SECONDS))
+    for kind in SUMMARIES
+}
+
+D = models.NotificationDigest
+
+_task = None
+
+
+def window(kind: str) -> float:
+    return WINDOWS.get(kind, NOTIFY_COALESCE_SECONDS)
+
+
+def deliver(session: Session, owner_id: int, title: str, message: str, link: str = None, data: dict = None):
+    """One Notification and one queued push, in the caller's transaction."""
+    session.add(models.Notification(owner_id=owner_id, message=message, link=link))
+    push.enqueue(session, owner_id, title, message, {"link": link, **(data or {})} if link else data)
+
+
+def notify(session: Session, owner_id: int, kind: str, title: str, message: str, link: str = None,
+           data: dict = None, subject=None, urgent: bool = False):
+    """Notify `owner_id` about an event of type `kind`; `subject` is the (patient id, name) it is about."""
+    seconds = window(kind)
+    if urgent or seconds <= 0:
+        deliver(session, owner_id, title, message, link, data)
+        return
+
+    now = datetime.datetime.utcnow()
+    row = session.get(D, (owner_id, kind))
+    if row is None:
+        row = D(owner_id=owner_id, kind=kind, count=0, subjects="{}", first_at=now,
+                due_at=now + datetime.timedelta(seconds=seconds))
+        session.add(row)
+    subjects = json.loads(row.subjects or "{}")
+    if subject is not None:
+        subjects[str(subject[0])] = subject[1]
+    row.count = (row.count or 0) + 1
+    row.subjects = json.dumps(subjects)
+    row.title, row.message, row.link = title, message, link
+    row.data = json.dumps(data or {})
+
+
+def _summarize(row):
+    """(message, link, data) of a closed digest."""
+    data = json.loads(row.data or "{}")
+    if row.count <= 1:
+        return row.message, row.link, data
+    patients = len(json.loads(row.subjects or "{}"))
+    if patients <= 1:
+        return f"{row.message} (+{row.count - 1} earlier)", row.link, data
+    template, link = SUMMARIES.get(row.kind, DEFAULT_SUMMARY)
+    return template.format(patients=patients, count=row.count), link, {"count": row.count}
+
+
+def flush_due(engine, now: datetime.datetime = None):
+    """Deliver every digest whose window has closed. Returns the number delivered."""
+    now = now or datetime.datetime.utcnow()
+    with Session(bind=engine) as session:
+        rows = session.execute(
+            delete(D).where(D.due_at <= now)
+            .returning(D.owner_id, D.kind, D.count, D.subjects, D.title, D.message, D.link, D.data)
+        ).all()
+        if not rows:
+            return 0
+        # recipients may have deleted their account while the digest was pending
+        owners = set(session.scalars(select(models.User.id).where(models.User.id.in_({r.owner_id for r in rows}))))
+        delivered = 0
+        for row in rows:
+            if row.owner_id not in owners:
+                continue
+            message, link, data = _summarize(row)
+            deliver(session, row.owner_id, row.title, message, link, data)
+            delivered += 1
+        session.commit()
+        return delivered
+
+
+async def _loop(engine):
+    while True:
+        try:
+            await run_in_threadpool(flush_due, engine)
+        except Exception as e:
+            print(f"[digests] Flush failed: {e}")
+        await asyncio.sleep(NOTIFY_FLUSH_SECONDS)
+
+
+def start(engine):
+    global _task
+    if _task is None:
+        _task = asyncio.get_running_loop().create_task(_loop(engine))
+
+
+def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+
+
+if __name__ == "__main__":
+    from app.database import engine
+
+    print(f"Delivered {flush_due(engine)} notification digests")
@@ -0,0 +1,223 @@
+# asthma-backend/fcm.py
+"""
+Asyncio client for the FCM HTTP v1 API, used by the push dispatcher (app.push).
+
+  - shared httpx.AsyncClients (HTTP/2 when h2 is installed) whose connections stay open
+    between batches. The connections are spread over several clients of FCM_POOL_SIZE each:
+    httpcore schedules requests in time quadratic in its pool size, and one pool of 64
+    connections spent more CPU on that than on the sends;
+  - OAuth2 access tokens are minted from the service account (a signed JWT exchanged at its
+    token_uri) and cached until FCM_TOKEN_REFRESH_MARGIN_SECONDS before they expire; a 401
+    drops the cached token and retries once;
+  - HTTP v1 has no multicast call, every device token is one request. All of them are
+    started together and the FCM_CONCURRENCY semaphore keeps at most that many in flight, so
+    a slow request holds up only its own slot;
+  - FCM error codes are mapped per token: UNREGISTERED, SENDER_ID_MISMATCH and an invalid
+    registration token mark the token dead (the dispatcher deactivates it); UNAVAILABLE,
+    INTERNAL, QUOTA_EXCEEDED and network errors are transient and retried with backoff.
+
+send() returns the same dict as firebase_messaging.send_messages_to_tokens, with a `code`
+and a `dead` flag on each response. FCM_ENDPOINT points the client elsewhere, e.g. at
+scripts/fcm_emulator.py for offline benchmarks; the emulator needs no credentials. Without
+credentials and against the real endpoint the client warns once and sends nothing; the
+pushes it skipped are counted in stats["suppressed"].
+"""
+
+import asyncio
+import itertools
+import json
+import os
+import time
+
+import httpx
+
+try:
+    from google.auth import crypt as google_crypt, jwt as google_jwt
+except Exception:
+    google_crypt = None
+    google_jwt = None
+
+FCM_ENDPOINT = os.getenv("FCM_ENDPOINT", "https://fcm.googleapis.com").rstrip("/")
+FCM_PROJECT_ID = os.getenv("FCM_PROJECT_ID")
+FCM_CONCURRENCY = int(os.getenv("FCM_CONCURRENCY", "64"))
+FCM_TIMEOUT_SECONDS = float(os.getenv("FCM_TIMEOUT_SECONDS", "10"))
+FCM_HTTP2 = os.getenv("FCM_HTTP2", "true").lower() in ("1", "true", "yes")
+FCM_TOKEN_REFRESH_MARGIN_SECONDS = float(os.getenv("FCM_TOKEN_REFRESH_MARGIN_SECONDS", "300"))
+FCM_POOL_SIZE = 8
+
+GOOGLE_ENDPOINT = "https://fcm.googleapis.com"
+SCOPE = "https://www.googleapis.com/auth/firebase.messaging"
+
+DEAD_CODES = {"UNREGISTERED", "SENDER_ID_MISMATCH"}
+# error code by HTTP status, when the body carries no FcmError detail
+STATUS_CODES = {400: "INVALID_ARGUMENT", 401: "THIRD_PARTY_AUTH_ERROR", 403: "SENDER_ID_MISMATCH",
+                404: "UNREGISTERED", 429: "QUOTA_EXCEEDED", 500: "INTERNAL", 503: "UNAVAILABLE"}
+
+
+def _credentials_info():
+    # same variables as firebase_messaging
+    path = os.getenv("GOOGLE_APPLICATION_CREDENTIALS") or os.getenv("FIREBASE_ADMIN_CREDENTIALS")
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _error(response: httpx.Response):
+    """(code, message) of a failed send."""
+    code = message = None
+    try:
+        error = response.json().get("error") or {}
+        message = error.get("message")
+        code = error.get("status")
+        for detail in error.get("details") or []:
+            if str(detail.get("@type", "")).endswith("FcmError") and detail.get("errorCode"):
+                code = detail["errorCode"]
+    except ValueError:
+        pass
+    return code or STATUS_CODES.get(response.status_code, "UNKNOWN"), message or response.text[:200]
+
+
+class AccessTokenCache:
+    """OAuth2 access token for a service account, refreshed shortly before it expires."""
+
+    def __init__(self, info: dict):
+        self.info = info
+        self.token = None
+        self.expires_at = 0.0
+        self.refreshes = 0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self.token = None
+
+    async def get(self, http: httpx.AsyncClient) -> str:
+        if self.token and time.time() < self.expires_at - FCM_TOKEN_REFRESH_MARGIN_SECONDS:
+            return self.token
+        async with self._lock:
+            # another request may have refreshed it while we waited
+            if self.token and time.time() < self.expires_at - FCM_TOKEN_REFRESH_MARGIN_SECONDS:
+                return self.token
+            if google_jwt is None:
+                raise RuntimeError("google-auth is not installed; cannot sign FCM access token requests")
+            now = int(time.time())
+            token_uri = self.info.get("token_uri", "https://oauth2.googleapis.com/token")
+            assertion = google_jwt.encode(
+                google_crypt.RSASigner.from_service_account_info(self.info),
+                {"iss": self.info["client_email"], "scope": SCOPE, "aud": token_uri, "iat": now, "exp": now + 3600},
+            )
+            res = await http.post(token_uri, data={
+                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+                "assertion": assertion.decode() if isinstance(assertion, bytes) else assertion,
+            })
+            res.raise_for_status()
+            body = res.json()
+            self.token = body["access_token"]
+            self.expires_at = now + float(body.get("expires_in", 3600))
+            self.refreshes += 1
+            return self.token
+
+
+class FCMClient:
+    def __init__(self, endpoint: str = FCM_ENDPOINT, project_id: str = None, credentials_info: dict = None,
+                 concurrency: int = FCM_CONCURRENCY, http2: bool = FCM_HTTP2, timeout: float = FCM_TIMEOUT_SECONDS):
+        self.endpoint = endpoint.rstrip("/")
+        self.emulated = self.endpoint != GOOGLE_ENDPOINT
+        info = credentials_info if credentials_info is not None else _credentials_info()
+        self.project_id = project_id or FCM_PROJECT_ID or (info or {}).get("project_id") or "emulator"
+        self.enabled = bool(info) or self.emulated
+        self._tokens = AccessTokenCache(info) if info else None
+        self._concurrency = max(1, concurrency)
+        self._http2 = http2
+        self._timeout = timeout
+        self._pools = None
+        self._next_pool = itertools.count()
+        self._limit = None
+        self._warned = False
+        self.stats = {"requests": 0, "success": 0, "failure": 0, "dead": 0, "suppressed": 0}
+
+    @property
+    def url(self):
+        return f"{self.endpoint}/v1/projects/{self.project_id}/messages:send"
+
+    def _new_pool(self, size: int) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=size, max_keepalive_connections=size)
+        try:
+            return httpx.AsyncClient(http2=self._http2, timeout=self._timeout, limits=limits)
+        except ImportError:
+            # h2 missing: HTTP/1.1 keep-alive pool
+            return httpx.AsyncClient(timeout=self._timeout, limits=limits)
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._pools is None:
+            sizes = [min(FCM_POOL_SIZE, self._concurrency - i) for i in range(0, self._concurrency, FCM_POOL_SIZE)]
+            self._pools = [self._new_pool(size) for size in sizes]
+            self._limit = asyncio.Semaphore(self._concurrency)
+        return self._pools[next(self._next_pool) % len(self._pools)]
+
+    async def _access_token(self, http):
+        return await self._tokens.get(http) if self._tokens else "emulator"
+
+    async def _send_one(self, http, token: str, message: dict, retry_auth: bool = True):
+        payload = {"message": {**message, "token": token}}
+        async with self._limit:
+            try:
+                headers = {"Authorization": f"Bearer {await self._access_token(http)}"}
+                res = await http.post(self.url, json=payload, headers=headers)
+            except (httpx.HTTPError, OSError) as e:
+                return {"token": token, "success": False, "code": "UNAVAILABLE", "dead": False,
+                        "error": f"{type(e).__name__}: {e}"}
+        self.stats["requests"] += 1
+        if res.status_code == 200:
+            return {"token": token, "success": True, "response": res.json().get("name")}
+        if res.status_code == 401 and retry_auth and self._tokens:
+            self._tokens.invalidate()
+            return await self._send_one(http, token, message, retry_auth=False)
+        code, text = _error(res)
+        dead = code in DEAD_CODES or (code == "INVALID_ARGUMENT" and "registration token" in str(text).lower())
+        return {"token": token, "success": False, "code": code, "dead": dead, "error": f"{code}: {text}"}
+
+    async def send(self, tokens: list, title: str, body: str, data: dict = None) -> dict:
+        """Send one notification to every token. Never raises for per-token failures."""
+        if not tokens:
+            return {"success": 0, "failure": 0, "responses": []}
+        if not self.enabled:
+            if not self._warned:
+                print("[fcm] No credentials and no FCM_ENDPOINT emulator; pushes are not sent")
+                self._warned = True
+            self.stats["suppressed"] += len(tokens)
+            return {"success": len(tokens), "failure": 0, "responses": []}
+
+        message = {"notification": {"title": title, "body": body},
+                   "data": {k: str(v) for k, v in (data or {}).items()}}
+        # _limit bounds the requests in flight
+        responses = await asyncio.gather(*(self._send_one(self._client(), token, message) for token in tokens))
+
+        success = sum(1 for r in responses if r["success"])
+        self.stats["success"] += success
+        self.stats["failure"] += len(responses) - success
+        self.stats["dead"] += sum(1 for r in responses if r.get("dead"))
+        return {"success": success, "failure": len(responses) - success, "responses": responses}
+
+    async def aclose(self):
+        if self._pools is not None:
+            for pool in self._pools:
+                await pool.aclose()
+            self._pools = None
+
+
+_client = None
+
+
+def get_client() -> FCMClient:
+    global _client
+    if _client is None:
+        _client = FCMClient()
+    return _client
+
+
+async def close():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
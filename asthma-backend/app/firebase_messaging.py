@@ -44,21 +44,36 @@ def send_message_to_token(token: str, title: str, body: str, data: dict = None)
             token=token,
             data=(data or {})
         )
-        res = messaging.send(message)
-        print("FCM sent: ", res)
+        messaging.send(message)
         return True
     except Exception as e:
         print("FCM send failed:", e)
         return False
 
 
+# FCM accepts at most this many tokens per multicast message
+MULTICAST_LIMIT = 500
+
+
 def send_messages_to_tokens(tokens: list, title: str, body: str, data: dict = None) -> dict:
-    """Send to multiple tokens using multicast. Returns dict with successes and failures."""
+    """Send to multiple tokens using multicast, in chunks of MULTICAST_LIMIT tokens.
+    Returns dict with successes and failures. The push dispatcher uses the async client in
+    app.fcm instead; this blocking path is kept for scripts and the test endpoint."""
     if not tokens:
         return {"success": 0, "failure": 0, "responses": []}
     if messaging is None:
         print("FCM not available; would send to tokens:", tokens)
         return {"success": len(tokens), "failure": 0, "responses": []}
+    if len(tokens) > MULTICAST_LIMIT:
+        total = {"success": 0, "failure": 0, "responses": []}
+        for i in range(0, len(tokens), MULTICAST_LIMIT):
+            part = send_messages_to_tokens(tokens[i:i + MULTICAST_LIMIT], title, body, data)
+            total["success"] += part["success"]
+            total["failure"] += part["failure"]
+            total["responses"] += part.get("responses") or []
+            if part.get("error"):
+                total["error"] = part["error"]
+        return total
 
     try:
         # Use send_each_for_multicast (supported in current firebase-admin)
@@ -0,0 +1,168 @@
+# asthma-backend/group_commit.py
+"""
+Group commit for small write transactions.
+
+A request hands the writer a unit of work: a function that takes a Session, performs its
+writes and returns whatever the caller needs. A single writer thread collects the units
+submitted by concurrent requests and runs them in ONE transaction, committing once
+GROUP_COMMIT_MAX_OPS units are pending or GROUP_COMMIT_WINDOW_MS has passed since the first
+one arrived. One fsync then covers the whole batch instead of one per request.
+
+Each unit runs inside its own SAVEPOINT, so a unit that raises only rolls back itself and
+its caller gets the exception. A caller's future is resolved only after the shared COMMIT,
+so any read it makes afterwards sees its own write.
+
+When the writer is not running (scripts, GROUP_COMMIT_ENABLED=false) units run inline in
+their own transaction with the same interface (run() does that on a threadpool thread).
+"""
+
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from sqlalchemy.orm import sessionmaker
+from starlette.concurrency import run_in_threadpool
+
+from app.database import engine
+
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "5"))
+GROUP_COMMIT_MAX_OPS = int(os.getenv("GROUP_COMMIT_MAX_OPS", "64"))
+
+# Objects returned by a unit are handed to another thread after commit, so keep them loaded
+WriterSession = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+
+_STOP = object()
+
+
+class GroupCommitWriter:
+    def __init__(self, session_factory=WriterSession, window_ms: float = GROUP_COMMIT_WINDOW_MS,
+                 max_ops: int = GROUP_COMMIT_MAX_OPS):
+        self._session_factory = session_factory
+        self._window = window_ms / 1000.0
+        self._max_ops = max(1, max_ops)
+        self._queue = queue.Queue()
+        self._thread = None
+        self.stats = {"batches": 0, "ops": 0, "failed_ops": 0, "max_batch": 0}
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._thread = threading.Thread(target=self._loop, name="group-commit-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        """Flush whatever is pending and stop the writer thread."""
+        if not self.running:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def submit(self, work) -> Future:
+        """Queue `work(session)`; the returned future resolves after the batch commits."""
+        fut = Future()
+        if not self.running:
+            self._flush([(work, fut)])
+        else:
+            self._queue.put((work, fut))
+        return fut
+
+    async def run(self, work):
+        """Await `work(session)` from an async route without blocking the event loop."""
+        if not self.running:
+            # the inline fallback commits in submit() itself, so do that on a worker thread
+            return (await run_in_threadpool(self.submit, work)).result()
+        return await asyncio.wrap_future(self.submit(work))
+
+    # --- writer thread ---
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self._window
+            while len(batch) < self._max_ops:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+        # drain anything submitted while stopping
+        leftover = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                leftover.append(item)
+        if leftover:
+            self._flush(leftover)
+
+    def _flush(self, batch):
+        session = self._session_factory()
+        outcomes = []
+        try:
+            if session.get_bind().dialect.name == "sqlite":
+                # Take the write lock up front; also keeps pysqlite from committing at the first RELEASE
+                session.connection().exec_driver_sql("BEGIN IMMEDIATE")
+            for work, fut in batch:
+                savepoint = session.begin_nested()
+                try:
+                    result = work(session)
+                    savepoint.commit()
+                    outcomes.append((fut, result, None))
+                except Exception as e:
+                    savepoint.rollback()
+                    outcomes.append((fut, None, e))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            for work, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            self.stats["failed_ops"] += len(batch)
+            print(f"[group_commit] batch of {len(batch)} failed: {e}")
+            return
+        finally:
+            session.close()
+
+        self.stats["batches"] += 1
+        self.stats["ops"] += len(batch)
+        self.stats["max_batch"] = max(self.stats["max_batch"], len(batch))
+        for fut, result, error in outcomes:
+            if error is not None:
+                self.stats["failed_ops"] += 1
+                fut.set_exception(error)
+            else:
+                fut.set_result(result)
+
+
+writer = GroupCommitWriter()
+
+
+def start():
+    if GROUP_COMMIT_ENABLED:
+        writer.start()
+
+
+def stop():
+    writer.stop()
@@ -0,0 +1,172 @@
+# asthma-backend/idempotency.py
+"""
+Idempotency-Key support for POST and PATCH requests.
+
+The Android workers retry (`Result.retry()`) whenever a request times out, so the same
+reading, medication or status change can arrive several times. A client that sends an
+`Idempotency-Key` header (a unique string per logical operation, e.g. a UUID saved with the
+pending work) gets it applied once:
+
+  - the first request claims the key with an in-flight row in `idempotency_keys`, runs, and
+    its 2xx response is stored on that row before it is sent;
+  - a retry with the same key and the same request gets the stored response back, with an
+    `Idempotent-Replayed: true` header, without running the handler again;
+  - a retry while the first request is still running gets 409, and a key reused for a
+    different method, path or body gets 422.
+
+Keys are scoped to the caller (the bearer token's subject, anonymous otherwise). The /auth/
+endpoints are left out: their responses carry tokens and OTPs that must not be stored. Error
+responses are not stored, so a failed request can be retried with the same key; an
+in-flight claim older than IDEMPOTENCY_LOCK_SECONDS is treated as abandoned. Rows expire
+after IDEMPOTENCY_TTL_HOURS and are purged by the retention job. Requests without the
+header behave exactly as before.
+"""
+
+import datetime
+import hashlib
+import os
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse, Response
+
+from app import auth, database, models
+
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv("IDEMPOTENCY_LOCK_SECONDS", "60"))
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+METHODS = ("POST", "PATCH")
+EXCLUDED_PREFIXES = ("/auth/",)
+
+K = models.IdempotencyKey
+
+
+def _digest(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else str(part).encode())
+        h.update(b"\0")
+    return h.digest()
+
+
+async def _claim(key: bytes, request_hash: bytes):
+    """Returns ("claimed", None), ("replay", row), ("busy", None) or ("mismatch", None)."""
+    now = datetime.datetime.utcnow()
+    async with database.async_engine.begin() as conn:
+        inserted = await conn.execute(
+            sqlite_insert(K).values(key=key, request_hash=request_hash, created_at=now).on_conflict_do_nothing()
+        )
+        if inserted.rowcount == 1:
+            return "claimed", None
+
+        row = (await conn.execute(
+            select(K.request_hash, K.status_code, K.content_type, K.body, K.created_at).where(K.key == key)
+        )).first()
+        if row is None:
+            # purged between the two statements; let the client retry
+            return "busy", None
+        expired = row.created_at < now - datetime.timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+        abandoned = row.status_code is None and \
+            row.created_at < now - datetime.timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+        if expired or abandoned:
+            # start over; the created_at check keeps two retries from both taking it
+            taken = await conn.execute(
+                update(K).where(K.key == key, K.created_at == row.created_at)
+                .values(request_hash=request_hash, status_code=None, content_type=None, body=None, created_at=now)
+            )
+            return ("claimed", None) if taken.rowcount == 1 else ("busy", None)
+        if row.request_hash != request_hash:
+            return "mismatch", None
+        if row.status_code is None:
+            return "busy", None
+        return "replay", row
+
+
+async def _store(key: bytes, status_code: int, content_type, body: bytes):
+    async with database.async_engine.begin() as conn:
+        await conn.execute(
+            update(K).where(K.key == key).values(status_code=status_code, content_type=content_type, body=body)
+        )
+
+
+async def _release(key: bytes):
+    async with database.async_engine.begin() as conn:
+        await conn.execute(delete(K).where(K.key == key, K.status_code.is_(None)))
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+class IdempotencyMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] not in METHODS or scope["path"].startswith(EXCLUDED_PREFIXES):
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        raw_key = headers.get("idempotency-key")
+        if raw_key is None:
+            return await self.app(scope, receive, send)
+        if not raw_key.strip() or len(raw_key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            return await JSONResponse({"detail": "Invalid Idempotency-Key header"}, status_code=400)(scope, receive, send)
+
+        body = await _read_body(receive)
+        key = _digest(auth.token_subject(headers.get("authorization")) or "", raw_key)
+        request_hash = _digest(scope["method"], scope["path"], scope.get("query_string", b""), body)
+
+        state, row = await _claim(key, request_hash)
+        if state == "replay":
+            replay_headers = {"Idempotent-Replayed": "true"}
+            if row.content_type:
+                replay_headers["content-type"] = row.content_type
+            return await Response(row.body, status_code=row.status_code, headers=replay_headers)(scope, receive, send)
+        if state == "busy":
+            return await JSONResponse(
+                {"detail": "A request with this Idempotency-Key is still in progress"},
+                status_code=409, headers={"Retry-After": "1"},
+            )(scope, receive, send)
+        if state == "mismatch":
+            return await JSONResponse(
+                {"detail": "Idempotency-Key was already used for a different request"}, status_code=422
+            )(scope, receive, send)
+
+        body_sent = False
+
+        async def receive_body():
+            nonlocal body_sent
+            if not body_sent:
+                body_sent = True
+                return {"type": "http.request", "body": body, "more_body": False}
+            return await receive()
+
+        response = {"status": None, "content_type": None, "chunks": [], "stored": False}
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                response["content_type"] = Headers(raw=message.get("headers", [])).get("content-type")
+            elif message["type"] == "http.response.body":
+                response["chunks"].append(message.get("body", b""))
+                # store before the last chunk goes out, so a retry after the client got it replays
+                if not message.get("more_body") and 200 <= response["status"] < 300:
+                    await _store(key, response["status"], response["content_type"], b"".join(response["chunks"]))
+                    response["stored"] = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive_body, capture)
+        finally:
+            if not response["stored"]:
+                await _release(key)
@@ -0,0 +1,118 @@
+# asthma-backend/identity_cache.py
+"""
+In-process caches of who a token belongs to and which doctors a patient is linked to.
+
+Every authenticated request used to look its user up by email, and every PEFR reading,
+medication event and dashboard update queried doctor_patient_map for the patient's doctors.
+Both change rarely, so they are kept here:
+
+  - users: token subject (email) -> Identity(id, email, role, name);
+  - doctors: patient id -> tuple of linked doctor ids, ascending.
+
+Entries expire after IDENTITY_CACHE_TTL_SECONDS and the least recently used ones are evicted
+beyond IDENTITY_CACHE_MAX_ENTRIES per cache. The endpoints that change a user or a link
+(profile update, account deletion, linking and unlinking) invalidate the entry explicitly once
+they have committed; the TTL bounds how long other worker processes may serve the old value.
+A value loaded while an invalidation happened is not stored, so a load that raced a commit
+cannot put the old state back. Misses (unknown users) are never cached.
+
+stats of both caches are shown by /admin/identity-cache-stats.
+"""
+
+import collections
+import os
+import threading
+import time
+
+from sqlalchemy import select
+
+from app import models
+
+IDENTITY_CACHE_TTL_SECONDS = float(os.getenv("IDENTITY_CACHE_TTL_SECONDS", "60"))
+IDENTITY_CACHE_MAX_ENTRIES = int(os.getenv("IDENTITY_CACHE_MAX_ENTRIES", "10000"))
+
+Identity = collections.namedtuple("Identity", ["id", "email", "role", "name"])
+
+
+class TTLCache:
+    def __init__(self, name: str, ttl: float, max_entries: int):
+        self.name = name
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+
+    def get(self, key):
+        """The cached value of `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return value
+                del self._entries[key]
+                self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+
+    def generation(self) -> int:
+        """Take this before loading a value; pass it to put()."""
+        return self._generation
+
+    def put(self, key, value, generation: int):
+        """Store `value` unless something was invalidated since `generation` was taken."""
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, *keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._entries.pop(key, None)
+            self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+users = TTLCache("users", IDENTITY_CACHE_TTL_SECONDS, IDENTITY_CACHE_MAX_ENTRIES)
+doctors = TTLCache("doctors", IDENTITY_CACHE_TTL_SECONDS, IDENTITY_CACHE_MAX_ENTRIES)
+
+
+def identity(user) -> Identity:
+    return Identity(user.id, user.email, user.role, user.name)
+
+
+def linked_doctor_ids(session, patient_id: int) -> tuple:
+    """Ids of the doctors linked to `patient_id` (a sync Session or Connection), ascending."""
+    doctor_ids = doctors.get(patient_id)
+    if doctor_ids is None:
+        generation = doctors.generation()
+        doctor_ids = tuple(session.execute(
+            select(models.DoctorPatient.doctor_id)
+            .where(models.DoctorPatient.patient_id == patient_id)
+            .order_by(models.DoctorPatient.doctor_id)
+        ).scalars())
+        doctors.put(patient_id, doctor_ids, generation)
+    return doctor_ids
+
+
+def stats() -> dict:
+    return {cache.name: {"entries": len(cache), **cache.stats} for cache in (users, doctors)}
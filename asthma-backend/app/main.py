@@ -1,19 +1,23 @@
 # asthma-backend/main.py
-from fastapi import FastAPI, Depends, HTTPException, status, Query, Form
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Form, Response, WebSocket
 from fastapi.security import OAuth2PasswordRequestForm
-from fastapi.responses import JSONResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import select, desc, text, inspect
+from fastapi.responses import JSONResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
+from sqlalchemy import select, insert, update, delete, desc, func
 from typing import List, Optional
 
 import os
 import datetime
 
-from . import auth, database, models, schemas
+import numpy as np
+
+from . import analytics, audit, audit_store, auth, changelog, database, delivery_log, digests, fcm, group_commit, idempotency, identity_cache, migrations, models, otp_store, pagination, password_pool, push, realtime, retention, rollup, schemas, summary, trends
 from .database import engine
 from .otp_service import (
     generate_otp,
     store_otp,
+    get_pending,
     verify_otp,
     clear_otp,
     send_otp_email
@@ -23,65 +27,105 @@ from ml.predictor import get_predictor
 from . import firebase_messaging
 from fastapi import BackgroundTasks
 
-# Create all database tables on startup
 app = FastAPI()
+app.add_middleware(idempotency.IdempotencyMiddleware)
+
 
-# Create all database tables on startup
-models.Base.metadata.create_all(bind=engine)
+@app.on_event("startup")
+def apply_migrations():
+    """Bring the schema to HEAD; an up-to-date database costs a single version check."""
+    migrations.upgrade(engine)
 
 
 @app.on_event("startup")
-def ensure_medication_columns():
-    """Attempt to add medication metadata columns if they're missing (safe for dev SQLite)."""
-    try:
-        insp = inspect(engine)
-        if 'medications' not in insp.get_table_names():
-            # nothing to migrate if table doesn't exist yet
-            return
-
-        conn = engine.connect()
-        res = conn.execute(text("PRAGMA table_info('medications')")).fetchall()
-        existing_cols = [r[1] for r in res]
-        additions = {
-            'start_date': 'DATETIME',
-            'days': 'INTEGER',
-            'cure_probability': 'FLOAT',
-            'doses_remaining': 'INTEGER',
-            'source': 'TEXT',
-            'prescribed_by': 'INTEGER'
-        }
-        for col, ddl in additions.items():
-            if col not in existing_cols:
-                try:
-                    conn.execute(text(f"ALTER TABLE medications ADD COLUMN {col} {ddl}"))
-                    print(f"Added column {col} to medications table")
-                except Exception as e:
-                    print(f"Could not add column {col}: {e}")
-        conn.close()
-    except Exception as e:
-        print("Startup migration check failed:", e)
+def start_group_commit_writer():
+    group_commit.start()
+
+
+@app.on_event("shutdown")
+def stop_group_commit_writer():
+    group_commit.stop()
+
+
+@app.on_event("startup")
+async def start_notification_retention():
+    retention.start(engine)
+
+
+@app.on_event("shutdown")
+def stop_notification_retention():
+    retention.stop()
+
+
+@app.on_event("startup")
+async def start_push_dispatcher():
+    push.start(engine)
+
+
+@app.on_event("shutdown")
+async def stop_push_dispatcher():
+    await push.stop()
+
+
+@app.on_event("startup")
+async def start_digest_flush():
+    digests.start(engine)
+
+
+@app.on_event("shutdown")
+def stop_digest_flush():
+    digests.stop()
+
+
+@app.on_event("startup")
+async def start_audit_writer():
+    audit.start(engine)
+
+
+@app.on_event("shutdown")
+def stop_audit_writer():
+    audit.stop(engine)
+
+
+@app.on_event("startup")
+async def start_delivery_log_writer():
+    delivery_log.start(engine)
+
+
+@app.on_event("shutdown")
+def stop_delivery_log_writer():
+    # registered after the push dispatcher so its last logs are written too
+    delivery_log.stop(engine)
+
+
+@app.on_event("startup")
+async def start_otp_sweeper():
+    otp_store.start()
+
+
+@app.on_event("shutdown")
+def stop_otp_sweeper():
+    otp_store.stop()
 
 
 @app.on_event("startup")
-def ensure_user_columns():
-    """Ensure user table has FCM token column for push notifications."""
+def start_password_pool():
+    password_pool.start()
+
+
+@app.on_event("shutdown")
+def stop_password_pool():
+    password_pool.stop()
+
+
+@app.on_event("startup")
+def report_engine_profile():
+    """Log the SQLite engine profile in effect (DB_ENGINE_PROFILE) so benchmark runs are comparable."""
     try:
-        insp = inspect(engine)
-        if 'users' not in insp.get_table_names():
-            return
-
-        conn = engine.connect()
-        res = conn.execute(text("PRAGMA table_info('users')")).fetchall()
-        existing_cols = [r[1] for r in res]
-        if 'fcm_token' not in existing_cols:
-            try:
-                conn.execute(text("ALTER TABLE users ADD COLUMN fcm_token TEXT"))
-                print("Added column fcm_token to users table")
-            except Exception as e:
-                print(f"Could not add column fcm_token: {e}")
-        conn.close()
+        info = database.describe_engine_profile()
+        print("[db] engine profile: " + ", ".join(f"{k}={v}" for k, v in info.items()))
     except Exception as e:
-        print("Startup user migration check failed:", e)
+        print("Engine profile check failed:", e)
 
 
 # ------------------------------------------------------------
@@ -102,29 +146,42 @@ def calculate_zone(baseline: int, current_pefr: int):
         return ("Red", "Medical emergency. Seek immediate help.", percentage)
 
 
-def get_pefr_trend(db: Session, owner_id: int, current_pefr: int):
-    last_record = db.query(models.PEFRRecord).filter(
-        models.PEFRRecord.owner_id == owner_id
-    ).order_by(desc(models.PEFRRecord.recorded_at)).first()
+def calculate_zones(baseline: int, values):
+    """calculate_zone over a batch of readings in time order, as if recorded one by one:
+    each reading is graded against the baseline as raised by the readings before it.
+    Returns (zones, percentages) arrays."""
+    values = np.asarray(values, dtype=float)
+    baselines = np.maximum.accumulate(np.concatenate(([baseline or 0], values)))[:-1]
+    percentages = np.zeros(len(values))
+    np.divide(values * 100, baselines, out=percentages, where=baselines > 0)
+    zones = np.select(
+        [baselines == 0, percentages >= 80, percentages >= 50],
+        ["Unknown", "Green", "Yellow"],
+        default="Red",
+    )
+    return zones, percentages
+
 
-    if not last_record:
-        return "stable"
-    if current_pefr > last_record.pefr_value:
-        return "improving"
-    elif current_pefr < last_record.pefr_value:
-        return "worsening"
-    return "stable"
+def client_timestamp(ts: Optional[datetime.datetime], now: datetime.datetime):
+    """A device-supplied recorded_at as naive UTC (like server timestamps); None means now."""
+    if ts is None:
+        return now
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if ts > now + datetime.timedelta(seconds=BULK_MAX_CLOCK_SKEW_SECONDS):
+        raise HTTPException(status_code=400, detail="recorded_at is in the future")
+    return ts
 
 
-def log_audit(db: Session, user_id: int, action: str, details: str = None):
-    db_log = models.AuditLog(user_id=user_id, action=action, details=details)
-    db.add(db_log)
+def log_audit(db: Session, user_id: int, action: str, **details):
+    audit.log(db, user_id, action, details)
 
 
 def log_alert(db: Session, user_id: int, alert_type: str):
     db_alert = models.AlertLog(user_id=user_id, alert_type=alert_type)
     db.add(db_alert)
 
+
 # ------------------------------------------------------------
 # Root
 # ------------------------------------------------------------
@@ -135,10 +192,14 @@ def read_root():
 
 
 # Admin: view recent email send attempts (OTP/email logs)
-@app.get("/admin/email-logs", response_model=List[schemas.EmailLog])
-def get_email_logs(limit: int = 50, db: Session = Depends(database.get_db)):
-    rows = db.query(models.EmailLog).order_by(desc(models.EmailLog.created_at)).limit(limit).all()
-    return rows
+@app.get("/admin/email-logs", response_model=List[schemas.EmailLog], dependencies=[Depends(auth.get_admin_user)])
+def get_email_logs(
+    response: Response,
+    page: pagination.HistoryPage = Depends(),
+    db: Session = Depends(database.get_db)
+):
+    query = page.apply(db.query(models.EmailLog), models.EmailLog.created_at, models.EmailLog.id, newest_first=True)
+    return page.page(query.all(), response, ts_attr="created_at")
 
 # ------------------------------------------------------------
 # AUTHENTICATION (OTP BASED ONLY)
@@ -151,12 +212,16 @@ def signup_send_otp(user: schemas.UserCreate, background_tasks: BackgroundTasks,
     if auth.get_user(db, email=user.email):
         return JSONResponse(status_code=409, content={"error": "Email already exists"})
 
+    # the pending signup is kept until the OTP is verified, with the password already hashed
+    payload = user.dict()
+    payload["hashed_password"] = auth.get_password_hash(payload.pop("password"))
+
     otp = generate_otp()
     store_otp(
         email=user.email,
         otp=otp,
         purpose="signup",
-        payload=user.dict()
+        payload=payload
     )
 
     # Decide whether to actually attempt SMTP sending or return OTP for dev/testing
@@ -183,10 +248,10 @@ def signup_send_otp(user: schemas.UserCreate, background_tasks: BackgroundTasks,
 @app.post("/auth/resend-signup-otp")
 def resend_signup_otp(email: str = Form(...), background_tasks: BackgroundTasks = BackgroundTasks()):
     """Resend OTP for signup if user didn't receive it."""
-    if email not in otp_store:
+    data = get_pending(email)
+    if data is None:
         return JSONResponse(status_code=400, content={"error": "No OTP found for this email. Please start signup again."})
     
-    data = otp_store[email]
     if data["purpose"] != "signup":
         return JSONResponse(status_code=400, content={"error": "This email was not registered for signup."})
     
@@ -228,13 +293,12 @@ def verify_signup_otp(
         return JSONResponse(status_code=400, content={"error": data})
 
     user_data = data["payload"]
-    hashed_password = auth.get_password_hash(user_data["password"])
 
     db_user = models.User(
         email=user_data["email"],
         name=user_data["name"],
-        hashed_password=hashed_password,
-        role=user_data["role"],
+        hashed_password=user_data["hashed_password"],
+        role=models.UserRole(user_data["role"]),
         age=user_data.get("age"),
         height=user_data.get("height"),
         gender=user_data.get("gender"),
@@ -246,36 +310,67 @@ def verify_signup_otp(
     db.commit()
     db.refresh(db_user)
 
-    log_audit(db, db_user.id, "SIGNUP", f"OTP verified signup for {db_user.email}")
+    log_audit(db, db_user.id, "SIGNUP")
     db.commit()
 
     clear_otp(email)
     return {"message": "Signup successful. Please login."}
 
 
-# 🔹 LOGIN (UNCHANGED)
+# 🔹 LOGIN
 @app.post("/auth/login", response_model=schemas.Token)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(database.get_db)):
-
-    user = auth.get_user(db, email=form_data.username)
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_async_db)):
+    """Async so that waiting for bcrypt (app.password_pool) holds no request thread."""
+    user = await auth.get_user_async(db, email=form_data.username)
     if not user:
+        password_pool.record_login(False)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
     
-    if not auth.verify_password(form_data.password, user.hashed_password):
+    if not await auth.verify_password_async(form_data.password, user.hashed_password):
+        password_pool.record_login(False)
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Incorrect password")
 
-    access_token = auth.create_access_token(data={"sub": user.email})
+    # hashes made with another BCRYPT_ROUNDS are replaced while the password is at hand
+    rehash = password_pool.needs_update(user.hashed_password)
+    if rehash:
+        user.hashed_password = await auth.get_password_hash_async(form_data.password)
 
-    log_audit(db, user.id, "LOGIN", f"User {user.email} logged in")
-    db.commit()
+    if auth.AUTH_MODE == "claims":
+        tokens = auth.issue_tokens(db, user)
+    else:
+        tokens = {"access_token": auth.create_access_token(data={"sub": user.email})}
+
+    log_audit(db, user.id, "LOGIN")
+    await db.commit()
+    password_pool.record_login(True, rehashed=rehash)
 
     return {
-        "access_token": access_token,
+        **tokens,
         "token_type": "bearer",
         "user_role": user.role
     }
 
 
+# 🔹 REFRESH → NEW ACCESS + REFRESH TOKEN (AUTH_MODE=claims)
+@app.post("/auth/refresh", response_model=schemas.Token)
+def refresh_tokens(refresh_token: str = Form(...), db: Session = Depends(database.get_db)):
+    """Trade a refresh token (usable once) for a new access token and refresh token."""
+    user, tokens = auth.rotate_refresh_token(db, refresh_token)
+    return {
+        **tokens,
+        "token_type": "bearer",
+        "user_role": user.role
+    }
+
+
+# 🔹 LOGOUT → REVOKE REFRESH TOKENS OF THIS LOGIN
+@app.post("/auth/logout")
+def logout(refresh_token: str = Form(...), db: Session = Depends(database.get_db)):
+    auth.revoke_refresh_token(db, refresh_token)
+    db.commit()
+    return {"message": "Logged out"}
+
+
 # 🔹 FORGOT PASSWORD → SEND OTP
 @app.post("/auth/forgot-password")
 def forgot_password(
@@ -314,10 +409,10 @@ def forgot_password(
 @app.post("/auth/resend-forgot-password-otp")
 def resend_forgot_password_otp(email: str = Form(...), background_tasks: BackgroundTasks = BackgroundTasks()):
     """Resend OTP for password reset if user didn't receive it."""
-    if email not in otp_store:
+    data = get_pending(email)
+    if data is None:
         return JSONResponse(status_code=400, content={"error": "No OTP found for this email. Please request a password reset again."})
     
-    data = otp_store[email]
     if data["purpose"] != "forgot":
         return JSONResponse(status_code=400, content={"error": "This email was not registered for password reset."})
     
@@ -359,6 +454,7 @@ def reset_password(
         return JSONResponse(status_code=404, content={"error": "User not found"})
 
     user.hashed_password = auth.get_password_hash(new_password)
+    auth.revoke_user_refresh_tokens(db, user.id)
     db.commit()
 
     log_audit(db, user.id, "RESET_PASSWORD")
@@ -391,60 +487,78 @@ def verify_forgot_otp(
 # --- Profile Management Endpoints ---
 
 @app.get("/profile/me", response_model=schemas.User)
-def get_my_profile(
-    current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(database.get_db) # Add the db session
+async def get_my_profile(
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async),
+    db: AsyncSession = Depends(database.get_async_db) # Add the db session
 ):
-    # 1. Manually load the Baseline (Fixes "N/A" issue)
-    db_baseline = db.query(models.BaselinePEFR).filter(
-        models.BaselinePEFR.owner_id == current_user.id
-    ).first()
-    current_user.baseline = db_baseline
+    # 1. Eagerly load the Baseline (Fixes "N/A" issue) and the collections in the response;
+    #    lazy loads are not available on an AsyncSession
+    result = await db.execute(
+        select(models.User).options(
+            selectinload(models.User.baseline),
+            selectinload(models.User.medications),
+            selectinload(models.User.emergency_contacts),
+            selectinload(models.User.reminders),
+        ).filter(models.User.id == current_user.id)
+    )
+    user = result.scalars().first()
 
     # 2. Manually load the latest PEFR record
-    latest_pefr = db.query(models.PEFRRecord).filter(
-        models.PEFRRecord.owner_id == current_user.id
-    ).order_by(desc(models.PEFRRecord.recorded_at)).first()
-    
+    result = await db.execute(
+        select(models.PEFRRecord).filter(
+            models.PEFRRecord.owner_id == current_user.id
+        ).order_by(desc(models.PEFRRecord.recorded_at)).limit(1)
+    )
+    latest_pefr = result.scalars().first()
+
     # 3. Manually load the latest Symptom record
-    latest_symptom = db.query(models.Symptom).filter(
-        models.Symptom.owner_id == current_user.id
-    ).order_by(desc(models.Symptom.recorded_at)).first()
-    
+    result = await db.execute(
+        select(models.Symptom).filter(
+            models.Symptom.owner_id == current_user.id
+        ).order_by(desc(models.Symptom.recorded_at)).limit(1)
+    )
+    latest_symptom = result.scalars().first()
+
     # 4. Attach them to the user object
-    current_user.latest_pefr_record = latest_pefr
-    current_user.latest_symptom = latest_symptom
-    
-    return current_user
+    user.latest_pefr_record = latest_pefr
+    user.latest_symptom = latest_symptom
+
+    return user
 
 @app.put("/profile/me", response_model=schemas.User)
 def update_my_profile(
     profile_update: schemas.UserCreate, 
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
-    current_user.name = profile_update.name
-    current_user.age = profile_update.age
-    current_user.height = profile_update.height
-    current_user.gender = profile_update.gender
-    current_user.contact_number = profile_update.contact_number
-    current_user.address = profile_update.address
+    user = db.get(models.User, current_user.id)
+    if user.name != profile_update.name:
+        # the dashboard's name order reads the copy on the patient's links
+        db.query(models.DoctorPatient).filter(models.DoctorPatient.patient_id == user.id).update(
+            {"patient_name": profile_update.name}, synchronize_session=False)
+    user.name = profile_update.name
+    user.age = profile_update.age
+    user.height = profile_update.height
+    user.gender = profile_update.gender
+    user.contact_number = profile_update.contact_number
+    user.address = profile_update.address
     
     if profile_update.password:
-        current_user.hashed_password = auth.get_password_hash(profile_update.password)
+        user.hashed_password = auth.get_password_hash(profile_update.password)
         
     db.commit()
-    db.refresh(current_user)
-    log_audit(db, current_user.id, "UPDATE_PROFILE")
+    identity_cache.users.invalidate(current_user.email)
+    db.refresh(user)
+    log_audit(db, user.id, "UPDATE_PROFILE")
     db.commit()
-    return current_user
+    return user
 
 
 @app.post("/profile/device-token")
 def register_device_token(
     token: str = Form(...),
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     """Register or update the current user's FCM device token."""
     # Create or update a Device record so a user can have multiple devices
@@ -466,7 +580,7 @@ def register_device_token(
 @app.get("/profile/devices")
 def list_my_devices(
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     devices = db.query(models.Device).filter(models.Device.owner_id == current_user.id).all()
     return [
@@ -485,7 +599,7 @@ def list_my_devices(
 def unregister_device(
     device_id: int,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     d = db.query(models.Device).filter(models.Device.id == device_id, models.Device.owner_id == current_user.id).first()
     if not d:
@@ -497,7 +611,7 @@ def unregister_device(
 @app.delete("/profile/me")
 def delete_my_account(
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     # Delete all related data first to maintain referential integrity
     
@@ -507,16 +621,30 @@ def delete_my_account(
     # Delete symptom records
     db.query(models.Symptom).filter(models.Symptom.owner_id == current_user.id).delete()
     
-    # Delete baseline
+    # Delete baseline, dashboard summary and daily rollup
     db.query(models.BaselinePEFR).filter(models.BaselinePEFR.owner_id == current_user.id).delete()
+    db.query(models.PatientSummary).filter(models.PatientSummary.patient_id == current_user.id).delete()
+    db.query(models.PEFRDailyRollup).filter(models.PEFRDailyRollup.owner_id == current_user.id).delete()
     
-    # Delete medications (both prescribed and owned)
+    # Delete medication status history (before the medications it points to, so it holds with foreign_keys=ON)
+    med_ids = select(models.Medication.id).filter(
+        (models.Medication.owner_id == current_user.id) |
+        (models.Medication.prescribed_by == current_user.id)
+    )
+    db.query(models.MedicationStatusHistory).filter(
+        (models.MedicationStatusHistory.changed_by_user_id == current_user.id) |
+        (models.MedicationStatusHistory.medication_id.in_(med_ids))
+    ).delete(synchronize_session=False)
+
+    # Delete medications (both prescribed and owned); patients of a deleting doctor get tombstones on /sync
+    prescribed = db.query(models.Medication.id, models.Medication.owner_id).filter(
+        models.Medication.prescribed_by == current_user.id,
+        models.Medication.owner_id != current_user.id
+    ).all()
+    changelog.record_deleted(db, models.Medication, prescribed)
     db.query(models.Medication).filter(models.Medication.owner_id == current_user.id).delete()
     db.query(models.Medication).filter(models.Medication.prescribed_by == current_user.id).delete()
     
-    # Delete medication status history
-    db.query(models.MedicationStatusHistory).filter(models.MedicationStatusHistory.changed_by_user_id == current_user.id).delete()
-    
     # Delete notifications
     db.query(models.Notification).filter(models.Notification.owner_id == current_user.id).delete()
     
@@ -528,22 +656,36 @@ def delete_my_account(
     
     # Delete push logs
     db.query(models.PushLog).filter(models.PushLog.owner_id == current_user.id).delete()
+
+    # Revoke refresh tokens
+    auth.revoke_user_refresh_tokens(db, current_user.id)
     
     # Delete doctor-patient links (both as doctor and patient)
+    linked_patient_ids = db.execute(
+        select(models.DoctorPatient.patient_id).where(models.DoctorPatient.doctor_id == current_user.id)
+    ).scalars().all()
     db.query(models.DoctorPatient).filter(
         (models.DoctorPatient.doctor_id == current_user.id) | 
         (models.DoctorPatient.patient_id == current_user.id)
     ).delete()
     
-    # Delete audit logs
-    db.query(models.AuditLog).filter(models.AuditLog.user_id == current_user.id).delete()
+    # Delete audit events (online partitions here, archive files once this has committed)
+    audit_store.delete_user(db, current_user.id)
     
     # Delete alert logs
     db.query(models.AlertLog).filter(models.AlertLog.user_id == current_user.id).delete()
+
+    # Delete the user's own sync history and pending notification digests
+    db.query(models.ChangeLog).filter(models.ChangeLog.owner_id == current_user.id).delete()
+    db.query(models.NotificationDigest).filter(models.NotificationDigest.owner_id == current_user.id).delete()
     
     # Finally delete the user
-    db.delete(current_user)
+    user_id = current_user.id
+    db.delete(db.get(models.User, user_id))
     db.commit()
+    identity_cache.users.invalidate(current_user.email)
+    identity_cache.doctors.invalidate(user_id, *linked_patient_ids)
+    audit_store.delete_user_archived(user_id)
     
     return {"message": "Account deleted successfully"}
 
@@ -553,7 +695,7 @@ def delete_my_account(
 def set_baseline(
     baseline: schemas.BaselinePEFRCreate, 
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.PATIENT:
         raise HTTPException(status_code=403, detail="Only patients can set a baseline.")
@@ -562,119 +704,99 @@ def set_baseline(
     
     if db_baseline:
         db_baseline.baseline_value = baseline.baseline_value
-        log_audit(db, current_user.id, "UPDATE_BASELINE", f"Value: {baseline.baseline_value}")
+        log_audit(db, current_user.id, "UPDATE_BASELINE", value=baseline.baseline_value)
     else:
         db_baseline = models.BaselinePEFR(**baseline.dict(), owner_id=current_user.id)
         db.add(db_baseline)
-        log_audit(db, current_user.id, "CREATE_BASELINE", f"Value: {baseline.baseline_value}")
+        log_audit(db, current_user.id, "CREATE_BASELINE", value=baseline.baseline_value)
     
     db.commit()
     db.refresh(db_baseline)
     return db_baseline
 
 @app.post("/pefr/record", response_model=schemas.PEFRRecordResponse)
-def record_pefr(
+async def record_pefr(
     pefr: schemas.PEFRRecordCreate,
-    db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
     if current_user.role != models.UserRole.PATIENT:
         raise HTTPException(status_code=403, detail="Only patients can record PEFR.")
 
-    baseline = db.query(models.BaselinePEFR).filter(models.BaselinePEFR.owner_id == current_user.id).first()
-    
-    baseline_value = 0
-    if baseline:
-        baseline_value = baseline.baseline_value
+    patient_id, patient_name = current_user.id, current_user.name
+
+    # Runs on the group-commit writer: reading the baseline there also serializes the
+    # auto-baseline update against concurrent readings from the same patient.
+    def write_record(session: Session):
+        baseline = session.query(models.BaselinePEFR).filter(models.BaselinePEFR.owner_id == patient_id).first()
+
+        baseline_value = 0
+        if baseline:
+            baseline_value = baseline.baseline_value
+
+        zone, guidance, percentage = calculate_zone(baseline_value, pefr.pefr_value)
+
+        # Update baseline PEFR if this PEFR value is higher than current baseline
+        if baseline:
+            if pefr.pefr_value > baseline.baseline_value:
+                baseline.baseline_value = pefr.pefr_value
+                log_audit(session, patient_id, "UPDATE_BASELINE_AUTO", value=pefr.pefr_value)
+        else:
+            # For new users, set baseline to the first PEFR value
+            baseline = models.BaselinePEFR(baseline_value=pefr.pefr_value, owner_id=patient_id)
+            session.add(baseline)
+            log_audit(session, patient_id, "CREATE_BASELINE_AUTO", value=pefr.pefr_value)
+
+        # The trend state lives on the baseline row: O(1) update, no history query
+        trend, anomaly, z_score = trends.update(baseline, pefr.pefr_value)
+
+        db_record = models.PEFRRecord(
+            pefr_value=pefr.pefr_value,
+            zone=zone,
+            owner_id=patient_id,
+            percentage=percentage,
+            trend=trend,
+            anomaly=anomaly,
+            source=pefr.source
+        )
+        session.add(db_record)
+
+        if zone == "Red":
+            log_alert(session, patient_id, "RED_ZONE_TRIGGERED")
+
+        log_audit(session, patient_id, "RECORD_PEFR", value=pefr.pefr_value, zone=zone)
+
+        session.flush()
+        summary.update_after_pefr(session, db_record)
+        rollup.add_reading(session, db_record)
+
+        # Notify all linked doctors in the same transaction; routine readings are coalesced
+        doctor_ids = identity_cache.linked_doctor_ids(session, patient_id)
+        notif_msg = f"Patient {patient_name} recorded PEFR: {pefr.pefr_value} L/min (Zone: {zone}, {percentage:.1f}%)"
+        notif_link = f"/patient/{patient_id}/pefr"
+        for doctor_id in doctor_ids:
+            digests.notify(session, doctor_id, "pefr", "Patient PEFR Update", notif_msg, notif_link,
+                           {"patient_id": patient_id}, subject=(patient_id, patient_name), urgent=zone == "Red")
+
+        session.flush()
+        return db_record, zone, guidance, percentage, trend, anomaly, z_score
+
+    db_record, zone, guidance, percentage, trend, anomaly, z_score = await group_commit.writer.run(write_record)
 
-    zone, guidance, percentage = calculate_zone(baseline_value, pefr.pefr_value)
-    trend = get_pefr_trend(db, current_user.id, pefr.pefr_value)
-    
-    db_record = models.PEFRRecord(
-        pefr_value=pefr.pefr_value,
-        zone=zone,
-        owner_id=current_user.id,
-        percentage=percentage,
-        trend=trend,
-        source=pefr.source
-    )
-    db.add(db_record)
-    
-    # Update baseline PEFR if this PEFR value is higher than current baseline
-    if baseline:
-        if pefr.pefr_value > baseline.baseline_value:
-            baseline.baseline_value = pefr.pefr_value
-            log_audit(db, current_user.id, "UPDATE_BASELINE_AUTO", f"Updated to highest PEFR: {pefr.pefr_value}")
-    else:
-        # For new users, set baseline to the first PEFR value
-        new_baseline = models.BaselinePEFR(baseline_value=pefr.pefr_value, owner_id=current_user.id)
-        db.add(new_baseline)
-        log_audit(db, current_user.id, "CREATE_BASELINE_AUTO", f"Set initial baseline to PEFR: {pefr.pefr_value}")
-    
-    if zone == "Red":
-        log_alert(db, current_user.id, "RED_ZONE_TRIGGERED")
-    
-    log_audit(db, current_user.id, "RECORD_PEFR", f"Value: {pefr.pefr_value}, Zone: {zone}")
-    
-    db.commit()
-    db.refresh(db_record)
-    
-    # Send notification to linked doctors
-    try:
-        # Find all doctors linked to this patient
-        doctor_links = db.query(models.DoctorPatient).filter(models.DoctorPatient.patient_id == current_user.id).all()
-        doctor_ids = [link.doctor_id for link in doctor_links]
-        
-        if doctor_ids:
-            notif_msg = f"Patient {current_user.name} recorded PEFR: {pefr.pefr_value} L/min (Zone: {zone}, {percentage:.1f}%)"
-            notif_link = f"/patient/{current_user.id}/pefr"
-            
-            # Create notifications for all linked doctors
-            for doctor_id in doctor_ids:
-                notification = models.Notification(owner_id=doctor_id, message=notif_msg, link=notif_link)
-                db.add(notification)
-            db.commit()
-            
-            # Send push notifications to all linked doctors
-            for doctor_id in doctor_ids:
-                try:
-                    # Get all active device tokens for this doctor
-                    devices = db.query(models.Device).filter(models.Device.owner_id == doctor_id, models.Device.active == True).all()
-                    tokens = [d.token for d in devices]
-                    if tokens:
-                        res = firebase_messaging.send_messages_to_tokens(tokens, title="Patient PEFR Update", body=notif_msg, data={"link": notif_link, "patient_id": str(current_user.id)})
-                        # Record push logs
-                        for r in (res.get('responses') or []):
-                            log = models.PushLog(owner_id=doctor_id, token=r.get('token'), success=bool(r.get('success')), response=str(r.get('response')) if r.get('response') else None, error=str(r.get('error')) if r.get('error') else None)
-                            db.add(log)
-                        db.commit()
-                        # Deactivate tokens that failed with invalid registration
-                        for r in (res.get('responses') or []):
-                            if not r.get('success'):
-                                tkn = r.get('token')
-                                db.query(models.Device).filter(models.Device.token == tkn).update({"active": False})
-                        db.commit()
-                except Exception as e:
-                    print(f"Failed to send FCM to doctor {doctor_id}: {e}")
-                    db.rollback()
-    except Exception as e:
-        # Non-fatal: if notification fails, proceed to return PEFR record
-        print(f"Failed to create/send PEFR notifications: {e}")
-        db.rollback()
-    
     return schemas.PEFRRecordResponse(
         zone=zone,
         guidance=guidance,
         record=db_record,
         percentage=percentage,
-        trend=trend
+        trend=trend,
+        anomaly=anomaly,
+        z_score=z_score
     )
 
 @app.post("/symptom/record", response_model=schemas.Symptom)
 def record_symptom(
     symptom: schemas.SymptomCreate,
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.PATIENT:
         raise HTTPException(status_code=403, detail="Only patients can record symptoms.")
@@ -685,11 +807,160 @@ def record_symptom(
     )
     db.add(db_symptom)
     log_audit(db, current_user.id, "RECORD_SYMPTOM")
+    db.flush()
+    summary.update_after_symptom(db, db_symptom)
     db.commit()
     db.refresh(db_symptom)
     return db_symptom
 
 
+# --- BULK UPLOAD (offline readings synced from the device) ---
+
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", "500"))
+BULK_MAX_CLOCK_SKEW_SECONDS = int(os.getenv("BULK_MAX_CLOCK_SKEW_SECONDS", "300"))
+
+
+def check_bulk_size(items: list):
+    if len(items) > BULK_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {BULK_MAX_ITEMS} items per upload")
+
+
+@app.post("/pefr/records/bulk", response_model=schemas.PEFRBulkResponse)
+async def record_pefr_bulk(
+    batch: schemas.PEFRBulkCreate,
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
+):
+    """Store a batch of readings taken on the device, with their own timestamps.
+    Readings already stored (same time and value) are skipped, so a retried upload is safe."""
+    if current_user.role != models.UserRole.PATIENT:
+        raise HTTPException(status_code=403, detail="Only patients can record PEFR.")
+    check_bulk_size(batch.readings)
+
+    patient_id, patient_name = current_user.id, current_user.name
+    now = datetime.datetime.utcnow()
+    # time order, so zones, the auto-baseline and the trend evolve as if recorded one by one
+    readings = sorted(
+        ((client_timestamp(r.recorded_at, now), r.pefr_value, r.source) for r in batch.readings),
+        key=lambda r: r[0],
+    )
+
+    def write_batch(session: Session):
+        baseline = session.query(models.BaselinePEFR).filter(models.BaselinePEFR.owner_id == patient_id).first()
+        if not readings:
+            return [], 0, baseline.baseline_value if baseline else None
+
+        stored = set(session.query(models.PEFRRecord.recorded_at, models.PEFRRecord.pefr_value).filter(
+            models.PEFRRecord.owner_id == patient_id,
+            models.PEFRRecord.recorded_at.between(readings[0][0], readings[-1][0]),
+        ).all())
+        fresh = []
+        for at, value, source in readings:
+            if (at, value) not in stored:
+                stored.add((at, value))
+                fresh.append((at, value, source))
+        duplicates = len(readings) - len(fresh)
+        if not fresh:
+            return [], duplicates, baseline.baseline_value if baseline else None
+
+        values = np.array([value for _, value, _ in fresh])
+        zones, percentages = calculate_zones(baseline.baseline_value if baseline else 0, values)
+
+        peak = int(values.max())
+        if baseline:
+            if peak > baseline.baseline_value:
+                baseline.baseline_value = peak
+                log_audit(session, patient_id, "UPDATE_BASELINE_AUTO", value=peak)
+        else:
+            baseline = models.BaselinePEFR(baseline_value=peak, owner_id=patient_id)
+            session.add(baseline)
+            log_audit(session, patient_id, "CREATE_BASELINE_AUTO", value=peak)
+
+        rows = []
+        for (at, value, source), zone, percentage in zip(fresh, zones.tolist(), percentages.tolist()):
+            trend, anomaly, _ = trends.update(baseline, value, at)
+            rows.append({"pefr_value": value, "zone": zone, "owner_id": patient_id, "percentage": percentage,
+                         "trend": trend, "anomaly": anomaly, "source": source, "recorded_at": at})
+
+        # one multi-row INSERT; Core inserts bypass the change-log flush hook
+        ids = session.execute(
+            insert(models.PEFRRecord).returning(models.PEFRRecord.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        for row, row_id in zip(rows, ids):
+            row["id"] = row_id
+        changelog.record_updated(session, models.PEFRRecord, [(row_id, patient_id) for row_id in ids])
+        rollup.add_values(session, [(patient_id, r["recorded_at"], r["pefr_value"], r["zone"]) for r in rows])
+        summary.update_after_pefr(session, models.PEFRRecord(**rows[-1]))
+
+        red = int((zones == "Red").sum())
+        if red:
+            log_alert(session, patient_id, "RED_ZONE_TRIGGERED")
+        log_audit(session, patient_id, "RECORD_PEFR_BULK", count=len(rows), red=red)
+
+        # one summary per doctor for the whole batch instead of one per reading
+        latest = rows[-1]
+        notif_msg = (
+            f"Patient {patient_name} uploaded {len(rows)} PEFR readings. Latest: {latest['pefr_value']} L/min "
+            f"(Zone: {latest['zone']}, {latest['percentage']:.1f}%), lowest: {int(values.min())} L/min"
+        )
+        if red:
+            notif_msg += f", {red} in Red zone"
+        doctor_ids = identity_cache.linked_doctor_ids(session, patient_id)
+        notif_link = f"/patient/{patient_id}/pefr"
+        for doctor_id in doctor_ids:
+            digests.notify(session, doctor_id, "pefr", "Patient PEFR Update", notif_msg, notif_link,
+                           {"patient_id": patient_id}, subject=(patient_id, patient_name), urgent=red > 0)
+
+        session.flush()
+        return rows, duplicates, baseline.baseline_value
+
+    rows, duplicates, baseline_value = await group_commit.writer.run(write_batch)
+
+    return schemas.PEFRBulkResponse(accepted=len(rows), duplicates=duplicates, baseline=baseline_value, records=rows)
+
+
+@app.post("/symptom/records/bulk", response_model=schemas.SymptomBulkResponse)
+def record_symptoms_bulk(
+    batch: schemas.SymptomBulkCreate,
+    db: Session = Depends(database.get_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
+):
+    """Store a batch of symptom entries taken on the device; entries at an already stored time are skipped."""
+    if current_user.role != models.UserRole.PATIENT:
+        raise HTTPException(status_code=403, detail="Only patients can record symptoms.")
+    check_bulk_size(batch.symptoms)
+    if not batch.symptoms:
+        return schemas.SymptomBulkResponse(accepted=0)
+
+    now = datetime.datetime.utcnow()
+    entries = sorted(
+        ({**s.dict(exclude={"recorded_at"}), "recorded_at": client_timestamp(s.recorded_at, now),
+          "owner_id": current_user.id} for s in batch.symptoms),
+        key=lambda e: e["recorded_at"],
+    )
+    stored = {at for (at,) in db.query(models.Symptom.recorded_at).filter(
+        models.Symptom.owner_id == current_user.id,
+        models.Symptom.recorded_at.between(entries[0]["recorded_at"], entries[-1]["recorded_at"]),
+    ).all()}
+    rows = []
+    for entry in entries:
+        if entry["recorded_at"] not in stored:
+            stored.add(entry["recorded_at"])
+            rows.append(entry)
+
+    if rows:
+        ids = db.execute(
+            insert(models.Symptom).returning(models.Symptom.id, sort_by_parameter_order=True), rows
+        ).scalars().all()
+        for row, row_id in zip(rows, ids):
+            row["id"] = row_id
+        changelog.record_updated(db, models.Symptom, [(row_id, current_user.id) for row_id in ids])
+        summary.update_after_symptom(db, models.Symptom(**rows[-1]))
+        log_audit(db, current_user.id, "RECORD_SYMPTOM_BULK", count=len(rows))
+        db.commit()
+
+    return schemas.SymptomBulkResponse(accepted=len(rows), duplicates=len(entries) - len(rows), records=rows)
+
+
 # -----------------------------
 # ML Prediction Endpoint
 # -----------------------------
@@ -697,7 +968,7 @@ def record_symptom(
 def ml_predict(
     payload: schemas.MLInput,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     # Only patients should use patient-specific recommendations
     if current_user.role != models.UserRole.PATIENT:
@@ -711,8 +982,9 @@ def ml_predict(
     features = payload.dict()
     result = predictor.predict(features)
 
-    # Log the usage for audit
-    log_audit(db, current_user.id, "ML_PREDICT", f"Input: {features}, Output: {result}")
+    # Log the usage for audit: the recommendation, not the whole input and output
+    log_audit(db, current_user.id, "ML_PREDICT", medicine=result.get("recommended_medicine"),
+              days=result.get("recommended_days"), probability=result.get("predicted_cure_probability"))
     db.commit()
 
     return schemas.MLPrediction(**result)
@@ -722,30 +994,65 @@ def ml_predict(
 
 @app.get("/pefr/records", response_model=List[schemas.PEFRRecord])
 def get_my_pefr_records(
+    response: Response,
+    page: pagination.HistoryPage = Depends(),
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.PATIENT:
         raise HTTPException(status_code=403, detail="Only patients can view this data.")
     
-    records = db.query(models.PEFRRecord).filter(
-        models.PEFRRecord.owner_id == current_user.id
-    ).order_by(models.PEFRRecord.recorded_at.asc()).all()
-    return records
+    query = db.query(models.PEFRRecord).filter(models.PEFRRecord.owner_id == current_user.id)
+    query = page.apply(query, models.PEFRRecord.recorded_at, models.PEFRRecord.id)
+    return page.page(query.all(), response)
+
+
+class AggregateParams:
+    """Query parameters of the PEFR aggregation endpoints (use as a dependency)."""
+
+    def __init__(
+        self,
+        bucket: str = Query("day", pattern="^(hour|day|week)$"),
+        since: Optional[datetime.datetime] = Query(None, alias="from"),
+        until: Optional[datetime.datetime] = Query(None, alias="to"),
+        tz_offset_minutes: int = Query(0, ge=-14 * 60, le=14 * 60, description="Client UTC offset, e.g. 330 for IST"),
+        max_points: int = Query(analytics.PEFR_AGGREGATE_MAX_POINTS, ge=3, le=2000),
+    ):
+        self.bucket = bucket
+        self.since = since
+        self.until = until
+        self.tz_offset_minutes = tz_offset_minutes
+        self.max_points = max_points
+
+    def run(self, db: Session, owner_id: int):
+        return analytics.aggregate(db, owner_id, self.bucket, self.since, self.until,
+                                   self.tz_offset_minutes, self.max_points)
+
+
+@app.get("/pefr/aggregate", response_model=schemas.PEFRAggregate)
+def get_my_pefr_aggregate(
+    params: AggregateParams = Depends(),
+    db: Session = Depends(database.get_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
+):
+    if current_user.role != models.UserRole.PATIENT:
+        raise HTTPException(status_code=403, detail="Only patients can view this data.")
+    return params.run(db, current_user.id)
 
 
 @app.get("/symptom/records", response_model=List[schemas.Symptom])
 def get_my_symptom_records(
+    response: Response,
+    page: pagination.HistoryPage = Depends(),
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.PATIENT:
         raise HTTPException(status_code=403, detail="Only patients can view this data.")
     
-    records = db.query(models.Symptom).filter(
-        models.Symptom.owner_id == current_user.id
-    ).order_by(models.Symptom.recorded_at.asc()).all()
-    return records
+    query = db.query(models.Symptom).filter(models.Symptom.owner_id == current_user.id)
+    query = page.apply(query, models.Symptom.recorded_at, models.Symptom.id)
+    return page.page(query.all(), response)
 
 
 # --- DOCTOR LINKING ---
@@ -754,7 +1061,7 @@ def get_my_symptom_records(
 def link_patient_to_doctor(
     link_request: schemas.DoctorPatientLinkCreate,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.PATIENT:
         raise HTTPException(status_code=403, detail="Only patients can link to a doctor.")
@@ -782,13 +1089,15 @@ def link_patient_to_doctor(
 
     db_link = models.DoctorPatient(
         doctor_id=user_with_email.id,
-        patient_id=current_user.id
+        patient_id=current_user.id,
+        **summary.link_sort_keys(current_user.id)
     )
     db.add(db_link)
     db.commit()
+    identity_cache.doctors.invalidate(current_user.id)
     db.refresh(db_link)
 
-    log_audit(db, current_user.id, "LINK_DOCTOR", f"Patient linked to doctor ID {user_with_email.id}")
+    log_audit(db, current_user.id, "LINK_DOCTOR", doctor_id=user_with_email.id)
     db.commit()
 
     return db_link
@@ -797,10 +1106,10 @@ def link_patient_to_doctor(
 # --- MEDICATION ENDPOINTS ---
 
 @app.post("/medications", response_model=schemas.Medication)
-def create_medication(
+async def create_medication(
     medication: schemas.MedicationCreate,
-    db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
     # allow API to set `source` if provided (e.g., 'ai' when saved from ML recommendation)
     payload = medication.dict()
@@ -813,88 +1122,79 @@ def create_medication(
             pass
 
     db.add(db_medication)
-    db.commit()
-    db.refresh(db_medication)
+    await db.commit()
+    await db.refresh(db_medication)
     return db_medication
 
 @app.get("/medications", response_model=List[schemas.Medication])
-def get_my_medications(
-    db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+async def get_my_medications(
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
-    return db.query(models.Medication).filter(models.Medication.owner_id == current_user.id).all()
+    result = await db.execute(select(models.Medication).filter(models.Medication.owner_id == current_user.id))
+    return result.scalars().all()
+
+def get_notify_doctor_id(db: Session, med: models.Medication):
+    """Prescribing doctor of a medication, or else the patient's linked doctor."""
+    if med.prescribed_by:
+        return med.prescribed_by
+    doctor_ids = identity_cache.linked_doctor_ids(db, med.owner_id)
+    return doctor_ids[0] if doctor_ids else None
 
 # --- UPDATE MEDICATION STATUS (PATIENT) ---
 
 @app.patch("/medications/{med_id}/status")
-def update_medication_status(
+async def update_medication_status(
     med_id: int,
     update: schemas.MedicationStatusUpdate,
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
-    med = db.query(models.Medication).filter(
-        models.Medication.id == med_id,
-        models.Medication.owner_id == current_user.id
-    ).first()
+    user_id, user_name = current_user.id, current_user.name
+
+    def write_status(session: Session):
+        med = session.query(models.Medication).filter(
+            models.Medication.id == med_id,
+            models.Medication.owner_id == user_id
+        ).first()
+
+        if not med:
+            raise HTTPException(status_code=404, detail="Medication not found")
+
+        # 1) update current status on medication
+        med.taken_status = update.status
+
+        # 2) create history record
+        history = models.MedicationStatusHistory(
+            medication_id = med.id,
+            status = update.status,
+            notes = update.notes,
+            changed_by_user_id = user_id
+        )
+        session.add(history)
 
-    if not med:
-        raise HTTPException(status_code=404, detail="Medication not found")
+        log_audit(session, user_id, "UPDATE_MEDICATION_STATUS", medication_id=med.id, status=update.status)
 
-    # 1) update current status on medication
-    med.taken_status = update.status
+        # 3) notify prescribing doctor (or linked doctor) in the same transaction
+        doctor_id = get_notify_doctor_id(session, med)
+        if doctor_id and doctor_id != user_id:
+            msg = f"Patient {user_name} updated status for {med.name} to {update.status}."
+            digests.notify(session, doctor_id, "medication", "Medication Status Updated", msg,
+                           f"/medications/{med.id}", subject=(user_id, user_name))
 
-    # 2) create history record
-    history = models.MedicationStatusHistory(
-        medication_id = med.id,
-        status = update.status,
-        notes = update.notes,
-        changed_by_user_id = current_user.id
-    )
-    db.add(history)
+    await group_commit.writer.run(write_status)
 
-    log_audit(db, current_user.id, "UPDATE_MEDICATION_STATUS", f"Medication {med.id} -> {update.status}")
-    db.commit()
-    # Notify prescribing doctor (or linked doctor) about the status update
-    try:
-        doctor_id = med.prescribed_by
-        if not doctor_id:
-            link = db.query(models.DoctorPatient).filter(models.DoctorPatient.patient_id == med.owner_id).first()
-            doctor_id = link.doctor_id if link else None
-
-        if doctor_id and doctor_id != current_user.id:
-            msg = f"Patient {current_user.name} updated status for {med.name} to {update.status}."
-            notif = models.Notification(owner_id=doctor_id, message=msg, link=f"/medications/{med.id}")
-            db.add(notif)
-            db.commit()
-            try:
-                devices = db.query(models.Device).filter(models.Device.owner_id == doctor_id, models.Device.active == True).all()
-                tokens = [d.token for d in devices]
-                if tokens:
-                    res = firebase_messaging.send_messages_to_tokens(tokens, title="Medication Status Updated", body=msg, data={"link": f"/medications/{med.id}"})
-                    for r in (res.get('responses') or []):
-                        log = models.PushLog(owner_id=doctor_id, token=r.get('token'), success=bool(r.get('success')), response=str(r.get('response')) if r.get('response') else None, error=str(r.get('error')) if r.get('error') else None)
-                        db.add(log)
-                    db.commit()
-                    for r in (res.get('responses') or []):
-                        if not r.get('success'):
-                            db.query(models.Device).filter(models.Device.token == r.get('token')).update({"active": False})
-                    db.commit()
-            except Exception:
-                db.rollback()
-    except Exception:
-        db.rollback()
     return {"message": "Status updated"}
 
 
 @app.patch("/medications/{med_id}", response_model=schemas.Medication)
-def update_medication_metadata(
+async def update_medication_metadata(
     med_id: int,
     update: schemas.MedicationUpdate,
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
-    med = db.query(models.Medication).filter(models.Medication.id == med_id).first()
+    result = await db.execute(select(models.Medication).filter(models.Medication.id == med_id))
+    med = result.scalars().first()
     if not med:
         raise HTTPException(status_code=404, detail="Medication not found")
 
@@ -908,76 +1208,55 @@ def update_medication_metadata(
         if hasattr(update, f) and getattr(update, f) is not None:
             setattr(med, f, getattr(update, f))
 
-    db.commit()
-    db.refresh(med)
-    log_audit(db, current_user.id, "UPDATE_MEDICATION_METADATA", f"Medication {med.id} metadata updated")
+    log_audit(db, current_user.id, "UPDATE_MEDICATION_METADATA", medication_id=med.id)
+    await db.commit()
+    await db.refresh(med)
     return med
 
 
 @app.post("/medications/{med_id}/take", response_model=schemas.Medication)
-def take_medication(
+async def take_medication(
     med_id: int,
     take: schemas.MedicationTake,
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
     # Only patients may mark doses as taken
     if current_user.role != models.UserRole.PATIENT:
         raise HTTPException(status_code=403, detail="Only patients can mark medication as taken")
 
-    med = db.query(models.Medication).filter(models.Medication.id == med_id, models.Medication.owner_id == current_user.id).first()
-    if not med:
-        raise HTTPException(status_code=404, detail="Medication not found")
+    user_id, user_name = current_user.id, current_user.name
 
-    doses = max(1, int(getattr(take, 'doses', 1) or 1))
-    if med.doses_remaining is not None:
-        med.doses_remaining = max(0, med.doses_remaining - doses)
+    def write_take(session: Session):
+        med = session.query(models.Medication).filter(models.Medication.id == med_id, models.Medication.owner_id == user_id).first()
+        if not med:
+            raise HTTPException(status_code=404, detail="Medication not found")
 
-    med.taken_status = 'taken'
+        doses = max(1, int(getattr(take, 'doses', 1) or 1))
+        if med.doses_remaining is not None:
+            med.doses_remaining = max(0, med.doses_remaining - doses)
 
-    history = models.MedicationStatusHistory(
-        medication_id = med.id,
-        status = 'taken',
-        notes = take.notes,
-        changed_by_user_id = current_user.id
-    )
-    db.add(history)
+        med.taken_status = 'taken'
 
-    log_audit(db, current_user.id, "MEDICATION_TAKEN", f"Medication {med.id} taken, doses={doses}")
-    db.commit()
-    db.refresh(med)
+        history = models.MedicationStatusHistory(
+            medication_id = med.id,
+            status = 'taken',
+            notes = take.notes,
+            changed_by_user_id = user_id
+        )
+        session.add(history)
 
-    # Notify prescribing doctor (or linked doctor) that patient took medication
-    try:
-        doctor_id = med.prescribed_by
-        if not doctor_id:
-            link = db.query(models.DoctorPatient).filter(models.DoctorPatient.patient_id == med.owner_id).first()
-            doctor_id = link.doctor_id if link else None
-
-        if doctor_id and doctor_id != current_user.id:
-            msg = f"Patient {current_user.name} marked {med.name} as taken."
-            notif = models.Notification(owner_id=doctor_id, message=msg, link=f"/medications/{med.id}")
-            db.add(notif)
-            db.commit()
-            try:
-                devices = db.query(models.Device).filter(models.Device.owner_id == doctor_id, models.Device.active == True).all()
-                tokens = [d.token for d in devices]
-                if tokens:
-                    res = firebase_messaging.send_messages_to_tokens(tokens, title="Medication Taken", body=msg, data={"link": f"/medications/{med.id}"})
-                    for r in (res.get('responses') or []):
-                        log = models.PushLog(owner_id=doctor_id, token=r.get('token'), success=bool(r.get('success')), response=str(r.get('response')) if r.get('response') else None, error=str(r.get('error')) if r.get('error') else None)
-                        db.add(log)
-                    db.commit()
-                    for r in (res.get('responses') or []):
-                        if not r.get('success'):
-                            db.query(models.Device).filter(models.Device.token == r.get('token')).update({"active": False})
-                    db.commit()
-            except Exception:
-                db.rollback()
-    except Exception:
-        db.rollback()
+        log_audit(session, user_id, "MEDICATION_TAKEN", medication_id=med.id, doses=doses)
 
-    return med
+        # Notify prescribing doctor (or linked doctor) that patient took medication
+        doctor_id = get_notify_doctor_id(session, med)
+        if doctor_id and doctor_id != user_id:
+            msg = f"Patient {user_name} marked {med.name} as taken."
+            digests.notify(session, doctor_id, "medication", "Medication Taken", msg,
+                           f"/medications/{med.id}", subject=(user_id, user_name))
+        session.flush()
+        return med
+
+    return await group_commit.writer.run(write_take)
 
 # --- GET MEDICATION HISTORY (DOCTOR) ---
 
@@ -985,7 +1264,7 @@ def take_medication(
 def get_patient_medication_history(
     patient_id: int,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.DOCTOR:
         raise HTTPException(status_code=403, detail="Only doctors can access this endpoint")
@@ -1021,7 +1300,7 @@ def get_patient_medication_history(
 def delete_linked_patient(
     patient_id: int,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.DOCTOR:
         raise HTTPException(status_code=403, detail="Only doctors can remove linked patients")
@@ -1035,8 +1314,9 @@ def delete_linked_patient(
         raise HTTPException(status_code=404, detail="Link not found")
 
     db.delete(link)
-    log_audit(db, current_user.id, "DELETE_PATIENT_LINK", f"Unlinked patient {patient_id}")
+    log_audit(db, current_user.id, "DELETE_PATIENT_LINK", patient_id=patient_id)
     db.commit()
+    identity_cache.doctors.invalidate(patient_id)
     return {"message": "Unlinked"}
 
 
@@ -1044,7 +1324,7 @@ def delete_linked_patient(
 @app.get("/patient/doctor", response_model=schemas.User)
 def get_linked_doctor(
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     # find doctor link where current_user is patient
     link = db.query(models.DoctorPatient).filter(models.DoctorPatient.patient_id == current_user.id).first()
@@ -1062,7 +1342,7 @@ def get_linked_doctor(
 @app.delete("/patient/doctor")
 def unlink_doctor(
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     # find the link where current_user is the patient
     link = db.query(models.DoctorPatient).filter(models.DoctorPatient.patient_id == current_user.id).first()
@@ -1070,27 +1350,34 @@ def unlink_doctor(
         raise HTTPException(status_code=404, detail="No linked doctor")
 
     db.delete(link)
-    log_audit(db, current_user.id, "UNLINK_DOCTOR", f"Patient {current_user.id} unlinked doctor {link.doctor_id}")
+    log_audit(db, current_user.id, "UNLINK_DOCTOR", doctor_id=link.doctor_id)
     db.commit()
+    identity_cache.doctors.invalidate(current_user.id)
     return {"message": "Unlinked"}
 
 
 # --- DELETE MEDICATION (PATIENT or DOCTOR) ---
+async def delete_status_history(db: AsyncSession, med_id: int):
+    """History rows reference the medication, so they go first (required with foreign_keys=ON)."""
+    await db.execute(delete(models.MedicationStatusHistory).where(models.MedicationStatusHistory.medication_id == med_id))
+
 @app.delete("/medications/{med_id}")
-def delete_medication(
+async def delete_medication(
     med_id: int,
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
-    med = db.query(models.Medication).filter(models.Medication.id == med_id).first()
+    result = await db.execute(select(models.Medication).filter(models.Medication.id == med_id))
+    med = result.scalars().first()
     if not med:
         raise HTTPException(status_code=404, detail="Medication not found")
 
     # Doctors may remove medications they prescribed
     if current_user.role == models.UserRole.DOCTOR:
-        db.delete(med)
-        log_audit(db, current_user.id, "DELETE_MEDICATION", f"Doctor deleted medication {med_id}")
-        db.commit()
+        await delete_status_history(db, med.id)
+        await db.delete(med)
+        log_audit(db, current_user.id, "DELETE_MEDICATION", medication_id=med_id, by="doctor")
+        await db.commit()
         return {"message": "Deleted"}
 
     # Patients can delete their own medication only after updating status
@@ -1100,9 +1387,10 @@ def delete_medication(
     if not med.taken_status or med.taken_status.lower() == "not updated":
         raise HTTPException(status_code=400, detail="Please update medication status before deleting")
 
-    db.delete(med)
-    log_audit(db, current_user.id, "DELETE_MEDICATION", f"Patient deleted medication {med_id}")
-    db.commit()
+    await delete_status_history(db, med.id)
+    await db.delete(med)
+    log_audit(db, current_user.id, "DELETE_MEDICATION", medication_id=med_id, by="patient")
+    await db.commit()
     return {"message": "Deleted"}
 
 # --- EMERGENCY CONTACT ENDPOINTS ---
@@ -1111,7 +1399,7 @@ def delete_medication(
 def create_emergency_contact(
     contact: schemas.EmergencyContactCreate,
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     db_contact = models.EmergencyContact(**contact.dict(), owner_id=current_user.id)
     db.add(db_contact)
@@ -1122,7 +1410,7 @@ def create_emergency_contact(
 @app.get("/contacts", response_model=List[schemas.EmergencyContact])
 def get_my_emergency_contacts(
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     return db.query(models.EmergencyContact).filter(models.EmergencyContact.owner_id == current_user.id).all()
 
@@ -1132,7 +1420,7 @@ def get_my_emergency_contacts(
 def create_reminder(
     reminder: schemas.ReminderCreate,
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     db_reminder = models.Reminder(**reminder.dict(), owner_id=current_user.id)
     db.add(db_reminder)
@@ -1143,47 +1431,78 @@ def create_reminder(
 @app.get("/reminders", response_model=List[schemas.Reminder])
 def get_my_reminders(
     db: Session = Depends(database.get_db), 
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     return db.query(models.Reminder).filter(models.Reminder.owner_id == current_user.id).all()
 
 # --- DOCTOR DASHBOARD ---
 
+DASHBOARD_MAX_PAGE_SIZE = 500
+
+
 @app.get("/doctor/patients", response_model=List[schemas.User])
-def get_doctor_patients(
+async def get_doctor_patients(
+    response: Response,
     search: Optional[str] = Query(None, description="Search by patient name or email"),
     zone: Optional[str] = Query(None, description="Filter by current risk zone (Red, Yellow, Green)"),
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    sort: str = Query("risk", pattern="^(risk|stale|name)$", description="risk (Red first), stale (oldest reading first) or name"),
+    limit: int = Query(100, ge=1, le=DASHBOARD_MAX_PAGE_SIZE),
+    after: Optional[str] = Query(None, description="Cursor from the X-Next-Cursor header of the previous page"),
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
     if current_user.role != models.UserRole.DOCTOR:
         raise HTTPException(status_code=403, detail="Only doctors can access this endpoint.")
-    
-    patient_links = select(models.DoctorPatient.patient_id).filter(
-        models.DoctorPatient.doctor_id == current_user.id
+
+    # walks the per-doctor index of the sort order on doctor_patient_map
+    keys = summary.dashboard_sort_keys(sort)
+    query = summary.dashboard_query(current_user.id).options(
+        selectinload(models.User.baseline),
+        selectinload(models.User.medications),
+        selectinload(models.User.emergency_contacts),
+        selectinload(models.User.reminders),
     )
-    query = db.query(models.User).filter(models.User.id.in_(patient_links))
-    
+
     if search:
         query = query.filter(
             (models.User.name.ilike(f"%{search}%")) |
             (models.User.email.ilike(f"%{search}%"))
         )
-    
-    if zone:
-        query = query.join(models.PEFRRecord).filter(models.PEFRRecord.zone == zone)
-
-    patients = query.all()
 
-    # Manually attach latest records for every patient
-    for patient in patients:
-        patient.latest_pefr_record = db.query(models.PEFRRecord).filter(
-            models.PEFRRecord.owner_id == patient.id
-        ).order_by(desc(models.PEFRRecord.recorded_at)).first()
-        
-        patient.latest_symptom = db.query(models.Symptom).filter(
-            models.Symptom.owner_id == patient.id
-        ).order_by(desc(models.Symptom.recorded_at)).first()
+    if zone:
+        # the patient's zone now, not any zone they were ever in
+        query = query.filter(models.PatientSummary.current_zone == zone)
+
+    if after:
+        query = query.filter(pagination.after(keys, pagination.decode_cursor(after, len(keys))))
+
+    result = await db.execute(query.order_by(*keys).limit(limit + 1))
+    rows = result.all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    # Attach latest records for the whole page with one query per table
+    pefr_ids = [s.latest_pefr_id for _, s, _ in rows if s is not None and s.latest_pefr_id]
+    symptom_ids = [s.latest_symptom_id for _, s, _ in rows if s is not None and s.latest_symptom_id]
+    latest_pefr = {}
+    latest_symptom = {}
+    if pefr_ids:
+        result = await db.execute(select(models.PEFRRecord).filter(models.PEFRRecord.id.in_(pefr_ids)))
+        latest_pefr = {r.owner_id: r for r in result.scalars().all()}
+    if symptom_ids:
+        result = await db.execute(select(models.Symptom).filter(models.Symptom.id.in_(symptom_ids)))
+        latest_symptom = {r.owner_id: r for r in result.scalars().all()}
+
+    patients = []
+    for patient, patient_summary, _ in rows:
+        patient.latest_pefr_record = latest_pefr.get(patient.id)
+        patient.latest_symptom = latest_symptom.get(patient.id)
+        patient.summary = patient_summary
+        patients.append(patient)
+
+    if has_more and rows:
+        last_link = rows[-1][2]
+        response.headers["X-Next-Cursor"] = pagination.encode_cursor([getattr(last_link, key.key) for key in keys])
 
     return patients
 
@@ -1195,8 +1514,10 @@ def get_patient_by_id(db: Session, patient_id: int):
 @app.get("/patient/{patient_id}/pefr", response_model=List[schemas.PEFRRecord])
 def get_patient_pefr_records(
     patient_id: int,
+    response: Response,
+    page: pagination.HistoryPage = Depends(),
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.DOCTOR:
         raise HTTPException(status_code=403, detail="Only doctors can access this data.")
@@ -1205,14 +1526,35 @@ def get_patient_pefr_records(
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found.")
         
-    return db.query(models.PEFRRecord).filter(models.PEFRRecord.owner_id == patient_id).all()
+    query = db.query(models.PEFRRecord).filter(models.PEFRRecord.owner_id == patient_id)
+    query = page.apply(query, models.PEFRRecord.recorded_at, models.PEFRRecord.id)
+    return page.page(query.all(), response)
+
+
+@app.get("/patient/{patient_id}/pefr/aggregate", response_model=schemas.PEFRAggregate)
+def get_patient_pefr_aggregate(
+    patient_id: int,
+    params: AggregateParams = Depends(),
+    db: Session = Depends(database.get_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
+):
+    if current_user.role != models.UserRole.DOCTOR:
+        raise HTTPException(status_code=403, detail="Only doctors can access this data.")
+
+    patient = get_patient_by_id(db, patient_id)
+    if not patient:
+        raise HTTPException(status_code=404, detail="Patient not found.")
+
+    return params.run(db, patient_id)
 
 
 @app.get("/patient/{patient_id}/symptoms", response_model=List[schemas.Symptom])
 def get_patient_symptom_records(
     patient_id: int,
+    response: Response,
+    page: pagination.HistoryPage = Depends(),
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.DOCTOR:
         raise HTTPException(status_code=403, detail="Only doctors can access this data.")
@@ -1221,14 +1563,16 @@ def get_patient_symptom_records(
     if not patient:
         raise HTTPException(status_code=404, detail="Patient not found.")
         
-    return db.query(models.Symptom).filter(models.Symptom.owner_id == patient_id).all()
+    query = db.query(models.Symptom).filter(models.Symptom.owner_id == patient_id)
+    query = page.apply(query, models.Symptom.recorded_at, models.Symptom.id)
+    return page.page(query.all(), response)
 
 @app.post("/doctor/patient/{patient_id}/medication", response_model=schemas.Medication)
 def prescribe_medication(
     patient_id: int,
     medication: schemas.MedicationCreate,
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
 ):
     if current_user.role != models.UserRole.DOCTOR:
         raise HTTPException(status_code=403, detail="Only doctors can prescribe medication.")
@@ -1250,38 +1594,16 @@ def prescribe_medication(
     )
     db.add(db_medication)
     
-    log_audit(db, current_user.id, "PRESCRIBE_MEDICATION", f"Doctor prescribed {medication.name} to patient {patient_id}")
+    log_audit(db, current_user.id, "PRESCRIBE_MEDICATION", patient_id=patient_id, medication=medication.name)
     db.commit()
     
     db.refresh(db_medication)
-    # Create a notification for the patient to inform them
+    # Create a notification for the patient to inform them; the push goes out through the outbox
     try:
         notif_msg = f"Doctor {current_user.name} prescribed {db_medication.name} for you."
         notif_link = f"/medications/{db_medication.id}"
-        notification = models.Notification(owner_id=patient_id, message=notif_msg, link=notif_link)
-        db.add(notification)
+        digests.deliver(db, patient_id, "New Prescription", notif_msg, notif_link)
         db.commit()
-        db.refresh(notification)
-        # Attempt to send push notification via FCM to the patient
-        try:
-            # send to all active device tokens for the patient
-            devices = db.query(models.Device).filter(models.Device.owner_id == patient_id, models.Device.active == True).all()
-            tokens = [d.token for d in devices]
-            if tokens:
-                res = firebase_messaging.send_messages_to_tokens(tokens, title="New Prescription", body=notif_msg, data={"link": notif_link})
-                # record push logs
-                for r in (res.get('responses') or []):
-                    log = models.PushLog(owner_id=patient_id, token=r.get('token'), success=bool(r.get('success')), response=str(r.get('response')) if r.get('response') else None, error=str(r.get('error')) if r.get('error') else None)
-                    db.add(log)
-                db.commit()
-                # deactivate tokens that failed with invalid registration
-                for r in (res.get('responses') or []):
-                    if not r.get('success'):
-                        tkn = r.get('token')
-                        db.query(models.Device).filter(models.Device.token == tkn).update({"active": False})
-                db.commit()
-        except Exception:
-            db.rollback()
     except Exception:
         # Non-fatal: if notification creation fails, proceed to return medication
         db.rollback()
@@ -1291,29 +1613,183 @@ def prescribe_medication(
 
 # Notifications
 @app.get("/notifications", response_model=List[schemas.Notification])
-def get_my_notifications(
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+async def get_my_notifications(
+    response: Response,
+    since_id: Optional[int] = Query(None, description="Only notifications newer than this id (last one seen)"),
+    page: pagination.HistoryPage = Depends(),
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
+):
+    stmt = select(models.Notification).filter(models.Notification.owner_id == current_user.id)
+    if since_id is not None:
+        stmt = stmt.filter(models.Notification.id > since_id)
+    stmt = page.apply(stmt, models.Notification.created_at, models.Notification.id, newest_first=True)
+    result = await db.execute(stmt)
+    return page.page(result.scalars().all(), response, ts_attr="created_at")
+
+
+async def count_unread(db: AsyncSession, owner_id: int):
+    # answered from the partial index ix_notifications_owner_unread, which holds unread rows only
+    result = await db.execute(
+        select(func.count()).select_from(models.Notification)
+        .filter(models.Notification.owner_id == owner_id, models.Notification.read == False)
+    )
+    return result.scalar()
+
+
+@app.get("/notifications/unread-count")
+async def get_unread_notification_count(
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
-    notes = db.query(models.Notification).filter(models.Notification.owner_id == current_user.id).order_by(desc(models.Notification.created_at)).all()
-    return notes
+    return {"unread_count": await count_unread(db, current_user.id)}
+
+
+@app.post("/notifications/read")
+async def mark_notifications_read(
+    body: schemas.NotificationMarkRead,
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
+):
+    """Mark many notifications read in one statement: the given `ids`, everything up to
+    `up_to_id`, or all unread notifications when neither is given."""
+    stmt = update(models.Notification).where(
+        models.Notification.owner_id == current_user.id, models.Notification.read == False
+    )
+    if body.ids is not None:
+        stmt = stmt.where(models.Notification.id.in_(body.ids))
+    if body.up_to_id is not None:
+        stmt = stmt.where(models.Notification.id <= body.up_to_id)
+    result = await db.execute(
+        stmt.values(read=True).returning(models.Notification.id).execution_options(synchronize_session=False)
+    )
+    changed = [(notif_id, current_user.id) for notif_id in result.scalars().all()]
+    # a bulk UPDATE skips the ORM flush, so log the changes for /sync here
+    await db.run_sync(changelog.record_updated, models.Notification, changed)
+    await db.commit()
+    return {"updated": len(changed), "unread_count": await count_unread(db, current_user.id)}
 
 
 @app.patch("/notifications/{notif_id}/read", response_model=schemas.Notification)
-def mark_notification_read(
+async def mark_notification_read(
     notif_id: int,
-    db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user_async)
 ):
-    notif = db.query(models.Notification).filter(models.Notification.id == notif_id, models.Notification.owner_id == current_user.id).first()
+    result = await db.execute(
+        select(models.Notification).filter(models.Notification.id == notif_id, models.Notification.owner_id == current_user.id)
+    )
+    notif = result.scalars().first()
     if not notif:
         raise HTTPException(status_code=404, detail="Notification not found")
     notif.read = True
-    db.commit()
-    db.refresh(notif)
+    await db.commit()
+    await db.refresh(notif)
     return notif
 
 
+# --- REALTIME (SSE / WebSocket) ---
+@app.get("/events")
+async def stream_events(token: str = Depends(auth.oauth2_scheme)):
+    """Server-Sent Events: "notification" and "dashboard" events as they commit, ": ping" heartbeats."""
+    user = await auth.authenticate_token_async(token)
+    sub = realtime.hub.subscribe(user.id)
+    return StreamingResponse(
+        realtime.sse_stream(sub),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.websocket("/ws")
+async def websocket_events(websocket: WebSocket, token: Optional[str] = None):
+    """Same events as /events over a WebSocket. Authenticate with ?token= or an Authorization header."""
+    if token is None:
+        scheme, _, value = websocket.headers.get("authorization", "").partition(" ")
+        token = value if scheme.lower() == "bearer" else None
+    try:
+        user = await auth.authenticate_token_async(token)
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await websocket.accept()
+    await realtime.serve_websocket(websocket, user.id)
+
+
+@app.get("/admin/realtime-stats", dependencies=[Depends(auth.get_admin_user)])
+def get_realtime_stats():
+    return {"connections": realtime.hub.connections, **realtime.hub.stats}
+
+
+@app.get("/admin/password-pool-stats", dependencies=[Depends(auth.get_admin_user)])
+def get_password_pool_stats():
+    return password_pool.summary()
+
+
+@app.get("/admin/identity-cache-stats", dependencies=[Depends(auth.get_admin_user)])
+def get_identity_cache_stats():
+    return identity_cache.stats()
+
+
+@app.get("/admin/push-stats", dependencies=[Depends(auth.get_admin_user)])
+def get_push_stats():
+    return {"pending": push.pending(engine), **push.stats, "fcm": fcm.get_client().stats}
+
+
+@app.get("/admin/delivery-log-stats", dependencies=[Depends(auth.get_admin_user)])
+def get_delivery_log_stats():
+    return {"depth": delivery_log.depth(), **delivery_log.stats}
+
+
+@app.get("/admin/audit-stats", dependencies=[Depends(auth.get_admin_user)])
+def get_audit_stats():
+    return {"depth": audit.writer.depth(), **audit.stats, "partitions": audit_store.summary(engine)}
+
+
+@app.get("/admin/audit-logs", response_model=List[schemas.AuditLogEntry], dependencies=[Depends(auth.get_admin_user)])
+def get_audit_logs(
+    response: Response,
+    user_id: Optional[int] = None,
+    action: Optional[str] = None,
+    include_archived: bool = False,
+    page: pagination.HistoryPage = Depends(),
+):
+    """Audit events, newest first, by user, action and time range (from/to), with cursors."""
+    code = None
+    if action is not None:
+        if action not in audit.ACTIONS:
+            raise HTTPException(status_code=400, detail=f"Unknown action {action}")
+        code = audit.ACTIONS[action]
+    rows = audit_store.read_page(engine, page, user_id=user_id, action=code, include_archived=include_archived)
+    rows = page.page(rows, response, ts_attr="timestamp")
+    return [
+        schemas.AuditLogEntry(id=row.id, timestamp=row.timestamp, user_id=row.user_id,
+                              action=audit.NAMES.get(row.action, str(row.action)), details=audit.decode(row.details))
+        for row in rows
+    ]
+
+
+# --- DELTA SYNC ---
+@app.get("/sync", response_model=schemas.SyncResponse)
+def sync_changes(
+    since: Optional[int] = Query(None, ge=0, description="Token from the previous sync; omit for a full snapshot"),
+    db: Session = Depends(database.get_db),
+    current_user: identity_cache.Identity = Depends(auth.get_current_user)
+):
+    """Entities the user owns that changed since `since`: upserts as full objects, deletions as ids."""
+    if since is not None and since > changelog.current_token(db):
+        # token from another database (e.g. after a restore): the client must start over
+        raise HTTPException(status_code=410, detail="Sync token is no longer valid; sync without 'since'")
+
+    # no token, or one from before the pruned part of the change log
+    if since is None or since < changelog.horizon(db):
+        token, upserts = changelog.snapshot(db, current_user.id)
+        return {"token": str(token), "full": True, "upserts": upserts}
+
+    token, has_more, upserts, deleted = changelog.changes_since(db, current_user.id, since)
+    return {"token": str(token), "has_more": has_more, "upserts": upserts, "deleted": deleted}
+
+
 # --- TEST / ADMIN FCM ENDPOINTS ---
 @app.post("/test/send-fcm-token")
 def test_send_fcm_token(
@@ -1333,28 +1809,21 @@ def admin_send_fcm_to_user(
     title: str = Form("Notification"),
     body: str = Form(...),
     db: Session = Depends(database.get_db),
-    current_user: models.User = Depends(auth.get_current_user)
+    current_user: identity_cache.Identity = Depends(auth.get_admin_user)
 ):
     """Authenticated endpoint to send FCM to a user by id. Useful for verification.
-    Requires authentication token in the request (same auth as other endpoints).
+    Requires an admin (doctor) token, like the other /admin routes.
     """
     target = db.query(models.User).filter(models.User.id == user_id).first()
     if not target:
         raise HTTPException(status_code=404, detail="User not found")
     # Send to all active devices for the user
-    devices = db.query(models.Device).filter(models.Device.owner_id == user_id, models.Device.active == True).all()
-    tokens = [d.token for d in devices]
-    if not tokens:
+    active = db.query(models.Device.id).filter(models.Device.owner_id == user_id, models.Device.active == True).first()
+    if not active:
         raise HTTPException(status_code=400, detail="User has no active device tokens")
-    res = firebase_messaging.send_messages_to_tokens(tokens, title=title, body=body, data={})
-    # Log results
-    for r in (res.get('responses') or []):
-        log = models.PushLog(owner_id=user_id, token=r.get('token'), success=bool(r.get('success')), response=str(r.get('response')) if r.get('response') else None, error=str(r.get('error')) if r.get('error') else None)
-        db.add(log)
-    db.commit()
-    # Deactivate invalid tokens
-    for r in (res.get('responses') or []):
-        if not r.get('success'):
-            db.query(models.Device).filter(models.Device.token == r.get('token')).update({"active": False})
+    # Delivery results land in push_logs once the dispatcher has sent it
+    row = push.enqueue(db, user_id, title, body)
+    db.flush()
+    outbox_id = row.id
     db.commit()
-    return {"sent": True, "result": res}
+    return {"queued": True, "id": outbox_id}
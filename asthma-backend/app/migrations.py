@@ -0,0 +1,327 @@
+# asthma-backend/migrations.py
+"""
+Versioned schema migrations.
+
+Every schema change is a numbered migration registered with @migration(version, name).
+Applied versions are recorded in the `schema_version` table, so each migration runs exactly
+once per database. On boot a worker only reads MAX(version); when it is already at HEAD
+nothing else is touched.
+
+Two kinds of migration:
+  - schema migrations (default) get a Connection and run together inside one write
+    transaction (BEGIN IMMEDIATE on SQLite, so concurrent workers don't race);
+  - online migrations (online=True) get the Engine and commit in small batches so a long
+    backfill never holds the write lock for long. They must be idempotent, since a crashed
+    or concurrent run may repeat them before the version row is written.
+
+Run `python -m app.migrations` to apply pending migrations and print the status.
+"""
+
+import datetime
+from collections import namedtuple
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from app import audit, audit_store, models, rollup, summary, trends
+
+Migration = namedtuple("Migration", ["version", "name", "fn", "online"])
+
+MIGRATIONS = []
+
+
+def migration(version: int, name: str, online: bool = False):
+    def register(fn):
+        if any(m.version == version for m in MIGRATIONS):
+            raise ValueError(f"Duplicate migration version {version}")
+        MIGRATIONS.append(Migration(version, name, fn, online))
+        MIGRATIONS.sort(key=lambda m: m.version)
+        return fn
+    return register
+
+
+def head():
+    return MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+# ------------------------------------------------------------
+# Helpers for migration bodies
+# ------------------------------------------------------------
+
+def column_names(conn, table: str):
+    return [r[1] for r in conn.execute(text(f"PRAGMA table_info('{table}')")).fetchall()]
+
+
+def add_column(conn, table: str, column: str, ddl: str):
+    """ALTER TABLE ... ADD COLUMN unless the column is already there (fresh DBs get it from create_all)."""
+    if column not in column_names(conn, table):
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+        print(f"[migrations] Added column {column} to {table} table")
+
+
+def create_table(conn, model):
+    model.__table__.create(bind=conn, checkfirst=True)
+
+
+def create_indexes(conn, model):
+    """Create the model's indexes; those on columns a later migration adds are left to it."""
+    columns = set(column_names(conn, model.__tablename__))
+    for index in model.__table__.indexes:
+        if all(column.name in columns for column in index.columns):
+            index.create(bind=conn, checkfirst=True)
+
+
+def backfill(engine, statement: str, batch_size: int = 1000, **params):
+    """Run `statement` repeatedly, one short transaction per batch, until it touches no rows.
+    The statement must bound itself with :batch_size (e.g. `WHERE id IN (SELECT ... LIMIT :batch_size)`)."""
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            res = conn.execute(text(statement), {"batch_size": batch_size, **params})
+        if not res.rowcount or res.rowcount <= 0:
+            return total
+        total += res.rowcount
+
+
+# ------------------------------------------------------------
+# Migrations (append new ones at the end with the next version number)
+# ------------------------------------------------------------
+
+@migration(1, "base schema")
+def _base_schema(conn):
+    models.Base.metadata.create_all(bind=conn)
+
+
+@migration(2, "medication metadata columns")
+def _medication_metadata_columns(conn):
+    additions = {
+        'start_date': 'DATETIME',
+        'days': 'INTEGER',
+        'cure_probability': 'FLOAT',
+        'doses_remaining': 'INTEGER',
+        'source': 'TEXT',
+        'prescribed_by': 'INTEGER'
+    }
+    for col, ddl in additions.items():
+        add_column(conn, "medications", col, ddl)
+
+
+@migration(3, "users.fcm_token")
+def _user_fcm_token(conn):
+    add_column(conn, "users", "fcm_token", "TEXT")
+
+
+@migration(4, "composite indexes for hot queries")
+def _hot_query_indexes(conn):
+    for model in (models.PEFRRecord, models.Symptom, models.Notification, models.MedicationStatusHistory,
+                  models.Device, models.DoctorPatient, models.Medication, models.BaselinePEFR, models.EmailLog):
+        create_indexes(conn, model)
+
+
+@migration(5, "patient_summary table")
+def _patient_summary_table(conn):
+    create_table(conn, models.PatientSummary)
+
+
+@migration(6, "backfill patient_summary", online=True)
+def _patient_summary_backfill(engine):
+    summary.rebuild_all(engine)
+
+
+@migration(7, "change_log table")
+def _change_log_table(conn):
+    create_table(conn, models.ChangeLog)
+
+
+@migration(8, "partial indexes for unread counts and notification retention")
+def _notification_partial_indexes(conn):
+    create_indexes(conn, models.Notification)
+
+
+@migration(9, "pefr_daily_rollup table")
+def _pefr_daily_rollup_table(conn):
+    create_table(conn, models.PEFRDailyRollup)
+
+
+@migration(10, "backfill pefr_daily_rollup", online=True)
+def _pefr_daily_rollup_backfill(engine):
+    rollup.rebuild_all(engine)
+
+
+@migration(11, "trend state on baseline_pefr, pefr_records.anomaly")
+def _trend_state_columns(conn):
+    additions = {
+        'trend_mean': 'FLOAT',
+        'trend_var': 'FLOAT',
+        'trend_slope': 'FLOAT',
+        'trend_count': 'INTEGER NOT NULL DEFAULT 0',
+        'trend_updated_at': 'DATETIME',
+    }
+    for col, ddl in additions.items():
+        add_column(conn, "baseline_pefr", col, ddl)
+    add_column(conn, "pefr_records", "anomaly", "BOOLEAN DEFAULT 0")
+
+
+@migration(12, "backfill trend state", online=True)
+def _trend_state_backfill(engine):
+    trends.rebuild_all(engine)
+
+
+@migration(13, "idempotency_keys table")
+def _idempotency_keys_table(conn):
+    create_table(conn, models.IdempotencyKey)
+    create_indexes(conn, models.IdempotencyKey)
+
+
+@migration(14, "push_outbox table")
+def _push_outbox_table(conn):
+    create_table(conn, models.PushOutbox)
+    create_indexes(conn, models.PushOutbox)
+
+
+@migration(15, "notification_digests table")
+def _notification_digests_table(conn):
+    create_table(conn, models.NotificationDigest)
+    create_indexes(conn, models.NotificationDigest)
+
+
+@migration(16, "audit_events table (replaces audit_logs)")
+def _audit_events_table(conn):
+    audit_store.build_table("audit_events").create(bind=conn, checkfirst=True)
+    if not conn.execute(text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'audit_logs'")).first():
+        return
+    # free-text details are kept as {"text": ...}; unknown actions become LEGACY with their name
+    known = ", ".join(f"'{name}'" for name in audit.ACTIONS)
+    codes = " ".join(f"WHEN '{name}' THEN {code}" for name, code in audit.ACTIONS.items())
+    conn.execute(text(
+        "INSERT INTO audit_events (timestamp, user_id, action, details) "
+        f"SELECT COALESCE(timestamp, CURRENT_TIMESTAMP), user_id, CASE action {codes} ELSE 0 END, "
+        f"CASE WHEN action IN ({known}) AND details IS NULL THEN NULL "
+        f"WHEN action IN ({known}) THEN json_object('text', details) "
+        "WHEN details IS NULL THEN json_object('action', action) "
+        "ELSE json_object('action', action, 'text', details) END "
+        "FROM audit_logs ORDER BY id"
+    ))
+    conn.execute(text("DROP TABLE audit_logs"))
+
+
+@migration(17, "monthly audit_events partitions")
+def _audit_event_partitions(conn):
+    months = conn.execute(text(
+        "SELECT DISTINCT strftime('%Y%m', timestamp) FROM audit_events ORDER BY 1"
+    )).scalars().all()
+    for month in months:
+        audit_store.create_partition(conn, month)
+        conn.execute(text(
+            f"INSERT INTO {audit_store.PREFIX}{month} (timestamp, user_id, action, details) "
+            "SELECT timestamp, user_id, action, details FROM audit_events "
+            "WHERE strftime('%Y%m', timestamp) = :month ORDER BY id"
+        ), {"month": month})
+    conn.execute(text("DROP TABLE audit_events"))
+
+
+@migration(18, "refresh_tokens table")
+def _refresh_tokens_table(conn):
+    create_table(conn, models.RefreshToken)
+    create_indexes(conn, models.RefreshToken)
+
+
+@migration(19, "otp_codes table")
+def _otp_codes_table(conn):
+    create_table(conn, models.OTPCode)
+    create_indexes(conn, models.OTPCode)
+
+
+@migration(20, "otp_codes.code_expires_at")
+def _otp_code_expiry_column(conn):
+    add_column(conn, "otp_codes", "code_expires_at", "DATETIME")
+
+
+@migration(21, "dashboard sort keys on doctor_patient_map")
+def _doctor_patient_sort_keys(conn):
+    additions = {
+        'risk_rank': 'INTEGER NOT NULL DEFAULT 3',
+        'last_reading_epoch': 'INTEGER NOT NULL DEFAULT 0',
+        'patient_name': "VARCHAR NOT NULL DEFAULT ''",
+    }
+    for col, ddl in additions.items():
+        add_column(conn, "doctor_patient_map", col, ddl)
+    # one row per link, so a single statement is enough
+    conn.execute(text(
+        "UPDATE doctor_patient_map SET "
+        "risk_rank = COALESCE((SELECT risk_rank FROM patient_summary s WHERE s.patient_id = doctor_patient_map.patient_id), 3), "
+        "last_reading_epoch = COALESCE((SELECT last_reading_epoch FROM patient_summary s "
+        "WHERE s.patient_id = doctor_patient_map.patient_id), 0), "
+        "patient_name = COALESCE((SELECT name FROM users u WHERE u.id = doctor_patient_map.patient_id), '')"
+    ))
+    create_indexes(conn, models.DoctorPatient)
+
+
+# ------------------------------------------------------------
+# Runner
+# ------------------------------------------------------------
+
+def current_version(engine):
+    """The single boot-time check: MAX(version), or 0 if the version table doesn't exist yet."""
+    try:
+        with engine.connect() as conn:
+            return conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+    except OperationalError:
+        return 0
+
+
+def _begin_write(conn):
+    if conn.dialect.name == "sqlite":
+        conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+def _record(conn, m: Migration):
+    conn.execute(
+        text("INSERT OR IGNORE INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"),
+        {"v": m.version, "n": m.name, "t": datetime.datetime.utcnow()}
+    )
+
+
+def upgrade(engine):
+    """Apply pending migrations in order. Returns the list of versions applied by this call."""
+    if current_version(engine) >= head():
+        return []
+
+    applied = []
+    while True:
+        with engine.connect() as conn:
+            _begin_write(conn)
+            conn.execute(text(
+                "CREATE TABLE IF NOT EXISTS schema_version ("
+                "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at DATETIME)"
+            ))
+            # re-read under the write lock: another worker may have migrated meanwhile
+            current = conn.execute(text("SELECT MAX(version) FROM schema_version")).scalar() or 0
+            pending = [m for m in MIGRATIONS if m.version > current]
+            online = None
+            for m in pending:
+                if m.online:
+                    online = m
+                    break
+                m.fn(conn)
+                _record(conn, m)
+                applied.append(m.version)
+                print(f"[migrations] Applied {m.version}: {m.name}")
+            conn.commit()
+
+        if online is None:
+            return applied
+
+        # online backfills run outside the schema transaction, in their own short batches
+        online.fn(engine)
+        with engine.begin() as conn:
+            _record(conn, online)
+        applied.append(online.version)
+        print(f"[migrations] Applied {online.version}: {online.name} (online)")
+
+
+if __name__ == "__main__":
+    from app.database import engine
+
+    done = upgrade(engine)
+    print(f"Schema at version {current_version(engine)} (head {head()}); applied now: {done or 'none'}")
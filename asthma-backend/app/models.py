@@ -1,6 +1,6 @@
 # asthma-backend/models.py
 
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, DateTime, Enum as SAEnum
+from sqlalchemy import Boolean, Column, ForeignKey, Index, Integer, LargeBinary, String, Float, Date, DateTime, Enum as SAEnum, text
 from sqlalchemy.orm import relationship
 from app.database import Base
 import datetime
@@ -37,7 +37,6 @@ class User(Base):
     medications = relationship("Medication", back_populates="owner")
     emergency_contacts = relationship("EmergencyContact", back_populates="owner")
     reminders = relationship("Reminder", back_populates="owner")
-    audit_logs = relationship("AuditLog", back_populates="user")
     alert_logs = relationship("AlertLog", back_populates="user")
     # Notifications for the user
     notifications = relationship("Notification", back_populates="owner")
@@ -57,6 +56,11 @@ class Device(Base):
     last_seen = Column(DateTime, default=datetime.datetime.utcnow)
     active = Column(Boolean, default=True)
 
+    __table_args__ = (
+        # active devices of a user (push fan-out)
+        Index("ix_devices_owner_active", "owner_id", "active"),
+    )
+
 
 class PushLog(Base):
     __tablename__ = "push_logs"
@@ -71,12 +75,39 @@ class PushLog(Base):
     # no relationships here; this table only logs push attempts
 
 
+class PushOutbox(Base):
+    """A push waiting to be sent, written with the notification it announces (app.push)."""
+    __tablename__ = "push_outbox"
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, nullable=False)      # no FK: a push for a deleted user is just dropped
+    title = Column(String, nullable=False)
+    body = Column(String, nullable=False)
+    data = Column(String, nullable=True)            # JSON object of string values
+    tokens = Column(String, nullable=True)          # JSON list when retrying some devices only
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    last_error = Column(String, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_push_outbox_due", "next_attempt_at"),
+    )
+
+
 class BaselinePEFR(Base):
     __tablename__ = "baseline_pefr"
 
     id = Column(Integer, primary_key=True, index=True)
     baseline_value = Column(Integer, nullable=False)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+
+    # incremental trend state, maintained by app.trends on every reading
+    trend_mean = Column(Float, nullable=True)
+    trend_var = Column(Float, nullable=True)
+    trend_slope = Column(Float, nullable=True)
+    trend_count = Column(Integer, nullable=False, default=0)
+    trend_updated_at = Column(DateTime, nullable=True)
 
     owner = relationship("User", back_populates="baseline")
 
@@ -93,10 +124,16 @@ class PEFRRecord(Base):
     # --- ADDED/UPDATED FIELDS ---
     percentage = Column(Float, nullable=True)
     trend = Column(String, nullable=True)
+    anomaly = Column(Boolean, default=False)
     source = Column(String, default="manual")
 
     owner = relationship("User", back_populates="pefr_records")
 
+    __table_args__ = (
+        # a patient's readings in time order (history, latest reading, trend)
+        Index("ix_pefr_records_owner_recorded", "owner_id", "recorded_at"),
+    )
+
 
 class Symptom(Base):
     __tablename__ = "symptoms"
@@ -119,6 +156,10 @@ class Symptom(Base):
 
     owner = relationship("User", back_populates="symptoms")
 
+    __table_args__ = (
+        Index("ix_symptoms_owner_recorded", "owner_id", "recorded_at"),
+    )
+
 
 class DoctorPatient(Base):
     __tablename__ = "doctor_patient_map"
@@ -126,6 +167,68 @@ class DoctorPatient(Base):
     id = Column(Integer, primary_key=True, index=True)
     doctor_id = Column(Integer, ForeignKey("users.id"))
     patient_id = Column(Integer, ForeignKey("users.id"))
+    # dashboard sort keys, copied from patient_summary and users (app.summary keeps them in
+    # step) so a doctor's patients are read in every sort order straight from an index
+    risk_rank = Column(Integer, nullable=False, default=3)
+    last_reading_epoch = Column(Integer, nullable=False, default=0)
+    patient_name = Column(String, nullable=False, default="")
+
+    __table_args__ = (
+        # covering in both directions: a doctor's patients and a patient's doctors
+        Index("ix_doctor_patient_map_doctor_patient", "doctor_id", "patient_id"),
+        Index("ix_doctor_patient_map_patient_doctor", "patient_id", "doctor_id"),
+        # /doctor/patients?sort=risk|stale|name
+        Index("ix_doctor_patient_map_doctor_risk", "doctor_id", "risk_rank", "last_reading_epoch", "patient_id"),
+        Index("ix_doctor_patient_map_doctor_stale", "doctor_id", "last_reading_epoch", "patient_id"),
+        Index("ix_doctor_patient_map_doctor_name", "doctor_id", "patient_name", "patient_id"),
+    )
+
+
+class PEFRDailyRollup(Base):
+    """Per-patient, per-day PEFR statistics kept up to date by app.rollup on every reading,
+    so charts and reports read one row per day instead of every reading."""
+    __tablename__ = "pefr_daily_rollup"
+
+    owner_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    day = Column(Date, primary_key=True)  # local day (PEFR_ROLLUP_TZ_OFFSET_MINUTES)
+    count = Column(Integer, nullable=False, default=0)
+    sum = Column(Float, nullable=False, default=0)
+    sum_sq = Column(Float, nullable=False, default=0)
+    min = Column(Integer, nullable=True)
+    max = Column(Integer, nullable=True)
+    first_at = Column(DateTime, nullable=True)
+    first_value = Column(Integer, nullable=True)
+    last_at = Column(DateTime, nullable=True)
+    last_value = Column(Integer, nullable=True)
+    red = Column(Integer, nullable=False, default=0)
+    yellow = Column(Integer, nullable=False, default=0)
+    green = Column(Integer, nullable=False, default=0)
+    morning_sum = Column(Float, nullable=False, default=0)
+    morning_count = Column(Integer, nullable=False, default=0)
+
+
+class PatientSummary(Base):
+    """Per-patient snapshot of the latest reading, maintained on every PEFR/symptom write
+    so the doctor dashboard doesn't have to look up each patient's history."""
+    __tablename__ = "patient_summary"
+
+    patient_id = Column(Integer, ForeignKey("users.id"), primary_key=True)
+    current_zone = Column(String, nullable=True)
+    latest_pefr_id = Column(Integer, nullable=True)
+    latest_pefr_value = Column(Integer, nullable=True)
+    latest_percentage = Column(Float, nullable=True)
+    latest_trend = Column(String, nullable=True)
+    last_reading_at = Column(DateTime, nullable=True)
+    latest_symptom_id = Column(Integer, nullable=True)
+    last_symptom_at = Column(DateTime, nullable=True)
+    # sort keys: 0 = Red ... 3 = Unknown / no reading; epoch seconds of the last reading (0 = never)
+    risk_rank = Column(Integer, nullable=False, default=3)
+    last_reading_epoch = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_patient_summary_zone", "current_zone"),
+    )
 
 
 # -------------------------------------------------------------------
@@ -139,7 +242,7 @@ class Medication(Base):
     name = Column(String, nullable=False)
     dose = Column(String, nullable=True)
     schedule = Column(String, nullable=True)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
 
     owner = relationship("User", back_populates="medications")
 
@@ -175,6 +278,10 @@ class MedicationStatusHistory(Base):
     medication = relationship("Medication", back_populates="status_history")
     changed_by_user = relationship("User", back_populates="medication_status_changes")
 
+    __table_args__ = (
+        Index("ix_medication_status_history_medication_changed", "medication_id", "changed_at"),
+    )
+
 
 # -------------------------------------------------------------------
 # ---------------------- OTHER EXISTING TABLES ----------------------
@@ -218,17 +325,89 @@ class Notification(Base):
 
     owner = relationship("User", back_populates="notifications")
 
+    __table_args__ = (
+        Index("ix_notifications_owner_created", "owner_id", "created_at"),
+        # partial indexes: unread counts only touch unread rows, retention only read ones
+        Index("ix_notifications_owner_unread", "owner_id", sqlite_where=text("read = 0")),
+        Index("ix_notifications_read_created", "created_at", sqlite_where=text("read = 1")),
+    )
 
-class AuditLog(Base):
-    __tablename__ = "audit_logs"
 
-    id = Column(Integer, primary_key=True, index=True)
-    timestamp = Column(DateTime, default=datetime.datetime.utcnow)
-    user_id = Column(Integer, ForeignKey("users.id"))
-    action = Column(String, nullable=False)
-    details = Column(String, nullable=True)
+class NotificationDigest(Base):
+    """Routine notifications to one recipient, held back and merged until due_at (app.digests)."""
+    __tablename__ = "notification_digests"
+
+    owner_id = Column(Integer, primary_key=True)     # recipient; no FK, dropped if the user is gone
+    kind = Column(String, primary_key=True)          # event type, e.g. "pefr", "medication"
+    count = Column(Integer, nullable=False, default=0)
+    subjects = Column(String, nullable=True)         # JSON {patient id: name} of the merged events
+    title = Column(String, nullable=False)           # of the latest event
+    message = Column(String, nullable=False)
+    link = Column(String, nullable=True)
+    data = Column(String, nullable=True)
+    first_at = Column(DateTime, default=datetime.datetime.utcnow)
+    due_at = Column(DateTime, nullable=False)
 
-    user = relationship("User", back_populates="audit_logs")
+    __table_args__ = (
+        Index("ix_notification_digests_due", "due_at"),
+    )
+
+
+class ChangeLog(Base):
+    """One row per insert/update/delete of a synced entity, written by app.changelog.
+    The autoincrement id is the client's sync token."""
+    __tablename__ = "change_log"
+
+    id = Column(Integer, primary_key=True)
+    owner_id = Column(Integer, nullable=False)  # no FK: tombstones outlive the rows they describe
+    entity = Column(String, nullable=False)     # table name, e.g. "pefr_records"
+    entity_id = Column(Integer, nullable=False)
+    deleted = Column(Boolean, nullable=False, default=False)
+    changed_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_change_log_owner_id", "owner_id", "id"),
+        # never reuse ids of pruned rows, or an old token could skip new changes
+        {"sqlite_autoincrement": True},
+    )
+
+
+class IdempotencyKey(Base):
+    """Stored response of a POST/PATCH sent with an Idempotency-Key header (app.idempotency)."""
+    __tablename__ = "idempotency_keys"
+
+    key = Column(LargeBinary, primary_key=True)              # sha256 of caller + Idempotency-Key
+    request_hash = Column(LargeBinary, nullable=False)       # sha256 of method, path and body
+    status_code = Column(Integer, nullable=True)             # NULL while the first request runs
+    content_type = Column(String, nullable=True)
+    body = Column(LargeBinary, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_idempotency_keys_created_at", "created_at"),
+        {"sqlite_with_rowid": False},
+    )
+
+
+class RefreshToken(Base):
+    """Server-side half of a rotating refresh token (app.auth, AUTH_MODE=claims). Only the
+    sha256 of the token is stored; a used token is kept, marked, until it expires, so that
+    presenting it again revokes every token of its family (one login)."""
+    __tablename__ = "refresh_tokens"
+
+    token_hash = Column(LargeBinary, primary_key=True)
+    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    family = Column(LargeBinary, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+    used_at = Column(DateTime, nullable=True)                # set when rotated
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    __table_args__ = (
+        Index("ix_refresh_tokens_user", "user_id"),
+        Index("ix_refresh_tokens_family", "family"),
+        Index("ix_refresh_tokens_expires_at", "expires_at"),
+        {"sqlite_with_rowid": False},
+    )
 
 
 class AlertLog(Base):
@@ -243,6 +422,26 @@ class AlertLog(Base):
     user = relationship("User", back_populates="alert_logs")
 
 
+class OTPCode(Base):
+    """Pending one-time password of an email address (app.otp_store, OTP_STORE=sqlite), shared
+    by every worker. Only an HMAC of the code is stored."""
+    __tablename__ = "otp_codes"
+
+    email = Column(String, primary_key=True)
+    otp_hash = Column(LargeBinary, nullable=False)
+    purpose = Column(String, nullable=False)             # "signup" or "forgot"
+    payload = Column(String, nullable=True)              # JSON, e.g. the pending signup
+    attempts = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    code_expires_at = Column(DateTime, nullable=True)    # the code; NULL means expires_at
+    expires_at = Column(DateTime, nullable=False)        # the whole record (swept after this)
+
+    __table_args__ = (
+        Index("ix_otp_codes_expires_at", "expires_at"),
+        {"sqlite_with_rowid": False},
+    )
+
+
 class EmailLog(Base):
     __tablename__ = "email_logs"
 
@@ -252,5 +451,5 @@ class EmailLog(Base):
     purpose = Column(String, nullable=True)
     success = Column(Boolean, default=False)
     error = Column(String, nullable=True)
-    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
 
@@ -2,7 +2,9 @@
 
 import os
 from dotenv import load_dotenv
-import random
+import hashlib
+import hmac
+import secrets
 import logging
 from datetime import datetime, timedelta
 import smtplib
@@ -12,12 +14,14 @@ try:
 except Exception:
     requests = None
 
-logger = logging.getLogger("otp_service")
+from app import auth, delivery_log, models, otp_store
 
-OTP_EXPIRY_MINUTES = 2
+logger = logging.getLogger("otp_service")
 
-# email -> { otp, created_at, purpose, payload }
-otp_store = {}
+OTP_EXPIRY_MINUTES = int(os.getenv("OTP_EXPIRY_MINUTES", "2"))
+# how long the pending signup/reset is kept, so an expired code can still be resent
+OTP_PENDING_MINUTES = max(int(os.getenv("OTP_PENDING_MINUTES", "30")), OTP_EXPIRY_MINUTES)
+OTP_MAX_ATTEMPTS = int(os.getenv("OTP_MAX_ATTEMPTS", "5"))
 
 # Load .env in project root (if present) so SMTP credentials can be provided via a file
 _here = os.path.dirname(__file__)
@@ -28,44 +32,67 @@ load_dotenv(os.path.join(_here, '.env'))
 
 
 def generate_otp():
-    return str(random.randint(100000, 999999))
+    return str(100000 + secrets.randbelow(900000))
+
+
+def _otp_hash(email: str, otp: str, purpose: str) -> bytes:
+    return hmac.new(auth.SECRET_KEY.encode(), f"{email}\0{purpose}\0{otp}".encode(), hashlib.sha256).digest()
 
 
 def store_otp(email: str, otp: str, purpose: str, payload: dict = None):
-    otp_store[email] = {
-        "otp": otp,
-        "created_at": datetime.utcnow(),
+    """Replace the pending OTP of `email` (app.otp_store); its attempt counter starts over.
+
+    The code is valid for OTP_EXPIRY_MINUTES, the record (with the payload) is kept for
+    OTP_PENDING_MINUTES so the resend endpoints can issue a new code after that."""
+    now = datetime.utcnow()
+    otp_store.store.put(email, {
+        "otp_hash": _otp_hash(email, otp, purpose),
         "purpose": purpose,
-        "payload": payload
-    }
+        "payload": payload,
+        "code_expires_at": now + timedelta(minutes=OTP_EXPIRY_MINUTES),
+        "expires_at": now + timedelta(minutes=OTP_PENDING_MINUTES),
+    })
 
 
-def is_expired(email: str):
-    return datetime.utcnow() - otp_store[email]["created_at"] > timedelta(minutes=OTP_EXPIRY_MINUTES)
+def get_pending(email: str):
+    """The pending OTP record of `email` ({purpose, payload, ...}), or None if there is none.
+    The code itself may have expired; this is what resend looks at."""
+    data = otp_store.store.get(email)
+    if data is None or data["expires_at"] <= datetime.utcnow():
+        return None
+    return data
 
 
 def verify_otp(email: str, otp: str, purpose: str):
-    if email not in otp_store:
+    data = otp_store.store.get(email)
+    if data is None:
         return False, "OTP not found"
 
-    data = otp_store[email]
-
     if data["purpose"] != purpose:
         return False, "Invalid OTP purpose"
 
-    if is_expired(email):
-        del otp_store[email]
+    # the record stays until it is swept, so the code can still be resent
+    if (data.get("code_expires_at") or data["expires_at"]) <= datetime.utcnow():
         return False, "OTP expired"
 
-    if data["otp"] != otp:
+    if not hmac.compare_digest(data["otp_hash"], _otp_hash(email, otp or "", purpose)):
+        # wrong codes count per email; after OTP_MAX_ATTEMPTS the OTP is gone
+        if otp_store.store.add_attempt(email) >= OTP_MAX_ATTEMPTS:
+            otp_store.store.delete(email)
+            return False, "Too many attempts. Please request a new OTP."
         return False, "Invalid OTP"
 
     return True, data
 
 
 def clear_otp(email: str):
-    if email in otp_store:
-        del otp_store[email]
+    otp_store.store.delete(email)
+
+
+def _log_email(email: str, subject: str, purpose: str, success: bool, error: str = None):
+    # queued; app.delivery_log writes email logs in batches off the request path
+    delivery_log.add(models.EmailLog, {"recipient": email, "subject": subject, "purpose": purpose,
+                                       "success": success, "error": error})
 
 
 def send_otp_email(email: str, otp: str, purpose: str):
@@ -127,14 +154,6 @@ def send_otp_email(email: str, otp: str, purpose: str):
     # on the configured port (commonly 587). Increase timeout for flaky networks.
     attempts = 2
     last_exc = None
-    # Prepare DB session writer if available
-    db_writer = None
-    try:
-        from database import SessionLocal
-        import models
-        db_writer = SessionLocal
-    except Exception:
-        db_writer = None
 
     timeout = int(os.getenv("SMTP_TIMEOUT", "30"))
     methods = []
@@ -173,28 +192,13 @@ def send_otp_email(email: str, otp: str, purpose: str):
                         pass
 
                 logger.info(f"OTP email sent to {email} via {method_name}@{host}:{port}")
-                # record success in DB if possible
-                if db_writer:
-                    try:
-                        db = db_writer()
-                        db.add(models.EmailLog(recipient=email, subject=msg["Subject"], purpose=purpose, success=True, error=None))
-                        db.commit()
-                        db.close()
-                    except Exception:
-                        pass
+                _log_email(email, msg["Subject"], purpose, True)
                 return True
             except Exception as e:
                 last_exc = e
                 logger.warning(f"{method_name} attempt {attempt} failed to send OTP email to {email}: {e}")
                 # record failure attempt
-                if db_writer:
-                    try:
-                        db = db_writer()
-                        db.add(models.EmailLog(recipient=email, subject=msg["Subject"], purpose=purpose, success=False, error=str(e)))
-                        db.commit()
-                        db.close()
-                    except Exception:
-                        pass
+                _log_email(email, msg["Subject"], purpose, False, str(e))
 
     # All attempts failed — log full exception and print OTP for developer debugging
     logger.exception(f"Failed to send OTP email to {email} after {attempts} attempts: {last_exc}")
@@ -203,18 +207,11 @@ def send_otp_email(email: str, otp: str, purpose: str):
     # an API-based provider (SendGrid) by setting SENDGRID_API_KEY in your environment,
     # which uses HTTPS and usually works on restricted networks.
     if last_exc is not None:
-        msg = str(last_exc).lower()
-        if "timed out" in msg or "connectionrefusederror" in msg or "connection refused" in msg:
+        error = str(last_exc).lower()
+        if "timed out" in error or "connectionrefusederror" in error or "connection refused" in error:
             logger.error("SMTP connection failures detected. Network may be blocking SMTP ports.\n"
                          "Consider setting SENDGRID_API_KEY or using a provider that accepts HTTPS API calls.")
     # final fail record
-    if db_writer:
-        try:
-            db = db_writer()
-            db.add(models.EmailLog(recipient=email, subject=msg["Subject"], purpose=purpose, success=False, error=str(last_exc)))
-            db.commit()
-            db.close()
-        except Exception:
-            pass
+    _log_email(email, msg["Subject"], purpose, False, str(last_exc))
     print(f"[otp_service] OTP for {email}: {otp} (purpose={purpose})")
     return False
@@ -0,0 +1,156 @@
+# asthma-backend/otp_store.py
+"""
+Where pending one-time passwords live between "send OTP" and "verify OTP".
+
+OTPs used to sit in a module-level dict: lost on restart, never swept, unbounded, and
+invisible to other uvicorn workers, so a code sent by one worker could not be verified by
+another. OTP_STORE selects a backend:
+
+  - sqlite (default): the otp_codes table of the main database, shared by every worker;
+  - memory: an in-process LRU of at most OTP_STORE_MAX_ENTRIES entries, for a single worker.
+
+Both hold one record per email: the HMAC of the code (never the code itself), its purpose,
+payload, the expiry of the code and of the record, and the number of wrong attempts
+(app.otp_service enforces the limit). A background task deletes expired records every
+OTP_SWEEP_SECONDS.
+"""
+
+import asyncio
+import collections
+import datetime
+import json
+import os
+import threading
+
+from sqlalchemy import delete, func, insert, select, update
+from starlette.concurrency import run_in_threadpool
+
+from app import database, models
+
+OTP_STORE = os.getenv("OTP_STORE", "sqlite")
+OTP_STORE_MAX_ENTRIES = int(os.getenv("OTP_STORE_MAX_ENTRIES", "10000"))
+OTP_SWEEP_SECONDS = float(os.getenv("OTP_SWEEP_SECONDS", "60"))
+
+_task = None
+
+
+class MemoryOTPStore:
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._records = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, email: str, record: dict):
+        with self._lock:
+            self._records[email] = dict(record, attempts=0)
+            self._records.move_to_end(email)
+            while len(self._records) > self.max_entries:
+                self._records.popitem(last=False)
+
+    def get(self, email: str):
+        with self._lock:
+            record = self._records.get(email)
+            return dict(record) if record is not None else None
+
+    def add_attempt(self, email: str) -> int:
+        with self._lock:
+            record = self._records.get(email)
+            if record is None:
+                return 0
+            record["attempts"] += 1
+            return record["attempts"]
+
+    def delete(self, email: str):
+        with self._lock:
+            self._records.pop(email, None)
+
+    def sweep(self, now: datetime.datetime) -> int:
+        with self._lock:
+            expired = [email for email, record in self._records.items() if record["expires_at"] <= now]
+            for email in expired:
+                del self._records[email]
+        return len(expired)
+
+    def size(self) -> int:
+        return len(self._records)
+
+
+class SQLiteOTPStore:
+    def __init__(self, engine):
+        self.engine = engine
+        self.table = models.OTPCode.__table__
+
+    def put(self, email: str, record: dict):
+        row = dict(record, email=email, attempts=0, created_at=datetime.datetime.utcnow(),
+                   payload=json.dumps(record["payload"]) if record.get("payload") is not None else None)
+        with self.engine.begin() as conn:
+            conn.execute(insert(self.table).prefix_with("OR REPLACE"), row)
+
+    def get(self, email: str):
+        with self.engine.connect() as conn:
+            row = conn.execute(select(self.table).where(self.table.c.email == email)).mappings().first()
+        if row is None:
+            return None
+        record = {key: row[key] for key in ("otp_hash", "purpose", "attempts", "code_expires_at", "expires_at")}
+        record["payload"] = json.loads(row["payload"]) if row["payload"] is not None else None
+        return record
+
+    def add_attempt(self, email: str) -> int:
+        with self.engine.begin() as conn:
+            attempts = conn.execute(
+                update(self.table).where(self.table.c.email == email)
+                .values(attempts=self.table.c.attempts + 1).returning(self.table.c.attempts)
+            ).scalar()
+        return attempts or 0
+
+    def delete(self, email: str):
+        with self.engine.begin() as conn:
+            conn.execute(delete(self.table).where(self.table.c.email == email))
+
+    def sweep(self, now: datetime.datetime) -> int:
+        with self.engine.begin() as conn:
+            return conn.execute(delete(self.table).where(self.table.c.expires_at <= now)).rowcount
+
+    def size(self) -> int:
+        with self.engine.connect() as conn:
+            return conn.execute(select(func.count()).select_from(self.table)).scalar()
+
+
+def _create_store():
+    if OTP_STORE == "memory":
+        return MemoryOTPStore(OTP_STORE_MAX_ENTRIES)
+    if OTP_STORE == "sqlite":
+        return SQLiteOTPStore(database.engine)
+    raise ValueError(f"OTP_STORE: unknown backend {OTP_STORE!r}")
+
+
+store = _create_store()
+
+
+def sweep() -> int:
+    """Delete expired OTPs. Returns the number deleted."""
+    return store.sweep(datetime.datetime.utcnow())
+
+
+async def _loop():
+    while True:
+        try:
+            swept = await run_in_threadpool(sweep)
+            if swept:
+                print(f"[otp] Swept {swept} expired OTPs")
+        except Exception as e:
+            print(f"[otp] Sweep failed: {e}")
+        await asyncio.sleep(OTP_SWEEP_SECONDS)
+
+
+def start():
+    global _task
+    if OTP_SWEEP_SECONDS > 0 and _task is None:
+        _task = asyncio.get_running_loop().create_task(_loop())
+
+
+def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
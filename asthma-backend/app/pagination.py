@@ -0,0 +1,138 @@
+# asthma-backend/pagination.py
+"""
+Keyset (cursor) pagination helpers.
+
+A cursor is the sort key of the last row of a page, JSON-encoded and base64url'd so clients
+treat it as opaque. The next page is `WHERE (k1, k2, ...) > (v1, v2, ...)` on the same
+ORDER BY, which an index on the sort columns answers without OFFSET scans.
+"""
+
+import base64
+import datetime
+import json
+import os
+from typing import Optional
+
+from fastapi import HTTPException, Query, Response
+from sqlalchemy import tuple_
+
+
+def encode_cursor(values) -> str:
+    raw = json.dumps(list(values), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, size: int) -> list:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def after(keys, values):
+    """Rows strictly after `values` in ascending order of `keys`."""
+    return tuple_(*keys) > tuple_(*values)
+
+
+def before(keys, values):
+    """Rows strictly before `values` in ascending order of `keys`."""
+    return tuple_(*keys) < tuple_(*values)
+
+
+# ------------------------------------------------------------
+# History endpoints: (timestamp, id) cursors and time windows
+# ------------------------------------------------------------
+
+HISTORY_DEFAULT_PAGE_SIZE = int(os.getenv("HISTORY_DEFAULT_PAGE_SIZE", "500"))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "1000"))
+
+
+def _timestamp_cursor(row, ts_attr: str):
+    return encode_cursor([getattr(row, ts_attr).isoformat(), row.id])
+
+
+def _decode_timestamp_cursor(cursor: str):
+    ts, row_id = decode_cursor(cursor, 2)
+    try:
+        return [datetime.datetime.fromisoformat(ts), int(row_id)]
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+class HistoryPage:
+    """Query parameters shared by the history endpoints (use as a dependency).
+
+    Rows come in the endpoint's natural order of (timestamp, id). `after` continues past the
+    X-Next-Cursor of the previous page, `before` goes back from an X-Prev-Cursor. `from`/`to`
+    bound the timestamp (inclusive). The page size is capped at HISTORY_MAX_PAGE_SIZE.
+
+    Without a cursor the first page holds the newest rows, in either order: an oldest-first
+    list starts at its end (like a `before` page from the last row) and pages back through
+    X-Prev-Cursor, so a client that never pages still gets its latest readings.
+    """
+
+    def __init__(
+        self,
+        after: Optional[str] = Query(None, description="Cursor from X-Next-Cursor: rows after it"),
+        before: Optional[str] = Query(None, description="Cursor from X-Prev-Cursor: rows before it"),
+        since: Optional[datetime.datetime] = Query(None, alias="from", description="Only rows at or after this time"),
+        until: Optional[datetime.datetime] = Query(None, alias="to", description="Only rows at or before this time"),
+        limit: Optional[int] = Query(None, ge=1, description=f"Page size (max {HISTORY_MAX_PAGE_SIZE})"),
+    ):
+        if after and before:
+            raise HTTPException(status_code=400, detail="Use either 'after' or 'before', not both")
+        self.after = _decode_timestamp_cursor(after) if after else None
+        self.before = _decode_timestamp_cursor(before) if before else None
+        self.since = since
+        self.until = until
+        self.limit = min(limit or HISTORY_DEFAULT_PAGE_SIZE, HISTORY_MAX_PAGE_SIZE)
+        self.from_end = False
+
+    @property
+    def backward(self):
+        return self.before is not None
+
+    def apply(self, query, ts_col, id_col, newest_first: bool = False):
+        """Add the window, cursor, ORDER BY and LIMIT (one extra row to detect more pages)."""
+        if self.since is not None:
+            query = query.filter(ts_col >= self.since)
+        if self.until is not None:
+            query = query.filter(ts_col <= self.until)
+
+        keys = [ts_col, id_col]
+        # "later in the natural order" is larger keys for oldest-first lists, smaller for newest-first
+        if self.after is not None:
+            query = query.filter(before(keys, self.after) if newest_first else after(keys, self.after))
+        if self.before is not None:
+            query = query.filter(after(keys, self.before) if newest_first else before(keys, self.before))
+
+        # an oldest-first list without a cursor starts at its newest rows
+        self.from_end = not newest_first and self.after is None and self.before is None
+        # a backward page is read in reverse and flipped back in page()
+        descending = newest_first != (self.backward or self.from_end)
+        order = [ts_col.desc(), id_col.desc()] if descending else [ts_col.asc(), id_col.asc()]
+        return query.order_by(*order).limit(self.limit + 1)
+
+    def page(self, rows, response: Response, ts_attr: str = "recorded_at"):
+        """Trim the probe row, restore natural order and set X-Next-Cursor / X-Prev-Cursor."""
+        rows = list(rows)
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        backward = self.backward or self.from_end
+        if backward:
+            rows.reverse()
+        if not rows:
+            return rows
+
+        # a `before` page always has rows after it; the page at the end has none
+        more_after = has_more if not backward else not self.from_end
+        more_before = has_more if backward else self.after is not None
+        if more_after:
+            response.headers["X-Next-Cursor"] = _timestamp_cursor(rows[-1], ts_attr)
+        if more_before:
+            response.headers["X-Prev-Cursor"] = _timestamp_cursor(rows[0], ts_attr)
+        return rows
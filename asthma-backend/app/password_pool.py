@@ -0,0 +1,187 @@
+# asthma-backend/password_pool.py
+"""
+bcrypt hashing and verification on a bounded process pool.
+
+A bcrypt call costs 100-300 ms of CPU. Run inline it holds a request thread and the GIL
+for that long, so a burst of logins (every client after an app release) stalled unrelated
+endpoints. Password work now goes to PASSWORD_POOL_WORKERS processes instead; the calling
+thread (or, for the async login, the event loop) just waits for the result.
+
+At most PASSWORD_POOL_MAX_PENDING calls may be queued or running. Beyond that a call is
+refused at once with 503 and Retry-After, instead of queueing behind minutes of bcrypt work.
+
+New hashes use BCRYPT_ROUNDS (cost factor 2^rounds). After a successful login a hash with a
+different cost is replaced (needs_update / the rehash in /auth/login), so changing the cost
+migrates users as they log in.
+
+stats (/admin/password-pool-stats) counts hashes, verifications, rejections, rehashes and
+logins, with the login rate over the last LOGIN_RATE_WINDOW_SECONDS.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+
+from fastapi import HTTPException, status
+from passlib.context import CryptContext
+
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", str(os.cpu_count() or 1)))
+PASSWORD_POOL_MAX_PENDING = int(os.getenv("PASSWORD_POOL_MAX_PENDING", "64"))
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+LOGIN_RATE_WINDOW_SECONDS = 60
+
+context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+stats = {"hashes": 0, "verifies": 0, "rejected": 0, "rehashed": 0, "logins": 0, "failed_logins": 0,
+         "max_pending": 0, "busy_seconds": 0.0}
+
+_executor = None
+_lock = threading.Lock()
+_pending = 0
+_logins = collections.deque()
+
+
+# ------------------------------------------------------------
+# Worker side (runs in the pool processes)
+# ------------------------------------------------------------
+
+def _timed(fn, *args):
+    started = time.perf_counter()
+    return fn(*args), time.perf_counter() - started
+
+
+def _noop():
+    return None
+
+
+def _hash(password: str):
+    return _timed(context.hash, password)
+
+
+def _verify(password: str, hashed: str):
+    return _timed(context.verify, password, hashed)
+
+
+# ------------------------------------------------------------
+# Caller side
+# ------------------------------------------------------------
+
+def start():
+    """Create the pool and warm it with one no-op per worker, so the first logins don't wait
+    for process startup (ProcessPoolExecutor only starts workers when work is submitted).
+
+    Workers come from a forkserver (spawn where there is none), not a fork of this process:
+    by startup it already runs threads, and a forked child inherits their locks as they were.
+    """
+    global _executor
+    with _lock:
+        if _executor is not None:
+            return _executor
+        methods = multiprocessing.get_all_start_methods()
+        mp_context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        _executor = concurrent.futures.ProcessPoolExecutor(max_workers=PASSWORD_POOL_WORKERS, mp_context=mp_context)
+        executor = _executor
+    concurrent.futures.wait([executor.submit(_noop) for _ in range(PASSWORD_POOL_WORKERS)])
+    return executor
+
+
+def stop():
+    global _executor
+    with _lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def pending() -> int:
+    return _pending
+
+
+def _done(future):
+    global _pending
+    with _lock:
+        _pending -= 1
+    if not future.cancelled() and future.exception() is None:
+        stats["busy_seconds"] += future.result()[1]
+
+
+def _submit(fn, *args) -> concurrent.futures.Future:
+    global _pending
+    executor = _executor or start()
+    with _lock:
+        if _pending >= PASSWORD_POOL_MAX_PENDING:
+            stats["rejected"] += 1
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many concurrent sign-ins, please retry shortly",
+                headers={"Retry-After": "1"},
+            )
+        _pending += 1
+        stats["max_pending"] = max(stats["max_pending"], _pending)
+    future = executor.submit(fn, *args)
+    future.add_done_callback(_done)
+    return future
+
+
+def _count(future, stat: str):
+    stats[stat] += 1
+    return future
+
+
+def hash_password(password: str) -> str:
+    return _count(_submit(_hash, password), "hashes").result()[0]
+
+
+def verify_password(password: str, hashed: str) -> bool:
+    return _count(_submit(_verify, password, hashed), "verifies").result()[0]
+
+
+async def hash_password_async(password: str) -> str:
+    return (await asyncio.wrap_future(_count(_submit(_hash, password), "hashes")))[0]
+
+
+async def verify_password_async(password: str, hashed: str) -> bool:
+    return (await asyncio.wrap_future(_count(_submit(_verify, password, hashed), "verifies")))[0]
+
+
+def needs_update(hashed: str) -> bool:
+    """True if `hashed` was made with another cost (or scheme) than new hashes get."""
+    return context.needs_update(hashed)
+
+
+# ------------------------------------------------------------
+# Login metrics
+# ------------------------------------------------------------
+
+def record_login(success: bool, rehashed: bool = False):
+    if not success:
+        stats["failed_logins"] += 1
+        return
+    stats["logins"] += 1
+    if rehashed:
+        stats["rehashed"] += 1
+    now = time.monotonic()
+    with _lock:
+        _logins.append(now)
+        while _logins and _logins[0] < now - LOGIN_RATE_WINDOW_SECONDS:
+            _logins.popleft()
+
+
+def summary() -> dict:
+    now = time.monotonic()
+    with _lock:
+        while _logins and _logins[0] < now - LOGIN_RATE_WINDOW_SECONDS:
+            _logins.popleft()
+        recent = len(_logins)
+    return {
+        "workers": PASSWORD_POOL_WORKERS,
+        "bcrypt_rounds": BCRYPT_ROUNDS,
+        "pending": _pending,
+        "max_pending_allowed": PASSWORD_POOL_MAX_PENDING,
+        "logins_per_second": round(recent / LOGIN_RATE_WINDOW_SECONDS, 2),
+        **stats,
+    }
@@ -0,0 +1,264 @@
+# asthma-backend/push.py
+"""
+Durable push delivery through the `push_outbox` table.
+
+Write paths call enqueue() next to the Notification they create, so the push is committed
+in the same transaction and a request never waits for FCM. A dispatcher in the API process
+drains the outbox in batches:
+
+  1. claim up to PUSH_BATCH_SIZE due rows with one UPDATE ... RETURNING that pushes their
+     next_attempt_at PUSH_LEASE_SECONDS ahead (a lease: other processes skip them, and a
+     crash mid-send just lets the lease run out);
+  2. look up the recipients' active devices with one query and send every row of the
+     batch concurrently through the asyncio FCM client (app.fcm, which caps requests in
+     flight at FCM_CONCURRENCY);
+  3. in one transaction: deactivate tokens FCM reports as dead, delete delivered rows and
+     reschedule the rest with exponential backoff (PUSH_BACKOFF_BASE_SECONDS * 2^attempts,
+     capped, with jitter). A retry only targets the devices that failed; after
+     PUSH_MAX_ATTEMPTS the push is dropped. The push logs go to the buffered
+     delivery-log writer (app.delivery_log).
+
+The dispatcher wakes up right after a commit that enqueued something, and otherwise polls
+every PUSH_POLL_SECONDS, so pushes left by a restart or by another process are picked up.
+`python -m app.push` drains the outbox once by hand.
+"""
+
+import asyncio
+import datetime
+import json
+import os
+import random
+
+from sqlalchemy import DateTime, bindparam, event, text, update
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from app import delivery_log, fcm, models
+
+PUSH_BATCH_SIZE = int(os.getenv("PUSH_BATCH_SIZE", "100"))
+PUSH_POLL_SECONDS = float(os.getenv("PUSH_POLL_SECONDS", "5"))
+PUSH_LEASE_SECONDS = float(os.getenv("PUSH_LEASE_SECONDS", "120"))
+PUSH_MAX_ATTEMPTS = int(os.getenv("PUSH_MAX_ATTEMPTS", "8"))
+PUSH_BACKOFF_BASE_SECONDS = float(os.getenv("PUSH_BACKOFF_BASE_SECONDS", "2"))
+PUSH_BACKOFF_MAX_SECONDS = float(os.getenv("PUSH_BACKOFF_MAX_SECONDS", "3600"))
+
+_CLAIM = text(
+    "UPDATE push_outbox SET next_attempt_at = :lease WHERE id IN ("
+    "SELECT id FROM push_outbox WHERE next_attempt_at <= :now ORDER BY next_attempt_at LIMIT :batch_size) "
+    "RETURNING id, owner_id, title, body, data, tokens, attempts"
+).bindparams(bindparam("lease", type_=DateTime), bindparam("now", type_=DateTime))
+
+stats = {"sent": 0, "failed": 0, "retried": 0, "dropped": 0, "dead_tokens": 0, "batches": 0}
+
+_task = None
+_loop = None
+_wakeup = None
+
+
+# ------------------------------------------------------------
+# Enqueueing (request side)
+# ------------------------------------------------------------
+
+def enqueue(session: Session, owner_id: int, title: str, body: str, data: dict = None):
+    """Queue a push to every active device of `owner_id`; sent after the transaction commits."""
+    row = models.PushOutbox(
+        owner_id=owner_id, title=title, body=body,
+        data=json.dumps({k: str(v) for k, v in (data or {}).items()}),
+        next_attempt_at=datetime.datetime.utcnow(),
+    )
+    session.add(row)
+    session.info["push_enqueued"] = True
+    return row
+
+
+def wake():
+    """Let the dispatcher know there is work. Safe to call from any thread."""
+    if _loop is not None and _wakeup is not None and not _loop.is_closed():
+        _loop.call_soon_threadsafe(_wakeup.set)
+
+
+@event.listens_for(Session, "after_commit")
+def _wake_after_commit(session: Session):
+    if session.info.pop("push_enqueued", False):
+        wake()
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _forget_on_rollback(session: Session, previous_transaction):
+    if previous_transaction.parent is None:
+        session.info.pop("push_enqueued", None)
+
+
+# ------------------------------------------------------------
+# Dispatching
+# ------------------------------------------------------------
+
+def _backoff(attempts: int) -> datetime.timedelta:
+    delay = min(PUSH_BACKOFF_BASE_SECONDS * (2 ** attempts), PUSH_BACKOFF_MAX_SECONDS)
+    return datetime.timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+async def _send(client: fcm.FCMClient, row, tokens):
+    try:
+        return await client.send(tokens, row.title, row.body, json.loads(row.data or "{}"))
+    except Exception as e:
+        # e.g. the access token could not be minted: retry the whole push
+        return {"success": 0, "failure": len(tokens), "error": str(e)}
+
+
+def _outcome(row, tokens, res):
+    """Split a send result into (log rows, dead tokens, tokens to retry, error)."""
+    logs, dead, retry = [], [], []
+    responses = res.get("responses") or []
+    for r in responses:
+        error = r.get("error")
+        logs.append({"owner_id": row.owner_id, "token": r.get("token"), "success": bool(r.get("success")),
+                     "response": str(r.get("response")) if r.get("response") else None,
+                     "error": str(error) if error else None})
+        if not r.get("success"):
+            (dead if r.get("dead") else retry).append(r.get("token"))
+    if res.get("error") and not responses:
+        # the whole request failed (network, auth, quota): try every device again
+        retry = list(tokens)
+    error = res.get("error") or next((log["error"] for log in logs if log["token"] in retry), None)
+    return logs, dead, retry, error
+
+
+def _claim(engine, now: datetime.datetime, batch_size: int):
+    """Lease a batch of due rows; returns them with the active tokens of their recipients."""
+    with engine.begin() as conn:
+        rows = conn.execute(_CLAIM, {
+            "now": now, "lease": now + datetime.timedelta(seconds=PUSH_LEASE_SECONDS), "batch_size": batch_size,
+        }).all()
+        if not rows:
+            return rows, {}
+        owner_ids = {row.owner_id for row in rows}
+        devices = {}
+        for owner_id, token in conn.execute(
+            text("SELECT owner_id, token FROM devices WHERE active = 1 AND owner_id IN :owners")
+            .bindparams(bindparam("owners", expanding=True)),
+            {"owners": list(owner_ids)},
+        ):
+            devices.setdefault(owner_id, []).append(token)
+    return rows, devices
+
+
+def _finish(engine, dead, done, retries):
+    with engine.begin() as conn:
+        if dead:
+            conn.execute(update(models.Device).where(models.Device.token.in_(dead)).values(active=False))
+        if done:
+            conn.execute(
+                text("DELETE FROM push_outbox WHERE id IN :ids").bindparams(bindparam("ids", expanding=True)),
+                {"ids": done},
+            )
+        if retries:
+            conn.execute(
+                update(models.PushOutbox).where(models.PushOutbox.id == bindparam("row_id")).values(
+                    attempts=bindparam("attempts"), tokens=bindparam("tokens"),
+                    next_attempt_at=bindparam("next_attempt_at"), last_error=bindparam("last_error"),
+                ),
+                retries,
+            )
+
+
+async def dispatch_once(engine, client: fcm.FCMClient = None, batch_size: int = PUSH_BATCH_SIZE):
+    """Claim and send one batch of due pushes. Returns the number of outbox rows handled."""
+    client = client or fcm.get_client()
+    now = datetime.datetime.utcnow()
+    rows, devices = await run_in_threadpool(_claim, engine, now, batch_size)
+    if not rows:
+        return 0
+
+    jobs, done = [], []
+    for row in rows:
+        active = devices.get(row.owner_id, [])
+        tokens = [t for t in json.loads(row.tokens) if t in active] if row.tokens else active
+        if tokens:
+            jobs.append((row, tokens))
+        else:
+            done.append(row.id)
+
+    results = await asyncio.gather(*(_send(client, row, tokens) for row, tokens in jobs))
+
+    logs, dead, retries = [], [], []
+    for (row, tokens), res in zip(jobs, results):
+        row_logs, row_dead, row_retry, error = _outcome(row, tokens, res)
+        logs += row_logs
+        dead += row_dead
+        stats["sent"] += len(tokens) - len(row_dead) - len(row_retry)
+        stats["failed"] += len(row_dead) + len(row_retry)
+        if not row_retry:
+            done.append(row.id)
+        elif row.attempts + 1 >= PUSH_MAX_ATTEMPTS:
+            print(f"[push] Dropping push {row.id} to user {row.owner_id} after {row.attempts + 1} attempts: {error}")
+            stats["dropped"] += 1
+            done.append(row.id)
+        else:
+            stats["retried"] += 1
+            retries.append({"row_id": row.id, "attempts": row.attempts + 1, "tokens": json.dumps(row_retry),
+                            "next_attempt_at": now + _backoff(row.attempts), "last_error": error})
+
+    await run_in_threadpool(_finish, engine, dead, done, retries)
+    delivery_log.add_many(models.PushLog, logs)
+    stats["dead_tokens"] += len(dead)
+    stats["batches"] += 1
+    return len(rows)
+
+
+def pending(engine) -> int:
+    with engine.connect() as conn:
+        return conn.execute(text("SELECT count(*) FROM push_outbox")).scalar()
+
+
+async def _run(engine):
+    while True:
+        _wakeup.clear()
+        try:
+            handled = await dispatch_once(engine)
+        except Exception as e:
+            print(f"[push] Dispatch failed: {e}")
+            handled = 0
+        if handled >= PUSH_BATCH_SIZE:
+            continue  # more waiting
+        try:
+            await asyncio.wait_for(_wakeup.wait(), PUSH_POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+
+
+def start(engine):
+    global _task, _loop, _wakeup
+    if _task is None:
+        _loop = asyncio.get_running_loop()
+        _wakeup = asyncio.Event()
+        _task = _loop.create_task(_run(engine))
+
+
+async def stop():
+    global _task, _loop
+    if _task is not None:
+        _task.cancel()
+        _task = None
+    _loop = None
+    await fcm.close()
+
+
+async def _drain(engine):
+    total = 0
+    try:
+        while True:
+            handled = await dispatch_once(engine)
+            total += handled
+            if handled < PUSH_BATCH_SIZE:
+                return total
+    finally:
+        await fcm.close()
+
+
+if __name__ == "__main__":
+    from app.database import engine
+
+    total = asyncio.run(_drain(engine))
+    delivery_log.flush(engine)
+    print(f"Dispatched {total} queued pushes ({pending(engine)} still pending or backing off)")
@@ -0,0 +1,217 @@
+# asthma-backend/realtime.py
+"""
+In-process pub/sub hub behind the realtime endpoints (SSE at /events, WebSocket at /ws).
+
+Every committed Notification is published to its owner ("notification" event) and every
+committed patient_summary change to the patient's linked doctors ("dashboard" event). Both
+are picked up by Session flush/commit hooks, like the change log, so record_pefr,
+prescribe_medication, update_medication_status, take_medication and any other write path
+publish without extra code. Events from a rolled-back transaction or savepoint are dropped.
+
+Each connection is one bounded asyncio.Queue. A slow client never blocks publishers: when
+its queue is full the oldest event is dropped and the client gets an "overflow" event,
+after which it should catch up through /sync. Idle connections only exchange a heartbeat
+every REALTIME_HEARTBEAT_SECONDS and hold no database connection.
+
+The hub is per process: with several workers a client only hears events committed by
+the worker it is connected to.
+"""
+
+import asyncio
+import json
+import os
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from app import identity_cache, models, schemas
+
+REALTIME_QUEUE_SIZE = int(os.getenv("REALTIME_QUEUE_SIZE", "100"))
+REALTIME_HEARTBEAT_SECONDS = float(os.getenv("REALTIME_HEARTBEAT_SECONDS", "25"))
+
+OVERFLOW = {"type": "overflow", "data": {"detail": "Events were dropped; sync to catch up"}}
+
+
+class Subscriber:
+    """One connected client. Only touched from its event loop's thread."""
+
+    def __init__(self, user_id: int, loop, size: int = REALTIME_QUEUE_SIZE):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=size)
+        self.overflowed = False
+        self.dropped = 0
+
+    def put(self, evt):
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.overflowed = True
+        self.queue.put_nowait(evt)
+
+    async def next(self, timeout: float = REALTIME_HEARTBEAT_SECONDS):
+        """The next event, or None when `timeout` passes without one (time for a heartbeat)."""
+        if self.overflowed:
+            self.overflowed = False
+            return OVERFLOW
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class Hub:
+    def __init__(self):
+        self._subscribers = defaultdict(set)
+        self._lock = threading.Lock()
+        self.stats = {"published": 0, "delivered": 0, "dropped": 0}
+
+    @property
+    def connections(self):
+        with self._lock:
+            return sum(len(subs) for subs in self._subscribers.values())
+
+    def has_subscribers(self):
+        return bool(self._subscribers)
+
+    def subscribe(self, user_id: int) -> Subscriber:
+        sub = Subscriber(user_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers[user_id].add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscriber):
+        with self._lock:
+            subs = self._subscribers.get(sub.user_id)
+            if subs is not None:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.user_id]
+        self.stats["dropped"] += sub.dropped
+
+    def publish(self, user_id: int, evt: dict):
+        """Queue `evt` for every connection of `user_id`. Safe to call from any thread."""
+        self.stats["published"] += 1
+        with self._lock:
+            subs = list(self._subscribers.get(user_id, ()))
+        try:
+            current = asyncio.get_running_loop()
+        except RuntimeError:
+            current = None
+        for sub in subs:
+            try:
+                if sub.loop is current:
+                    sub.put(evt)
+                else:
+                    sub.loop.call_soon_threadsafe(sub.put, evt)
+                self.stats["delivered"] += 1
+            except RuntimeError:
+                # loop already closed: the connection is going away
+                pass
+
+
+hub = Hub()
+
+
+# ------------------------------------------------------------
+# Session hooks: collect events on flush, publish on commit
+# ------------------------------------------------------------
+
+def _pending(session: Session):
+    return session.info.setdefault("realtime_events", [])
+
+
+def _innermost_transaction(session: Session):
+    return session.get_nested_transaction() or session.get_transaction()
+
+
+def _dashboard_event(session: Session, row: models.PatientSummary):
+    doctor_ids = identity_cache.linked_doctor_ids(session.connection(), row.patient_id)
+    data = schemas.PatientSummary.model_validate(row).model_dump(mode="json")
+    data["patient_id"] = row.patient_id
+    return [(doctor_id, {"type": "dashboard", "data": data}) for doctor_id in doctor_ids]
+
+
+@event.listens_for(Session, "after_flush")
+def _collect_events(session: Session, flush_context):
+    if not hub.has_subscribers():
+        return
+    events = []
+    for obj in session.new:
+        if isinstance(obj, models.Notification):
+            data = schemas.Notification.model_validate(obj).model_dump(mode="json")
+            events.append((obj.owner_id, {"type": "notification", "data": data}))
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, models.PatientSummary) and session.is_modified(obj, include_collections=False):
+            events.extend(_dashboard_event(session, obj))
+    if events:
+        transaction = _innermost_transaction(session)
+        _pending(session).extend((transaction, user_id, evt) for user_id, evt in events)
+
+
+@event.listens_for(Session, "after_soft_rollback")
+def _discard_events(session: Session, previous_transaction):
+    pending = session.info.get("realtime_events")
+    if not pending:
+        return
+
+    def rolled_back(transaction):
+        while transaction is not None:
+            if transaction is previous_transaction:
+                return True
+            transaction = transaction.parent
+        return False
+
+    pending[:] = [item for item in pending if not rolled_back(item[0])]
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_events(session: Session):
+    pending = session.info.pop("realtime_events", None)
+    for _, user_id, evt in pending or ():
+        hub.publish(user_id, evt)
+
+
+# ------------------------------------------------------------
+# Transports
+# ------------------------------------------------------------
+
+async def sse_stream(sub: Subscriber):
+    """Server-Sent Events body for a subscriber; heartbeats are SSE comments."""
+    try:
+        yield "retry: 5000\n: connected\n\n"
+        while True:
+            evt = await sub.next()
+            if evt is None:
+                yield ": ping\n\n"
+            else:
+                yield f"event: {evt['type']}\ndata: {json.dumps(evt['data'], separators=(',', ':'))}\n\n"
+    finally:
+        hub.unsubscribe(sub)
+
+
+async def serve_websocket(websocket, user_id: int):
+    """Pump events to an accepted WebSocket until the client goes away."""
+    sub = hub.subscribe(user_id)
+
+    async def send_events():
+        while True:
+            evt = await sub.next()
+            await websocket.send_json(evt if evt is not None else {"type": "ping"})
+
+    async def wait_for_close():
+        # clients don't need to send anything; receiving just notices the disconnect
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+
+    tasks = [asyncio.ensure_future(send_events()), asyncio.ensure_future(wait_for_close())]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        hub.unsubscribe(sub)
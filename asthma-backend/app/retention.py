@@ -0,0 +1,163 @@
+# asthma-backend/retention.py
+"""
+Retention for notifications, idempotency keys and the sync change log.
+
+Doctors with many patients get notified about readings and medication changes all day
+(merged into digests, but still), so their notifications pile up. Read notifications older than NOTIFICATION_RETENTION_DAYS
+are deleted in small batches (one short write transaction each) using the partial index
+ix_notifications_read_created. Unread notifications are never touched.
+
+The API runs the job every NOTIFICATION_RETENTION_INTERVAL_HOURS in the background; it can
+also be run by hand with `python -m app.retention`. Each batch writes /sync tombstones for
+the rows it deletes (app.changelog), in the same transaction.
+
+The same job deletes stored Idempotency-Key responses older than IDEMPOTENCY_TTL_HOURS,
+expired refresh tokens and change_log rows older than CHANGE_LOG_RETENTION_DAYS (oldest
+first, keeping the newest row; /sync sends a full snapshot to tokens older than what is
+left), and moves audit partitions older than AUDIT_HOT_MONTHS to their archive files
+(app.audit_store).
+"""
+
+import asyncio
+import datetime
+import os
+
+from sqlalchemy import DateTime, bindparam, text
+from starlette.concurrency import run_in_threadpool
+
+from app import audit_store, changelog, models
+from app.changelog import CHANGE_LOG_RETENTION_DAYS
+from app.idempotency import IDEMPOTENCY_TTL_HOURS
+
+NOTIFICATION_RETENTION_DAYS = int(os.getenv("NOTIFICATION_RETENTION_DAYS", "90"))
+NOTIFICATION_RETENTION_INTERVAL_HOURS = float(os.getenv("NOTIFICATION_RETENTION_INTERVAL_HOURS", "6"))
+NOTIFICATION_RETENTION_BATCH = int(os.getenv("NOTIFICATION_RETENTION_BATCH", "500"))
+
+_OLD_READ_NOTIFICATIONS = text(
+    "SELECT id, owner_id FROM notifications WHERE read = 1 AND created_at < :cutoff LIMIT :batch_size"
+).bindparams(bindparam("cutoff", type_=DateTime))
+
+_DELETE_NOTIFICATIONS = text("DELETE FROM notifications WHERE id IN :ids").bindparams(
+    bindparam("ids", expanding=True))
+
+_PURGE_IDEMPOTENCY_KEYS = text(
+    "DELETE FROM idempotency_keys WHERE key IN ("
+    "SELECT key FROM idempotency_keys WHERE created_at < :cutoff LIMIT :batch_size)"
+).bindparams(bindparam("cutoff", type_=DateTime))
+
+_PURGE_REFRESH_TOKENS = text(
+    "DELETE FROM refresh_tokens WHERE token_hash IN ("
+    "SELECT token_hash FROM refresh_tokens WHERE expires_at < :cutoff LIMIT :batch_size)"
+).bindparams(bindparam("cutoff", type_=DateTime))
+
+# the change log is pruned as a prefix of ids, so every token from :stop on stays complete
+_CHANGE_LOG_STOP = text(
+    "SELECT COALESCE((SELECT id FROM change_log WHERE changed_at >= :cutoff ORDER BY id LIMIT 1), "
+    "(SELECT MAX(id) FROM change_log))"
+).bindparams(bindparam("cutoff", type_=DateTime))
+
+_PURGE_CHANGE_LOG = text(
+    "DELETE FROM change_log WHERE id IN ("
+    "SELECT id FROM change_log WHERE id < :stop ORDER BY id LIMIT :batch_size)"
+)
+
+_task = None
+
+
+def _purge(engine, statement, batch_size: int, **params):
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            res = conn.execute(statement, {"batch_size": batch_size, **params})
+        if not res.rowcount or res.rowcount <= 0:
+            return total
+        total += res.rowcount
+
+
+def purge_read_notifications(engine, days: int = NOTIFICATION_RETENTION_DAYS,
+                             batch_size: int = NOTIFICATION_RETENTION_BATCH):
+    """Delete read notifications older than `days`, with their tombstones. Returns the number deleted."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    total = 0
+    while True:
+        with engine.begin() as conn:
+            rows = conn.execute(_OLD_READ_NOTIFICATIONS, {"cutoff": cutoff, "batch_size": batch_size}).all()
+            if rows:
+                conn.execute(_DELETE_NOTIFICATIONS, {"ids": [row.id for row in rows]})
+                changelog.record_deleted(conn, models.Notification, [(row.id, row.owner_id) for row in rows])
+        if not rows:
+            return total
+        total += len(rows)
+
+
+def purge_idempotency_keys(engine, hours: float = IDEMPOTENCY_TTL_HOURS,
+                           batch_size: int = NOTIFICATION_RETENTION_BATCH):
+    """Delete stored Idempotency-Key responses older than `hours`."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+    return _purge(engine, _PURGE_IDEMPOTENCY_KEYS, batch_size, cutoff=cutoff)
+
+
+def purge_refresh_tokens(engine, batch_size: int = NOTIFICATION_RETENTION_BATCH):
+    """Delete expired refresh tokens (used ones included)."""
+    return _purge(engine, _PURGE_REFRESH_TOKENS, batch_size, cutoff=datetime.datetime.utcnow())
+
+
+def purge_change_log(engine, days: int = CHANGE_LOG_RETENTION_DAYS,
+                     batch_size: int = NOTIFICATION_RETENTION_BATCH):
+    """Delete change_log rows older than `days`, oldest first, always keeping the newest row."""
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    with engine.connect() as conn:
+        stop = conn.execute(_CHANGE_LOG_STOP, {"cutoff": cutoff}).scalar()
+    if stop is None:
+        return 0
+    return _purge(engine, _PURGE_CHANGE_LOG, batch_size, stop=stop)
+
+
+async def _loop(engine):
+    while True:
+        try:
+            deleted = await run_in_threadpool(purge_read_notifications, engine)
+            if deleted:
+                print(f"[retention] Deleted {deleted} read notifications older than {NOTIFICATION_RETENTION_DAYS} days")
+        except Exception as e:
+            print(f"[retention] Notification purge failed: {e}")
+        try:
+            await run_in_threadpool(purge_idempotency_keys, engine)
+        except Exception as e:
+            print(f"[retention] Idempotency key purge failed: {e}")
+        try:
+            await run_in_threadpool(purge_refresh_tokens, engine)
+        except Exception as e:
+            print(f"[retention] Refresh token purge failed: {e}")
+        try:
+            await run_in_threadpool(purge_change_log, engine)
+        except Exception as e:
+            print(f"[retention] Change log purge failed: {e}")
+        try:
+            await run_in_threadpool(audit_store.archive_old, engine)
+        except Exception as e:
+            print(f"[retention] Audit partition archive failed: {e}")
+        await asyncio.sleep(NOTIFICATION_RETENTION_INTERVAL_HOURS * 3600)
+
+
+def start(engine):
+    global _task
+    if NOTIFICATION_RETENTION_INTERVAL_HOURS > 0 and _task is None:
+        _task = asyncio.get_running_loop().create_task(_loop(engine))
+
+
+def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        _task = None
+
+
+if __name__ == "__main__":
+    from app.database import engine
+
+    print(f"Deleted {purge_read_notifications(engine)} read notifications")
+    print(f"Deleted {purge_idempotency_keys(engine)} expired idempotency keys")
+    print(f"Deleted {purge_refresh_tokens(engine)} expired refresh tokens")
+    print(f"Deleted {purge_change_log(engine)} old change log rows")
+    print(f"Archived audit partitions: {audit_store.archive_old(engine) or 'none'}")
@@ -0,0 +1,161 @@
+# asthma-backend/rollup.py
+"""
+Maintenance of the `pefr_daily_rollup` table (one row per patient per local day).
+
+add_readings() / add_values() fold new readings into their days with one INSERT ... ON
+CONFLICT DO UPDATE per day, in the same transaction as the readings themselves. rebuild()
+recomputes rows from pefr_records with an INSERT ... SELECT ... GROUP BY. It backs the
+backfill migration and `python -m app.rollup`, and has to be rerun after changing
+PEFR_ROLLUP_TZ_OFFSET_MINUTES.
+
+Days are local to PEFR_ROLLUP_TZ_OFFSET_MINUTES (the clinic's time zone). Readings before
+PEFR_MORNING_CUTOFF_HOUR local time count as morning readings.
+"""
+
+import datetime
+import os
+
+from sqlalchemy import case, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from app import models
+
+PEFR_ROLLUP_TZ_OFFSET_MINUTES = int(os.getenv("PEFR_ROLLUP_TZ_OFFSET_MINUTES", "0"))
+PEFR_MORNING_CUTOFF_HOUR = int(os.getenv("PEFR_MORNING_CUTOFF_HOUR", "12"))
+
+R = models.PEFRDailyRollup
+
+
+def local_time(ts: datetime.datetime, offset_minutes: int = PEFR_ROLLUP_TZ_OFFSET_MINUTES):
+    return ts + datetime.timedelta(minutes=offset_minutes)
+
+
+def _row(owner_id: int, recorded_at: datetime.datetime, value: int, zone: str):
+    local = local_time(recorded_at)
+    morning = local.hour < PEFR_MORNING_CUTOFF_HOUR
+    return {
+        "owner_id": owner_id, "day": local.date(),
+        "count": 1, "sum": value, "sum_sq": value * value, "min": value, "max": value,
+        "first_at": recorded_at, "first_value": value, "last_at": recorded_at, "last_value": value,
+        "red": int(zone == "Red"), "yellow": int(zone == "Yellow"), "green": int(zone == "Green"),
+        "morning_sum": value if morning else 0, "morning_count": int(morning),
+    }
+
+
+def _upsert_statement():
+    stmt = sqlite_insert(R)
+    new = stmt.excluded
+    return stmt.on_conflict_do_update(
+        index_elements=[R.owner_id, R.day],
+        set_={
+            "count": R.count + new["count"],
+            "sum": R.sum + new.sum,
+            "sum_sq": R.sum_sq + new.sum_sq,
+            "min": func.min(R.min, new.min),
+            "max": func.max(R.max, new.max),
+            # back-dated readings may land before the current first reading
+            "first_value": case((new.first_at < R.first_at, new.first_value), else_=R.first_value),
+            "first_at": func.min(R.first_at, new.first_at),
+            "last_value": case((new.last_at >= R.last_at, new.last_value), else_=R.last_value),
+            "last_at": func.max(R.last_at, new.last_at),
+            "red": R.red + new.red,
+            "yellow": R.yellow + new.yellow,
+            "green": R.green + new.green,
+            "morning_sum": R.morning_sum + new.morning_sum,
+            "morning_count": R.morning_count + new.morning_count,
+        },
+    )
+
+
+def _merge(into: dict, row: dict):
+    """Combine two rows of the same day, the way the upsert does."""
+    for name in ("count", "sum", "sum_sq", "red", "yellow", "green", "morning_sum", "morning_count"):
+        into[name] += row[name]
+    into["min"], into["max"] = min(into["min"], row["min"]), max(into["max"], row["max"])
+    if row["first_at"] < into["first_at"]:
+        into["first_at"], into["first_value"] = row["first_at"], row["first_value"]
+    if row["last_at"] >= into["last_at"]:
+        into["last_at"], into["last_value"] = row["last_at"], row["last_value"]
+
+
+def add_values(session: Session, readings):
+    """Fold (owner_id, recorded_at, pefr_value, zone) tuples into the rollup.
+    Readings of the same day are combined first, so a batch costs one upsert per day."""
+    days = {}
+    for owner_id, recorded_at, value, zone in readings:
+        row = _row(owner_id, recorded_at, value, zone)
+        key = (owner_id, row["day"])
+        if key in days:
+            _merge(days[key], row)
+        else:
+            days[key] = row
+    if days:
+        session.execute(_upsert_statement(), list(days.values()))
+
+
+def add_readings(session: Session, records):
+    """Fold PEFRRecord rows into the rollup. Call after flush so recorded_at is set."""
+    add_values(session, [(r.owner_id, r.recorded_at, r.pefr_value, r.zone) for r in records])
+
+
+def add_reading(session: Session, record: models.PEFRRecord):
+    add_readings(session, [record])
+
+
+# ------------------------------------------------------------
+# Rebuild from history
+# ------------------------------------------------------------
+
+_REBUILD = """
+INSERT INTO pefr_daily_rollup (owner_id, day, count, sum, sum_sq, min, max, first_at, last_at,
+                               red, yellow, green, morning_sum, morning_count)
+SELECT owner_id, date(recorded_at, :offset) AS day,
+       count(*), sum(pefr_value), sum(pefr_value * pefr_value), min(pefr_value), max(pefr_value),
+       min(recorded_at), max(recorded_at),
+       sum(zone = 'Red'), sum(zone = 'Yellow'), sum(zone = 'Green'),
+       sum(CASE WHEN CAST(strftime('%H', recorded_at, :offset) AS INTEGER) < :cutoff THEN pefr_value ELSE 0 END),
+       sum(CASE WHEN CAST(strftime('%H', recorded_at, :offset) AS INTEGER) < :cutoff THEN 1 ELSE 0 END)
+FROM pefr_records
+WHERE owner_id BETWEEN :lo AND :hi AND recorded_at IS NOT NULL AND pefr_value IS NOT NULL
+GROUP BY owner_id, day
+"""
+
+_FIRST_LAST = """
+UPDATE pefr_daily_rollup SET
+    first_value = (SELECT p.pefr_value FROM pefr_records p
+                   WHERE p.owner_id = pefr_daily_rollup.owner_id AND p.recorded_at = pefr_daily_rollup.first_at
+                   ORDER BY p.id LIMIT 1),
+    last_value = (SELECT p.pefr_value FROM pefr_records p
+                  WHERE p.owner_id = pefr_daily_rollup.owner_id AND p.recorded_at = pefr_daily_rollup.last_at
+                  ORDER BY p.id DESC LIMIT 1)
+WHERE owner_id BETWEEN :lo AND :hi
+"""
+
+
+def rebuild(conn, lo: int, hi: int):
+    """Recompute the rollup rows of patients with lo <= owner_id <= hi."""
+    params = {"lo": lo, "hi": hi, "offset": f"{PEFR_ROLLUP_TZ_OFFSET_MINUTES:+d} minutes",
+              "cutoff": PEFR_MORNING_CUTOFF_HOUR}
+    conn.execute(text("DELETE FROM pefr_daily_rollup WHERE owner_id BETWEEN :lo AND :hi"), params)
+    conn.execute(text(_REBUILD), params)
+    conn.execute(text(_FIRST_LAST), params)
+
+
+def rebuild_all(engine, batch_size: int = 200):
+    """Rebuild every patient's rollup, one short transaction per `batch_size` patients."""
+    with engine.connect() as conn:
+        owner_ids = conn.execute(text(
+            "SELECT DISTINCT owner_id FROM pefr_records WHERE owner_id IS NOT NULL ORDER BY owner_id"
+        )).scalars().all()
+    for i in range(0, len(owner_ids), batch_size):
+        chunk = owner_ids[i:i + batch_size]
+        with engine.begin() as conn:
+            rebuild(conn, chunk[0], chunk[-1])
+    return len(owner_ids)
+
+
+if __name__ == "__main__":
+    from app.database import engine
+
+    print(f"Rebuilt daily PEFR rollup for {rebuild_all(engine)} patients")
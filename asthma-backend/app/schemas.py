@@ -1,7 +1,7 @@
 # asthma-backend/schemas.py
 
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from typing import Optional, List, Dict
 from datetime import datetime
 from app.models import UserRole
 
@@ -148,6 +148,19 @@ class Notification(NotificationBase):
         pass
 
 
+class NotificationMarkRead(BaseModel):
+    ids: Optional[List[int]] = None   # mark these notifications read
+    up_to_id: Optional[int] = None    # or everything with id <= up_to_id (neither: all unread)
+
+
+class AuditLogEntry(BaseModel):
+    id: int                 # unique within its month
+    timestamp: datetime
+    user_id: Optional[int] = None
+    action: str
+    details: dict = {}
+
+
 class EmailLog(BaseModel):
     id: int
     recipient: str
@@ -194,6 +207,7 @@ class PEFRRecord(BaseModel):
     owner_id: int
     percentage: Optional[float] = None
     trend: Optional[str] = None
+    anomaly: Optional[bool] = None
     source: Optional[str] = None
 
     class Config(ConfigBase):
@@ -206,6 +220,47 @@ class PEFRRecordResponse(BaseModel):
     record: PEFRRecord
     percentage: Optional[float] = None
     trend: Optional[str] = None
+    anomaly: bool = False               # reading far outside the patient's recent pattern
+    z_score: Optional[float] = None
+
+
+class PEFRReadingUpload(PEFRRecordCreate):
+    recorded_at: Optional[datetime] = None   # when the reading was taken on the device
+
+
+class PEFRBulkCreate(BaseModel):
+    readings: List[PEFRReadingUpload]
+
+
+class PEFRBulkResponse(BaseModel):
+    accepted: int
+    duplicates: int = 0                 # already stored (same time and value), skipped
+    baseline: Optional[int] = None
+    records: List[PEFRRecord] = []
+
+
+class PEFRBucket(BaseModel):
+    start: datetime                     # bucket start, in the client's local time
+    count: int
+    min: int
+    max: int
+    mean: float
+    std: Optional[float] = None
+    morning_mean: Optional[float] = None
+    evening_mean: Optional[float] = None
+    diurnal_variability: Optional[float] = None   # (max - min) / mean(max, min) * 100
+    percent_of_baseline: Optional[float] = None
+    red: int = 0
+    yellow: int = 0
+    green: int = 0
+
+
+class PEFRAggregate(BaseModel):
+    bucket: str
+    baseline: Optional[int] = None
+    total_buckets: int
+    downsampled: bool = False
+    buckets: List[PEFRBucket] = []
 
 
 # ------------------------------------------------------------
@@ -234,6 +289,32 @@ class Symptom(SymptomCreate):
         pass
 
 
+class SymptomUpload(SymptomCreate):
+    recorded_at: Optional[datetime] = None
+
+
+class SymptomBulkCreate(BaseModel):
+    symptoms: List[SymptomUpload]
+
+
+class SymptomBulkResponse(BaseModel):
+    accepted: int
+    duplicates: int = 0                 # already stored at the same time, skipped
+    records: List[Symptom] = []
+
+
+class PatientSummary(BaseModel):
+    current_zone: Optional[str] = None
+    latest_pefr_value: Optional[int] = None
+    latest_percentage: Optional[float] = None
+    latest_trend: Optional[str] = None
+    last_reading_at: Optional[datetime] = None
+    last_symptom_at: Optional[datetime] = None
+
+    class Config(ConfigBase):
+        pass
+
+
 # ------------------------------------------------------------
 # USER & AUTH SCHEMAS
 # ------------------------------------------------------------
@@ -268,6 +349,8 @@ class User(UserBase):
 
     latest_pefr_record: Optional[PEFRRecord] = None
     latest_symptom: Optional[Symptom] = None
+    # only set on the doctor dashboard
+    summary: Optional[PatientSummary] = None
 
     class Config(ConfigBase):
         pass
@@ -282,6 +365,8 @@ class Token(BaseModel):
     access_token: str
     token_type: str
     user_role: UserRole
+    refresh_token: Optional[str] = None   # AUTH_MODE=claims only
+    expires_in: Optional[int] = None      # seconds, AUTH_MODE=claims only
 
 
 class TokenData(BaseModel):
@@ -305,6 +390,28 @@ class DoctorPatientLink(BaseModel):
         pass
 
 
+# ------------------------------------------------------------
+# DELTA SYNC SCHEMAS
+# ------------------------------------------------------------
+
+class SyncEntities(BaseModel):
+    pefr_records: List[PEFRRecord] = []
+    symptoms: List[Symptom] = []
+    medications: List[Medication] = []
+    medication_status_history: List[MedicationStatusHistory] = []
+    reminders: List[Reminder] = []
+    emergency_contacts: List[EmergencyContact] = []
+    notifications: List[Notification] = []
+
+
+class SyncResponse(BaseModel):
+    token: str                          # pass back as ?since= on the next sync
+    has_more: bool = False              # more changes are pending: sync again right away
+    full: bool = False                  # snapshot of everything (no token, or a pruned one): replace local data
+    upserts: SyncEntities
+    deleted: Dict[str, List[int]] = {}  # tombstones: table name -> ids
+
+
 # ------------------------------------------------------------
 # AUTH / OTP REQUEST SCHEMAS
 # ------------------------------------------------------------
@@ -0,0 +1,159 @@
+# asthma-backend/summary.py
+"""
+Maintenance of the `patient_summary` table (one row per patient).
+
+The write paths call update_after_pefr / update_after_symptom in the same transaction as the
+reading itself, so the doctor dashboard can read zone, latest value, trend and staleness for
+all linked patients with a single indexed query. rebuild() recomputes a row from history and
+is used by the backfill migration and whenever history is deleted.
+
+The dashboard's sort keys (risk_rank, last_reading_epoch) are also copied to the patient's
+doctor_patient_map rows, which carry per-doctor indexes on them: dashboard_query() pages a
+doctor's patients in any sort order without sorting them all for every page.
+"""
+
+import datetime
+
+from sqlalchemy import desc, func, select, update
+from sqlalchemy.orm import Session, sessionmaker
+
+from app import models
+
+RISK_RANK = {"Red": 0, "Yellow": 1, "Green": 2}
+UNKNOWN_RISK = 3
+
+
+def risk_rank(zone: str):
+    return RISK_RANK.get(zone, UNKNOWN_RISK)
+
+
+def epoch(value: datetime.datetime):
+    if value is None:
+        return 0
+    return int(value.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def _get_or_create(session: Session, patient_id: int):
+    row = session.get(models.PatientSummary, patient_id)
+    if row is None:
+        row = models.PatientSummary(patient_id=patient_id, risk_rank=UNKNOWN_RISK, last_reading_epoch=0)
+        session.add(row)
+    return row
+
+
+def _apply_pefr(row: models.PatientSummary, record: models.PEFRRecord):
+    row.current_zone = record.zone
+    row.latest_pefr_id = record.id
+    row.latest_pefr_value = record.pefr_value
+    row.latest_percentage = record.percentage
+    row.latest_trend = record.trend
+    row.last_reading_at = record.recorded_at
+    row.risk_rank = risk_rank(record.zone)
+    row.last_reading_epoch = epoch(record.recorded_at)
+
+
+def _sync_links(session: Session, row: models.PatientSummary):
+    session.execute(
+        update(models.DoctorPatient).where(models.DoctorPatient.patient_id == row.patient_id)
+        .values(risk_rank=row.risk_rank, last_reading_epoch=row.last_reading_epoch)
+        .execution_options(synchronize_session=False)
+    )
+
+
+def update_after_pefr(session: Session, record: models.PEFRRecord):
+    """Call after the record is flushed (needs its id and recorded_at)."""
+    row = _get_or_create(session, record.owner_id)
+    # out-of-order (back-dated) readings don't replace a newer one
+    if row.last_reading_at is None or record.recorded_at >= row.last_reading_at:
+        _apply_pefr(row, record)
+        _sync_links(session, row)
+    return row
+
+
+def update_after_symptom(session: Session, symptom: models.Symptom):
+    """Call after the symptom is flushed (needs its id and recorded_at)."""
+    row = _get_or_create(session, symptom.owner_id)
+    if row.last_symptom_at is None or symptom.recorded_at >= row.last_symptom_at:
+        row.latest_symptom_id = symptom.id
+        row.last_symptom_at = symptom.recorded_at
+    return row
+
+
+def rebuild(session: Session, patient_id: int):
+    """Recompute a patient's row from history (two indexed lookups)."""
+    latest_pefr = session.query(models.PEFRRecord).filter(
+        models.PEFRRecord.owner_id == patient_id
+    ).order_by(desc(models.PEFRRecord.recorded_at)).first()
+    latest_symptom = session.query(models.Symptom).filter(
+        models.Symptom.owner_id == patient_id
+    ).order_by(desc(models.Symptom.recorded_at)).first()
+
+    row = _get_or_create(session, patient_id)
+    if latest_pefr:
+        _apply_pefr(row, latest_pefr)
+    else:
+        row.current_zone = None
+        row.latest_pefr_id = row.latest_pefr_value = row.latest_percentage = row.latest_trend = None
+        row.last_reading_at = None
+        row.risk_rank = UNKNOWN_RISK
+        row.last_reading_epoch = 0
+    row.latest_symptom_id = latest_symptom.id if latest_symptom else None
+    row.last_symptom_at = latest_symptom.recorded_at if latest_symptom else None
+    _sync_links(session, row)
+    return row
+
+
+def link_sort_keys(patient_id: int):
+    """Values for a new doctor_patient_map row, as subqueries so the INSERT reads them itself."""
+    def current(column, default):
+        return func.coalesce(select(column).where(models.PatientSummary.patient_id == patient_id).scalar_subquery(),
+                             default)
+    name = select(models.User.name).where(models.User.id == patient_id).scalar_subquery()
+    return {
+        "risk_rank": current(models.PatientSummary.risk_rank, UNKNOWN_RISK),
+        "last_reading_epoch": current(models.PatientSummary.last_reading_epoch, 0),
+        "patient_name": func.coalesce(name, ""),
+    }
+
+
+def dashboard_sort_keys(sort: str):
+    """Ascending sort keys for the dashboard; the last key (patient id) makes them unique."""
+    link = models.DoctorPatient
+    # staleness: oldest reading first, patients who never recorded first of all
+    if sort == "stale":
+        return [link.last_reading_epoch, link.patient_id]
+    if sort == "name":
+        return [link.patient_name, link.patient_id]
+    return [link.risk_rank, link.last_reading_epoch, link.patient_id]
+
+
+def dashboard_query(doctor_id: int):
+    """(User, PatientSummary or None, DoctorPatient) for every patient linked to `doctor_id`."""
+    return select(models.User, models.PatientSummary, models.DoctorPatient).join(
+        models.DoctorPatient, models.DoctorPatient.patient_id == models.User.id
+    ).outerjoin(
+        models.PatientSummary, models.PatientSummary.patient_id == models.User.id
+    ).filter(models.DoctorPatient.doctor_id == doctor_id)
+
+
+def rebuild_all(engine, batch_size: int = 200):
+    """Backfill every patient with readings, committing one batch of patients at a time."""
+    SessionFactory = sessionmaker(bind=engine, autoflush=False)
+
+    last_id = 0
+    total = 0
+    while True:
+        session = SessionFactory()
+        try:
+            ids = [r[0] for r in session.query(models.User.id).filter(
+                models.User.role == models.UserRole.PATIENT, models.User.id > last_id
+            ).order_by(models.User.id).limit(batch_size).all()]
+            if not ids:
+                return total
+            for patient_id in ids:
+                rebuild(session, patient_id)
+            session.commit()
+        finally:
+            session.close()
+        total += len(ids)
+        last_id = ids[-1]
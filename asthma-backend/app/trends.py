@@ -0,0 +1,103 @@
+# asthma-backend/trends.py
+"""
+Incremental PEFR trend and anomaly detection.
+
+Each patient's trend state lives on their baseline_pefr row: an exponentially weighted mean
+and variance of the readings, a smoothed slope of that mean, and the number of readings
+seen. update() folds in one reading in O(1), with no history query on the write path:
+
+  - z-score of the reading against the mean/variance *before* it (the std is floored at
+    TREND_MIN_REL_STD of the mean, so a short, very steady history doesn't flag tiny dips);
+  - anomaly when |z| > TREND_ANOMALY_Z once TREND_WARMUP readings have been seen. The
+    reading is clipped to the mean +/- TREND_ANOMALY_Z std before it updates the state and
+    keeps the previous label, so a single bad blow can't flip the trend;
+  - trend label from the slope relative to the mean: beyond +/- TREND_SLOPE_THRESHOLD per
+    reading it is "improving"/"worsening", otherwise "stable" (same labels as before).
+
+A reading older than trend_updated_at (an offline reading uploaded late) is scored against
+the current state but not folded in: the EWMA assumes time order, so a back-dated value
+would be taken as the newest one and bend the slope.
+
+rebuild_all() replays history to initialise the state for existing patients.
+"""
+
+import datetime
+import math
+import os
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from app import models
+
+TREND_ALPHA = float(os.getenv("TREND_ALPHA", "0.3"))              # weight of a new reading in the mean
+TREND_SLOPE_ALPHA = float(os.getenv("TREND_SLOPE_ALPHA", "0.3"))  # weight of a new step in the slope
+TREND_SLOPE_THRESHOLD = float(os.getenv("TREND_SLOPE_THRESHOLD", "0.01"))
+TREND_ANOMALY_Z = float(os.getenv("TREND_ANOMALY_Z", "3.0"))
+TREND_WARMUP = int(os.getenv("TREND_WARMUP", "5"))
+# floor for the std used in z-scores, as a fraction of the mean (normal blow-to-blow variation)
+TREND_MIN_REL_STD = float(os.getenv("TREND_MIN_REL_STD", "0.05"))
+
+
+def update(state: models.BaselinePEFR, value: float, at: datetime.datetime = None):
+    """Fold `value` into the state in place. Returns (trend, anomaly, z_score)."""
+    count = state.trend_count or 0
+    if count == 0:
+        state.trend_mean, state.trend_var, state.trend_slope = float(value), 0.0, 0.0
+        state.trend_count = 1
+        state.trend_updated_at = at or datetime.datetime.utcnow()
+        return "stable", False, 0.0
+
+    mean, var, slope = state.trend_mean, state.trend_var or 0.0, state.trend_slope or 0.0
+    std = max(math.sqrt(var), TREND_MIN_REL_STD * abs(mean))
+    z = (value - mean) / std if std > 0 else 0.0
+    anomaly = count >= TREND_WARMUP and abs(z) > TREND_ANOMALY_Z
+    # back-dated: scored, but the state (and so the trend) stays as the newer readings left it
+    if at is not None and state.trend_updated_at is not None and at < state.trend_updated_at:
+        return label(state), anomaly, round(z, 2)
+
+    x = value
+    if anomaly:
+        previous = label(state)
+        x = mean + math.copysign(TREND_ANOMALY_Z * std, z)
+    diff = x - mean
+    new_mean = mean + TREND_ALPHA * diff
+    state.trend_var = (1 - TREND_ALPHA) * (var + TREND_ALPHA * diff * diff)
+    state.trend_slope = TREND_SLOPE_ALPHA * (new_mean - mean) + (1 - TREND_SLOPE_ALPHA) * slope
+    state.trend_mean = new_mean
+    state.trend_count = count + 1
+    state.trend_updated_at = at or datetime.datetime.utcnow()
+
+    # an outlier is reported through the flag; its own label keeps the trend it interrupted
+    return (previous if anomaly else label(state)), anomaly, round(z, 2)
+
+
+def label(state: models.BaselinePEFR):
+    if not state.trend_count or state.trend_count < 2 or not state.trend_mean:
+        return "stable"
+    relative = state.trend_slope / state.trend_mean
+    if relative > TREND_SLOPE_THRESHOLD:
+        return "improving"
+    if relative < -TREND_SLOPE_THRESHOLD:
+        return "worsening"
+    return "stable"
+
+
+def rebuild_all(engine, batch_size: int = 200):
+    """Replay every patient's readings to initialise the trend state (backfill)."""
+    with engine.connect() as conn:
+        owner_ids = conn.execute(text(
+            "SELECT DISTINCT owner_id FROM baseline_pefr WHERE owner_id IS NOT NULL ORDER BY owner_id"
+        )).scalars().all()
+    for i in range(0, len(owner_ids), batch_size):
+        with Session(bind=engine) as session:
+            for owner_id in owner_ids[i:i + batch_size]:
+                state = session.query(models.BaselinePEFR).filter(models.BaselinePEFR.owner_id == owner_id).first()
+                state.trend_count = 0
+                readings = session.query(models.PEFRRecord.pefr_value, models.PEFRRecord.recorded_at).filter(
+                    models.PEFRRecord.owner_id == owner_id
+                ).order_by(models.PEFRRecord.recorded_at, models.PEFRRecord.id).all()
+                for value, at in readings:
+                    update(state, value, at)
+            session.commit()
+    return len(owner_ids)
@@ -0,0 +1,10 @@
+"""
+Point the app at a throwaway database (and audit archive directory) before any test module
+imports it, so test runs never touch the development database.
+"""
+import os
+import tempfile
+
+_tmp = tempfile.mkdtemp(prefix="asthma-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(_tmp, 'test.db')}")
+os.environ.setdefault("AUDIT_ARCHIVE_DIR", os.path.join(_tmp, "audit_archive"))
@@ -1,12 +1,12 @@
 # Script to clear all data from the database while keeping the schema
 
-from app.database import engine, Base
-from app import models
+from app.database import engine
+from app import audit_store, migrations, models
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import text
 
 # Create tables if they don't exist
-Base.metadata.create_all(bind=engine)
+migrations.upgrade(engine)
 
 Session = sessionmaker(bind=engine)
 session = Session()
@@ -17,17 +17,25 @@ try:
 
     # Delete in proper dependency-safe order
     session.query(models.PushLog).delete()
+    session.query(models.PushOutbox).delete()
     session.query(models.Device).delete()
     session.query(models.MedicationStatusHistory).delete()
     session.query(models.Medication).delete()
     session.query(models.Notification).delete()
+    session.query(models.NotificationDigest).delete()
     session.query(models.Reminder).delete()
     session.query(models.EmergencyContact).delete()
     session.query(models.PEFRRecord).delete()
     session.query(models.Symptom).delete()
     session.query(models.BaselinePEFR).delete()
+    session.query(models.PatientSummary).delete()
+    session.query(models.PEFRDailyRollup).delete()
     session.query(models.DoctorPatient).delete()
-    session.query(models.AuditLog).delete()
+    session.query(models.ChangeLog).delete()
+    session.query(models.IdempotencyKey).delete()
+    session.query(models.RefreshToken).delete()
+    session.query(models.OTPCode).delete()
+    audit_store.clear(session.connection())
     session.query(models.AlertLog).delete()
     session.query(models.EmailLog).delete()
     session.query(models.User).delete()
@@ -42,6 +50,9 @@ try:
     session.execute(text("PRAGMA foreign_keys = ON;"))
 
     session.commit()
+
+    # Archived audit months live in their own files
+    audit_store.delete_archives()
     print("✅ Database fully cleaned and ID counters reset.")
 
 except Exception as e:
@@ -0,0 +1,169 @@
+# asthma-backend/scripts/fcm_emulator.py
+"""
+Local stand-in for the FCM HTTP v1 API and the OAuth token endpoint, to benchmark the push
+pipeline and its failure handling offline.
+
+    python -m scripts.fcm_emulator --port 9099 --latency-ms 30 --error-rate 0.01
+    FCM_ENDPOINT=http://127.0.0.1:9099 uvicorn app.main:app
+
+Responses by device token:
+    dead-...     404 UNREGISTERED (the dispatcher deactivates the token)
+    invalid-...  400 INVALID_ARGUMENT, not a valid registration token (deactivated too)
+    flaky-...    503 UNAVAILABLE for the first --flaky-failures sends of that token
+anything else succeeds, except a random --error-rate share that gets 503 UNAVAILABLE and
+requests beyond --quota per second, which get 429 QUOTA_EXCEEDED.
+
+POST /token issues access tokens valid for --token-ttl seconds (point a test service
+account's token_uri here). Sends get 401 without a bearer token or with one the emulator
+did not issue; clients without credentials send "Bearer emulator", which is always accepted.
+GET /stats returns the counters and POST /reset clears them.
+
+--bench N starts the emulator in-process, sends one push to N tokens (1% dead, 1% flaky)
+through app.fcm.FCMClient and prints the throughput and outcome counts.
+"""
+
+import argparse
+import asyncio
+import collections
+import random
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Form, Request
+from fastapi.responses import JSONResponse
+
+FCM_ERROR_TYPE = "type.googleapis.com/google.firebase.fcm.v1.FcmError"
+
+
+def _fcm_error(status_code: int, status: str, code: str, message: str, headers: dict = None):
+    return JSONResponse(status_code=status_code, headers=headers, content={"error": {
+        "code": status_code, "message": message, "status": status,
+        "details": [{"@type": FCM_ERROR_TYPE, "errorCode": code}],
+    }})
+
+
+def create_app(latency_ms: float = 0.0, error_rate: float = 0.0, flaky_failures: int = 1,
+               quota: int = 0, token_ttl: int = 3600) -> FastAPI:
+    app = FastAPI()
+    stats = collections.Counter()
+    flaky_seen = collections.Counter()
+    window = {"second": 0, "count": 0}
+    issued = {"emulator"}
+
+    @app.post("/token")
+    def issue_token(grant_type: str = Form(...), assertion: str = Form(...)):
+        stats["tokens_issued"] += 1
+        token = f"emulator-{stats['tokens_issued']}"
+        issued.add(token)
+        return {"access_token": token, "expires_in": token_ttl, "token_type": "Bearer"}
+
+    @app.post("/v1/projects/{project_id}/messages:send")
+    async def send(project_id: str, request: Request):
+        stats["requests"] += 1
+        if request.headers.get("authorization", "").removeprefix("Bearer ") not in issued:
+            stats["unauthenticated"] += 1
+            return JSONResponse(status_code=401, content={"error": {
+                "code": 401, "message": "Request had invalid authentication credentials.",
+                "status": "UNAUTHENTICATED"}})
+        message = (await request.json()).get("message") or {}
+        token = message.get("token") or ""
+
+        if latency_ms:
+            await asyncio.sleep(latency_ms / 1000.0 * random.uniform(0.5, 1.5))
+
+        if quota:
+            now = int(time.time())
+            if window["second"] != now:
+                window["second"], window["count"] = now, 0
+            window["count"] += 1
+            if window["count"] > quota:
+                stats["quota_exceeded"] += 1
+                return _fcm_error(429, "RESOURCE_EXHAUSTED", "QUOTA_EXCEEDED", "Quota exceeded.", {"Retry-After": "1"})
+        if token.startswith("dead-"):
+            stats["unregistered"] += 1
+            return _fcm_error(404, "NOT_FOUND", "UNREGISTERED", "Requested entity was not found.")
+        if token.startswith("invalid-"):
+            stats["invalid"] += 1
+            return _fcm_error(400, "INVALID_ARGUMENT", "INVALID_ARGUMENT",
+                              "The registration token is not a valid FCM registration token")
+        if token.startswith("flaky-") and flaky_seen[token] < flaky_failures:
+            flaky_seen[token] += 1
+            stats["unavailable"] += 1
+            return _fcm_error(503, "UNAVAILABLE", "UNAVAILABLE", "The service is currently unavailable.")
+        if error_rate and random.random() < error_rate:
+            stats["unavailable"] += 1
+            return _fcm_error(503, "UNAVAILABLE", "UNAVAILABLE", "The service is currently unavailable.")
+
+        stats["delivered"] += 1
+        return {"name": f"projects/{project_id}/messages/{stats['delivered']}"}
+
+    @app.get("/stats")
+    def get_stats():
+        return dict(stats)
+
+    @app.post("/reset")
+    def reset():
+        stats.clear()
+        flaky_seen.clear()
+        return {"reset": True}
+
+    return app
+
+
+def serve_in_thread(app: FastAPI, port: int):
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server, thread
+
+
+async def bench(port: int, n: int, concurrency: int):
+    from app import fcm
+
+    tokens = []
+    for i in range(n):
+        roll = i % 100
+        tokens.append(f"dead-{i}" if roll == 0 else f"flaky-{i}" if roll == 1 else f"device-{i}")
+    client = fcm.FCMClient(endpoint=f"http://127.0.0.1:{port}", project_id="bench",
+                           credentials_info={}, concurrency=concurrency)
+    try:
+        start = time.perf_counter()
+        res = await client.send(tokens, "Benchmark", "Hello from the emulator bench")
+        elapsed = time.perf_counter() - start
+    finally:
+        await client.aclose()
+    codes = collections.Counter(r.get("code", "OK") for r in res["responses"])
+    dead = sum(1 for r in res["responses"] if r.get("dead"))
+    print(f"{n} sends in {elapsed:.2f}s ({n / elapsed:.0f}/s) with concurrency {concurrency}")
+    print(f"success={res['success']} failure={res['failure']} dead={dead} codes={dict(codes)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local FCM HTTP v1 emulator")
+    parser.add_argument("--port", type=int, default=9099)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--flaky-failures", type=int, default=1)
+    parser.add_argument("--quota", type=int, default=0, help="max sends per second (0 = unlimited)")
+    parser.add_argument("--token-ttl", type=int, default=3600)
+    parser.add_argument("--bench", type=int, default=0, help="send to this many tokens and exit")
+    parser.add_argument("--concurrency", type=int, default=64, help="client concurrency for --bench")
+    args = parser.parse_args()
+
+    app = create_app(args.latency_ms, args.error_rate, args.flaky_failures, args.quota, args.token_ttl)
+    if args.bench:
+        server, thread = serve_in_thread(app, args.port)
+        try:
+            asyncio.run(bench(args.port, args.bench, args.concurrency))
+        finally:
+            server.should_exit = True
+            thread.join()
+        return
+    uvicorn.run(app, host="127.0.0.1", port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Unit tests of the pure numeric parts of the PEFR analytics: LTTB downsampling
+(app.analytics.lttb) and the incremental trend / anomaly state (app.trends.update).
+
+Run with:
+    python -m pytest test_analytics.py
+"""
+import datetime
+
+import numpy as np
+import pytest
+
+from app import analytics, models, trends
+
+
+# ------------------------------------------------------------
+# LTTB
+# ------------------------------------------------------------
+
+@pytest.mark.parametrize("n, threshold", [(1000, 50), (100, 99), (10, 3), (7, 5)])
+def test_lttb_keeps_the_ends_and_returns_threshold_points(n, threshold):
+    rng = np.random.default_rng(n)
+    x = np.arange(n, dtype=float)
+    y = np.cumsum(rng.normal(size=n))
+    keep = analytics.lttb(x, y, threshold)
+    assert len(keep) == threshold
+    assert keep[0] == 0 and keep[-1] == n - 1
+    assert np.all(np.diff(keep) > 0)
+
+
+def test_lttb_keeps_a_spike():
+    x = np.arange(500, dtype=float)
+    y = np.full(500, 400.0)
+    y[237] = 150.0
+    assert 237 in analytics.lttb(x, y, 20)
+
+
+@pytest.mark.parametrize("threshold", [2, 10, 11])
+def test_lttb_returns_every_point_when_there_is_nothing_to_drop(threshold):
+    x = np.arange(10, dtype=float)
+    assert list(analytics.lttb(x, x, threshold)) == list(range(10))
+
+
+# ------------------------------------------------------------
+# Trend state
+# ------------------------------------------------------------
+
+START = datetime.datetime(2024, 1, 1, 8, 0)
+
+
+def feed(state, values, start=START):
+    return [trends.update(state, value, start + datetime.timedelta(hours=12 * i)) for i, value in enumerate(values)]
+
+
+def test_trend_converges_to_a_steady_level():
+    state = models.BaselinePEFR(trend_count=0)
+    results = feed(state, [400 + (5 if i % 2 else -5) for i in range(60)])
+    assert state.trend_mean == pytest.approx(400, abs=5)
+    assert state.trend_count == 60
+    assert results[-1][0] == "stable"
+    assert not any(anomaly for _, anomaly, _ in results)
+
+
+def test_trend_follows_a_sustained_change():
+    state = models.BaselinePEFR(trend_count=0)
+    feed(state, [300 + 10 * i for i in range(20)])
+    assert trends.label(state) == "improving"
+    feed(state, [490 - 15 * i for i in range(20)], start=START + datetime.timedelta(days=30))
+    assert trends.label(state) == "worsening"
+
+
+def test_outlier_is_flagged_and_does_not_flip_the_trend():
+    state = models.BaselinePEFR(trend_count=0)
+    feed(state, [400 + (4 if i % 2 else -4) for i in range(trends.TREND_WARMUP + 10)])
+    mean = state.trend_mean
+    std = max(np.sqrt(state.trend_var), trends.TREND_MIN_REL_STD * mean)
+    trend, anomaly, z = trends.update(state, 150, START + datetime.timedelta(days=30))
+    assert anomaly and z < -trends.TREND_ANOMALY_Z
+    assert trend == "stable"
+    # clipped before it is folded in: one bad blow moves the mean by at most ALPHA * Z * std
+    assert mean - state.trend_mean <= trends.TREND_ALPHA * trends.TREND_ANOMALY_Z * std + 1e-9
+
+
+def test_no_anomaly_during_warmup():
+    state = models.BaselinePEFR(trend_count=0)
+    results = feed(state, [400, 400, 150])
+    assert not any(anomaly for _, anomaly, _ in results)
@@ -0,0 +1,470 @@
+"""
+API regression tests against a throwaway SQLite database.
+
+The app runs (startup hooks included) through FastAPI's TestClient; conftest.py points
+DATABASE_URL and AUDIT_ARCHIVE_DIR at a temporary folder before anything imports the app.
+
+Run with:
+    python -m pytest test_api.py
+"""
+import pytest
+from fastapi.testclient import TestClient
+
+ADMIN_ROUTES = [
+    "/admin/email-logs",
+    "/admin/realtime-stats",
+    "/admin/password-pool-stats",
+    "/admin/identity-cache-stats",
+    "/admin/push-stats",
+    "/admin/delivery-log-stats",
+    "/admin/audit-stats",
+    "/admin/audit-logs",
+]
+
+
+@pytest.fixture(scope="module")
+def client():
+    from app.main import app
+
+    with TestClient(app) as c:
+        yield c
+
+
+def create_user(client, email, role=None):
+    """Insert a user with password "pw" and log in. Returns (id, auth headers)."""
+    from app import auth, database, models
+
+    with database.SessionLocal() as db:
+        user = models.User(email=email, name=email.split("@")[0], role=role or models.UserRole.PATIENT,
+                           hashed_password=auth.pwd_context.copy(bcrypt__rounds=4).hash("pw"))
+        db.add(user)
+        db.commit()
+        user_id = user.id
+    res = client.post("/auth/login", data={"username": email, "password": "pw"})
+    assert res.status_code == 200, res.text
+    return user_id, {"Authorization": "Bearer " + res.json()["access_token"]}
+
+
+@pytest.fixture(scope="module")
+def users(client):
+    from app import models
+
+    ids, headers = {}, {}
+    for email, role in (("patient@example.com", models.UserRole.PATIENT),
+                        ("doctor@example.com", models.UserRole.DOCTOR)):
+        ids[role.value], headers[email.split("@")[0]] = create_user(client, email, role)
+    return ids, headers
+
+
+@pytest.mark.parametrize("route", ADMIN_ROUTES)
+def test_admin_routes_require_authentication(client, route):
+    assert client.get(route).status_code == 401
+
+
+@pytest.mark.parametrize("route", ADMIN_ROUTES)
+def test_admin_routes_require_admin_role(client, users, route):
+    _, headers = users
+    assert client.get(route, headers=headers["patient"]).status_code == 403
+    assert client.get(route, headers=headers["doctor"]).status_code == 200
+
+
+def test_history_pages_start_at_the_newest_rows(client, users):
+    import datetime
+
+    from app import database, models
+
+    ids, headers = users
+    start = datetime.datetime(2024, 1, 1, 8, 0)
+    with database.SessionLocal() as db:
+        db.add_all(models.PEFRRecord(owner_id=ids["Patient"], pefr_value=300 + i, zone="Green",
+                                     recorded_at=start + datetime.timedelta(hours=i)) for i in range(7))
+        db.commit()
+
+    # no cursor: the newest page, oldest-first within the page, with a cursor back
+    res = client.get("/pefr/records?limit=3", headers=headers["patient"])
+    assert [r["pefr_value"] for r in res.json()] == [304, 305, 306]
+    assert "X-Next-Cursor" not in res.headers
+    pages = [res.json()]
+    while "X-Prev-Cursor" in res.headers:
+        res = client.get(f"/pefr/records?limit=3&before={res.headers['X-Prev-Cursor']}", headers=headers["patient"])
+        pages.insert(0, res.json())
+    assert [r["pefr_value"] for page in pages for r in page] == list(range(300, 307))
+    assert [len(page) for page in pages] == [1, 3, 3]
+
+    # and forward again from the oldest page
+    res = client.get(f"/pefr/records?limit=3&after={res.headers['X-Next-Cursor']}", headers=headers["patient"])
+    assert [r["pefr_value"] for r in res.json()] == [301, 302, 303]
+
+    # the default page size covers every reading here
+    res = client.get("/pefr/records", headers=headers["patient"])
+    assert [r["pefr_value"] for r in res.json()] == list(range(300, 307))
+
+
+def test_backdated_bulk_readings_leave_the_trend_alone(client, users):
+    from app import database, models
+
+    ids, headers = users
+
+    def state():
+        with database.SessionLocal() as db:
+            baseline = db.query(models.BaselinePEFR).filter(models.BaselinePEFR.owner_id == ids["Patient"]).one()
+            return baseline.trend_count, baseline.trend_mean, baseline.trend_slope, baseline.trend_updated_at
+
+    recent = [{"pefr_value": 400 + 10 * i, "recorded_at": f"2025-06-0{i + 1}T08:00:00"} for i in range(5)]
+    res = client.post("/pefr/records/bulk", json={"readings": recent}, headers=headers["patient"])
+    assert res.status_code == 200, res.text
+    assert res.json()["records"][-1]["trend"] == "improving"
+    before = state()
+
+    # an offline week uploaded late: much lower, but older than everything above
+    backdated = [{"pefr_value": 250, "recorded_at": f"2025-05-0{i + 1}T08:00:00"} for i in range(5)]
+    res = client.post("/pefr/records/bulk", json={"readings": backdated}, headers=headers["patient"])
+    assert res.status_code == 200, res.text
+    assert res.json()["accepted"] == 5
+    assert {r["trend"] for r in res.json()["records"]} == {"improving"}
+    assert state() == before
+
+
+def test_group_commit_failing_unit_rolls_back_only_itself(client):
+    from app import database, group_commit, models
+
+    # a long window, so both units land in the same batch
+    writer = group_commit.GroupCommitWriter(window_ms=2000, max_ops=2)
+    writer.start()
+
+    def good(session):
+        session.add(models.EmailLog(recipient="group-good@example.com"))
+        session.flush()
+        return "ok"
+
+    def bad(session):
+        session.add(models.EmailLog(recipient="group-bad@example.com"))
+        session.flush()
+        raise ValueError("unit failed")
+
+    try:
+        futures = [writer.submit(bad), writer.submit(good)]
+        with pytest.raises(ValueError, match="unit failed"):
+            futures[0].result(timeout=10)
+        assert futures[1].result(timeout=10) == "ok"
+    finally:
+        writer.stop()
+    assert writer.stats["batches"] == 1 and writer.stats["ops"] == 2 and writer.stats["failed_ops"] == 1
+
+    with database.SessionLocal() as db:
+        recipients = [r for (r,) in db.query(models.EmailLog.recipient).filter(
+            models.EmailLog.recipient.like("group-%"))]
+    assert recipients == ["group-good@example.com"]
+
+
+def test_group_commit_fallback_runs_off_the_event_loop(client):
+    import asyncio
+    import threading
+
+    from app import group_commit
+
+    writer = group_commit.GroupCommitWriter()   # never started: units run inline
+
+    async def main():
+        loop_thread = threading.get_ident()
+        ran_on = await writer.run(lambda session: threading.get_ident())
+        return loop_thread, ran_on
+
+    loop_thread, ran_on = asyncio.run(main())
+    assert ran_on != loop_thread
+    assert writer.stats["ops"] == 1
+
+
+def test_signup_otp_can_be_resent_after_the_code_expires(client, monkeypatch):
+    import datetime
+
+    from app import main, otp_store
+
+    monkeypatch.setenv("OTP_FORCE_DEV_RETURN", "true")
+    codes = iter(["111111", "222222"])
+    monkeypatch.setattr(main, "generate_otp", lambda: next(codes))
+    email = "newpatient@example.com"
+    res = client.post("/auth/signup-send-otp",
+                      json={"email": email, "name": "new", "role": "Patient", "password": "pw"})
+    assert res.status_code == 200, res.text
+
+    # let the code (not the pending signup) expire
+    record = otp_store.store.get(email)
+    record["code_expires_at"] = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    otp_store.store.put(email, record)
+    res = client.post("/auth/verify-signup-otp", data={"email": email, "otp": "111111"})
+    assert res.json() == {"error": "OTP expired"}
+
+    res = client.post("/auth/resend-signup-otp", data={"email": email})
+    assert res.status_code == 200, res.text
+    res = client.post("/auth/verify-signup-otp", data={"email": email, "otp": "222222"})
+    assert res.status_code == 200, res.text
+
+
+def test_doctor_dashboard_pages_follow_the_patients_latest_readings(client, users):
+    _, headers = users
+    doctor = headers["doctor"]
+    red_id, red = create_user(client, "zed@example.com")
+    green_id, green = create_user(client, "yan@example.com")
+
+    # linked before the readings (the links follow the summary) and after them (copied on link)
+    assert client.post("/patient/link-doctor", json={"doctor_email": "doctor@example.com"}, headers=red).status_code == 200
+    for value in (400, 150):
+        assert client.post("/pefr/record", json={"pefr_value": value}, headers=red).status_code == 200
+    assert client.post("/pefr/record", json={"pefr_value": 400}, headers=green).status_code == 200
+    assert client.post("/patient/link-doctor", json={"doctor_email": "doctor@example.com"}, headers=green).status_code == 200
+
+    def pages(sort):
+        ids, cursor = [], None
+        while True:
+            url = f"/doctor/patients?sort={sort}&limit=1" + (f"&after={cursor}" if cursor else "")
+            res = client.get(url, headers=doctor)
+            assert res.status_code == 200, res.text
+            ids += [p["id"] for p in res.json()]
+            cursor = res.headers.get("X-Next-Cursor")
+            if not cursor:
+                return ids
+
+    assert pages("risk") == [red_id, green_id]
+    assert pages("stale") == [red_id, green_id]
+    assert pages("name") == [green_id, red_id]
+
+    profile = {"email": "zed@example.com", "name": "abe", "role": "Patient", "password": ""}
+    assert client.put("/profile/me", json=profile, headers=red).status_code == 200
+    assert pages("name") == [red_id, green_id]
+
+
+def test_medication_metadata_updates_are_audited(client, users):
+    from app import audit, database
+
+    ids, headers = users
+    res = client.post("/medications", json={"name": "salbutamol"}, headers=headers["patient"])
+    assert res.status_code == 200, res.text
+    med_id = res.json()["id"]
+    res = client.patch(f"/medications/{med_id}", json={"dose": "2 puffs"}, headers=headers["patient"])
+    assert res.status_code == 200, res.text
+
+    audit.flush(database.engine)
+    res = client.get(f"/admin/audit-logs?user_id={ids['Patient']}&action=UPDATE_MEDICATION_METADATA",
+                     headers=headers["doctor"])
+    assert [e["details"] for e in res.json()] == [{"medication_id": med_id}]
+
+
+def idempotency_row(headers, raw_key):
+    """The stored idempotency_keys row of `raw_key` sent with `headers`, or None."""
+    from app import auth, database, idempotency, models
+
+    key = idempotency._digest(auth.token_subject(headers["Authorization"]) or "", raw_key)
+    with database.SessionLocal() as db:
+        return db.get(models.IdempotencyKey, key)
+
+
+def pefr_count(patient_id):
+    from app import database, models
+
+    with database.SessionLocal() as db:
+        return db.query(models.PEFRRecord).filter(models.PEFRRecord.owner_id == patient_id).count()
+
+
+def test_idempotency_key_stores_and_replays_the_first_response(client, users):
+    ids, headers = users
+    patient = dict(headers["patient"], **{"Idempotency-Key": "reading-1"})
+    count = pefr_count(ids["Patient"])
+
+    first = client.post("/pefr/record", json={"pefr_value": 380}, headers=patient)
+    assert first.status_code == 200, first.text
+    assert "Idempotent-Replayed" not in first.headers
+    row = idempotency_row(patient, "reading-1")
+    assert row.status_code == 200 and row.body == first.content
+
+    retry = client.post("/pefr/record", json={"pefr_value": 380}, headers=patient)
+    assert retry.status_code == 200
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert retry.json() == first.json()
+    assert pefr_count(ids["Patient"]) == count + 1
+
+    # the same key for another request
+    res = client.post("/pefr/record", json={"pefr_value": 390}, headers=patient)
+    assert res.status_code == 422
+    assert pefr_count(ids["Patient"]) == count + 1
+
+
+def test_idempotency_key_in_flight_gets_409(client, users):
+    import datetime
+
+    from app import auth, database, idempotency, models
+
+    ids, headers = users
+    patient = dict(headers["patient"], **{"Idempotency-Key": "reading-2", "Content-Type": "application/json"})
+    body = b'{"pefr_value": 370}'
+    # the claim of a first request that is still running
+    with database.SessionLocal() as db:
+        db.add(models.IdempotencyKey(
+            key=idempotency._digest(auth.token_subject(patient["Authorization"]), "reading-2"),
+            request_hash=idempotency._digest("POST", "/pefr/record", b"", body),
+            created_at=datetime.datetime.utcnow()))
+        db.commit()
+    count = pefr_count(ids["Patient"])
+
+    res = client.post("/pefr/record", content=body, headers=patient)
+    assert res.status_code == 409
+    assert res.headers["Retry-After"] == "1"
+    assert pefr_count(ids["Patient"]) == count
+
+
+def test_idempotency_key_errors_are_not_stored(client, users):
+    _, headers = users
+    doctor = dict(headers["doctor"], **{"Idempotency-Key": "reading-3"})
+    for _ in range(2):
+        res = client.post("/pefr/record", json={"pefr_value": 360}, headers=doctor)
+        assert res.status_code == 403
+        assert "Idempotent-Replayed" not in res.headers
+    assert idempotency_row(doctor, "reading-3") is None
+
+
+def test_idempotency_key_is_ignored_on_auth_routes(client, users):
+    from app import database, models
+
+    with database.SessionLocal() as db:
+        stored = db.query(models.IdempotencyKey).count()
+    for _ in range(2):
+        res = client.post("/auth/login", data={"username": "patient@example.com", "password": "pw"},
+                          headers={"Idempotency-Key": "login-1"})
+        assert res.status_code == 200
+        assert "Idempotent-Replayed" not in res.headers
+    with database.SessionLocal() as db:
+        assert db.query(models.IdempotencyKey).count() == stored
+
+
+def test_sync_pages_deltas_tombstones_and_pruned_tokens(client, monkeypatch):
+    from app import changelog, database, models, retention
+
+    patient_id, patient = create_user(client, "sync@example.com")
+    _, doctor = create_user(client, "syncdoctor@example.com", models.UserRole.DOCTOR)
+
+    res = client.get("/sync", headers=patient)
+    assert res.json()["full"] is True
+    token = res.json()["token"]
+
+    res = client.post(f"/doctor/patient/{patient_id}/medication", json={"name": "budesonide"}, headers=doctor)
+    assert res.status_code == 200, res.text
+    med_id = res.json()["id"]
+    # a Core multi-row insert, logged through record_updated()
+    readings = [{"pefr_value": 400 + i, "recorded_at": f"2025-07-0{i + 1}T08:00:00"} for i in range(3)]
+    assert client.post("/pefr/records/bulk", json={"readings": readings}, headers=patient).status_code == 200
+
+    monkeypatch.setattr(changelog, "SYNC_MAX_CHANGES", 2)
+    upserts, pages = {}, 0
+    while True:
+        body = client.get(f"/sync?since={token}", headers=patient).json()
+        assert body["full"] is False
+        for entity, objs in body["upserts"].items():
+            upserts.setdefault(entity, []).extend(obj["id"] for obj in objs)
+        token, pages = body["token"], pages + 1
+        if not body["has_more"]:
+            break
+    assert pages > 1
+    assert upserts["medications"] == [med_id]
+    assert len(upserts["pefr_records"]) == 3
+
+    # a deleted doctor's prescriptions leave tombstones (record_deleted)
+    assert client.delete("/profile/me", headers=doctor).status_code == 200
+    body = client.get(f"/sync?since={token}", headers=patient).json()
+    assert body["deleted"] == {"medications": [med_id]}
+
+    # once the log is pruned past a token, that client gets a snapshot instead of deltas
+    assert retention.purge_change_log(database.engine, days=0) > 0
+    with database.SessionLocal() as db:
+        assert db.query(models.ChangeLog).count() == 1      # the newest row is kept
+        latest = changelog.current_token(db)
+    assert client.get("/sync?since=1", headers=patient).json()["full"] is True
+    body = client.get(f"/sync?since={latest}", headers=patient).json()
+    assert body["full"] is False and not any(body["upserts"].values()) and body["deleted"] == {}
+
+
+def test_purged_notifications_leave_sync_tombstones(client):
+    import datetime
+
+    from app import database, models, retention
+
+    patient_id, patient = create_user(client, "purge@example.com")
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=retention.NOTIFICATION_RETENTION_DAYS + 1)
+    with database.SessionLocal() as db:
+        rows = [models.Notification(owner_id=patient_id, message=f"old {i}", created_at=old, read=read)
+                for i, read in enumerate([True, True, False])]
+        db.add_all(rows)
+        db.commit()
+        read_ids = [row.id for row in rows[:2]]
+    token = client.get("/sync", headers=patient).json()["token"]
+
+    assert retention.purge_read_notifications(database.engine, batch_size=1) >= 2
+    body = client.get(f"/sync?since={token}", headers=patient).json()
+    assert body["full"] is False
+    assert sorted(body["deleted"]["notifications"]) == read_ids
+
+
+@pytest.fixture
+def claims_mode(monkeypatch):
+    from app import auth
+
+    monkeypatch.setattr(auth, "AUTH_MODE", "claims")
+
+
+def login(client, email, password="pw"):
+    res = client.post("/auth/login", data={"username": email, "password": password})
+    assert res.status_code == 200, res.text
+    return res.json()
+
+
+def refresh(client, refresh_token):
+    return client.post("/auth/refresh", data={"refresh_token": refresh_token})
+
+
+def test_refresh_tokens_rotate_and_reuse_revokes_the_family(client, claims_mode):
+    create_user(client, "rotate@example.com")
+    first = login(client, "rotate@example.com")["refresh_token"]
+    other_login = login(client, "rotate@example.com")["refresh_token"]
+
+    res = refresh(client, first)
+    assert res.status_code == 200, res.text
+    second = res.json()["refresh_token"]
+    assert second != first and res.json()["access_token"]
+    res = refresh(client, second)
+    assert res.status_code == 200
+    third = res.json()["refresh_token"]
+
+    # replaying a used token means it leaked: the whole login is revoked
+    assert refresh(client, first).status_code == 401
+    assert refresh(client, third).status_code == 401
+    # other logins of the same user are not affected
+    assert refresh(client, other_login).status_code == 200
+
+
+def test_logout_revokes_the_login(client, claims_mode):
+    create_user(client, "logout@example.com")
+    token = login(client, "logout@example.com")["refresh_token"]
+    rotated = refresh(client, token).json()["refresh_token"]
+    other_login = login(client, "logout@example.com")["refresh_token"]
+
+    assert client.post("/auth/logout", data={"refresh_token": rotated}).status_code == 200
+    assert refresh(client, rotated).status_code == 401
+    assert refresh(client, other_login).status_code == 200
+
+
+def test_password_reset_and_account_deletion_revoke_refresh_tokens(client, claims_mode, monkeypatch):
+    from app import main
+
+    monkeypatch.setenv("OTP_FORCE_DEV_RETURN", "true")
+    monkeypatch.setattr(main, "generate_otp", lambda: "333333")
+    create_user(client, "reset@example.com")
+    token = login(client, "reset@example.com")["refresh_token"]
+    assert client.post("/auth/forgot-password", data={"email": "reset@example.com"}).status_code == 200
+    res = client.post("/auth/reset-password",
+                      data={"email": "reset@example.com", "otp": "333333", "new_password": "pw2"})
+    assert res.status_code == 200, res.text
+    assert refresh(client, token).status_code == 401
+
+    _, headers = create_user(client, "leaving@example.com")
+    token = login(client, "leaving@example.com")["refresh_token"]
+    assert client.delete("/profile/me", headers=headers).status_code == 200
+    assert refresh(client, token).status_code == 401
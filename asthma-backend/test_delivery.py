@@ -0,0 +1,204 @@
+"""
+Tests of push delivery through the outbox (app.push) and notification coalescing
+(app.digests), on an in-memory database built by the migrations, and of the FCM client
+(app.fcm) against a mock transport. The dispatcher gets a fake FCM client and the digest
+flush is given its clock, so nothing here depends on the network or on timing.
+
+Run with:
+    python -m pytest test_delivery.py
+"""
+import asyncio
+import datetime
+import json
+
+import httpx
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import StaticPool
+
+from app import digests, fcm, migrations, models, push
+
+PATIENTS = [(10 + i, f"patient{i}") for i in range(3)]
+DOCTOR_ID = 2
+
+
+class FakeFCM:
+    """Answers every token from `results`: True (delivered), "dead" or an error string."""
+
+    def __init__(self, results):
+        self.results = results
+        self.sent = []
+
+    async def send(self, tokens, title, body, data=None):
+        self.sent.append(list(tokens))
+        responses = []
+        for token in tokens:
+            result = self.results.get(token, True)
+            responses.append({"token": token, "success": result is True, "dead": result == "dead",
+                              "error": None if result is True else result})
+        return {"success": sum(r["success"] for r in responses),
+                "failure": sum(not r["success"] for r in responses), "responses": responses}
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    migrations.upgrade(engine)
+    with Session(bind=engine) as session:
+        session.add(models.User(id=DOCTOR_ID, email="doctor@example.com", name="doctor",
+                                role=models.UserRole.DOCTOR, hashed_password="x"))
+        for patient_id, name in PATIENTS:
+            session.add(models.User(id=patient_id, email=f"{name}@example.com", name=name,
+                                    role=models.UserRole.PATIENT, hashed_password="x"))
+        for token in ("ok", "flaky", "gone"):
+            session.add(models.Device(owner_id=DOCTOR_ID, token=token, active=True))
+        session.commit()
+    return engine
+
+
+def enqueue(engine, **values):
+    with Session(bind=engine) as session:
+        row = push.enqueue(session, DOCTOR_ID, "Title", "Body")
+        for name, value in values.items():
+            setattr(row, name, value)
+        session.commit()
+        return row.id
+
+
+def outbox(engine):
+    with Session(bind=engine) as session:
+        return session.query(models.PushOutbox).all()
+
+
+# ------------------------------------------------------------
+# Outbox
+# ------------------------------------------------------------
+
+def test_claimed_pushes_are_leased(engine):
+    enqueue(engine)
+    now = datetime.datetime.utcnow()
+    rows, devices = push._claim(engine, now, 10)
+    assert len(rows) == 1 and sorted(devices[DOCTOR_ID]) == ["flaky", "gone", "ok"]
+    # another dispatcher skips the row until the lease runs out
+    assert push._claim(engine, now, 10)[0] == []
+    later = now + datetime.timedelta(seconds=push.PUSH_LEASE_SECONDS + 1)
+    assert len(push._claim(engine, later, 10)[0]) == 1
+
+
+def test_failed_devices_are_retried_with_backoff(engine):
+    enqueue(engine)
+    client = FakeFCM({"flaky": "UNAVAILABLE", "gone": "dead"})
+    before = datetime.datetime.utcnow()
+    assert asyncio.run(push.dispatch_once(engine, client)) == 1
+
+    [row] = outbox(engine)
+    assert row.attempts == 1
+    assert json.loads(row.tokens) == ["flaky"]            # only the device that failed
+    assert row.last_error == "UNAVAILABLE"
+    delay = (row.next_attempt_at - before).total_seconds()
+    assert 0.8 * push.PUSH_BACKOFF_BASE_SECONDS <= delay <= 1.2 * push.PUSH_BACKOFF_BASE_SECONDS + 1
+    with Session(bind=engine) as session:
+        assert session.query(models.Device).filter(models.Device.token == "gone").one().active is False
+
+    # not due yet; once it is, only the failed device is tried again
+    assert asyncio.run(push.dispatch_once(engine, client)) == 0
+    with Session(bind=engine) as session:
+        session.query(models.PushOutbox).update({"next_attempt_at": before})
+        session.commit()
+    client.results = {}
+    assert asyncio.run(push.dispatch_once(engine, client)) == 1
+    assert client.sent[-1] == ["flaky"]
+    assert outbox(engine) == []
+
+
+def test_push_is_dropped_after_max_attempts(engine):
+    enqueue(engine, attempts=push.PUSH_MAX_ATTEMPTS - 1)
+    dropped = push.stats["dropped"]
+    assert asyncio.run(push.dispatch_once(engine, FakeFCM({"ok": "UNAVAILABLE"}))) == 1
+    assert outbox(engine) == []
+    assert push.stats["dropped"] == dropped + 1
+
+
+# ------------------------------------------------------------
+# Digests
+# ------------------------------------------------------------
+
+def notify(engine, patient, urgent=False, owner_id=DOCTOR_ID):
+    with Session(bind=engine) as session:
+        digests.notify(session, owner_id, "pefr", "Patient PEFR Update", f"{patient[1]} recorded a reading",
+                       "/patient/1/pefr", subject=patient, urgent=urgent)
+        session.commit()
+
+
+def notifications(engine):
+    with Session(bind=engine) as session:
+        return [n.message for n in session.query(models.Notification).order_by(models.Notification.id)]
+
+
+def test_routine_events_are_merged_into_one_digest(engine):
+    for patient in PATIENTS + PATIENTS[:2]:
+        notify(engine, patient)
+    assert notifications(engine) == []
+
+    now = datetime.datetime.utcnow()
+    assert digests.flush_due(engine, now=now) == 0           # window still open
+    closed = now + datetime.timedelta(seconds=digests.window("pefr") + 1)
+    assert digests.flush_due(engine, now=closed) == 1
+    assert notifications(engine) == ["3 patients recorded readings (5 in total)"]
+    assert len(outbox(engine)) == 1
+    assert digests.flush_due(engine, now=closed) == 0
+
+
+def test_urgent_events_bypass_the_window(engine):
+    notify(engine, PATIENTS[0])
+    notify(engine, PATIENTS[1], urgent=True)
+    assert notifications(engine) == ["patient1 recorded a reading"]
+    assert len(outbox(engine)) == 1
+
+
+def test_digest_of_a_deleted_recipient_is_dropped(engine):
+    notify(engine, PATIENTS[0], owner_id=99)
+    closed = datetime.datetime.utcnow() + datetime.timedelta(seconds=digests.window("pefr") + 1)
+    assert digests.flush_due(engine, now=closed) == 0
+    assert notifications(engine) == [] and outbox(engine) == []
+    with Session(bind=engine) as session:
+        assert session.query(models.NotificationDigest).count() == 0
+
+
+# ------------------------------------------------------------
+# FCM client
+# ------------------------------------------------------------
+
+def test_unconfigured_fcm_counts_suppressed_pushes_without_printing_each(capsys):
+    client = fcm.FCMClient(endpoint=fcm.GOOGLE_ENDPOINT, credentials_info={})
+    for _ in range(3):
+        assert asyncio.run(client.send(["a", "b"], "Title", "Body"))["success"] == 2
+    assert client.stats["suppressed"] == 6
+    assert capsys.readouterr().out.count("[fcm]") == 1
+
+
+def test_fcm_sends_every_token_with_bounded_concurrency():
+    in_flight, peak = 0, 0
+
+    async def handler(request):
+        nonlocal in_flight, peak
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json={"name": "projects/emulator/messages/1"})
+
+    client = fcm.FCMClient(endpoint="http://emulator", concurrency=4)
+    client._new_pool = lambda size: httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+    async def run():
+        try:
+            return await client.send([f"token-{i}" for i in range(10)], "Title", "Body")
+        finally:
+            await client.aclose()
+
+    result = asyncio.run(run())
+    assert result["success"] == 10
+    assert [r["token"] for r in result["responses"]] == [f"token-{i}" for i in range(10)]
+    assert peak == 4
@@ -0,0 +1,217 @@
+"""
+EXPLAIN QUERY PLAN regression suite for the hot queries in app/main.py.
+
+Builds the schema through the migrations on an in-memory SQLite database and fails if any
+hot query falls back to a full table scan or sorts through a temp B-tree.
+
+Run with:
+    python -m pytest test_query_plans.py
+or as a script:
+    python test_query_plans.py
+"""
+import datetime
+
+from sqlalchemy import create_engine, desc, func, select
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.pool import StaticPool
+
+from app import audit_store, migrations, models, pagination, summary
+
+OWNER_ID = 1
+DOCTOR_ID = 2
+MED_ID = 1
+CURSOR = pagination.encode_cursor(["2024-01-01T08:00:00", 10])
+WINDOW = dict(since=datetime.datetime(2024, 1, 1), until=datetime.datetime(2024, 2, 1))
+AUDIT_MONTH = "202401"
+AUDIT = audit_store.table(AUDIT_MONTH)
+
+
+def history_page(stmt, ts_col, id_col, newest_first=False, **params):
+    page = pagination.HistoryPage(**{"after": None, "before": None, "since": None, "until": None,
+                                     "limit": None, **params})
+    return page.apply(stmt, ts_col, id_col, newest_first=newest_first)
+
+
+HOT_QUERIES = {
+    # record_pefr: baseline (and trend state) lookup; /profile/me: latest reading
+    "baseline by owner": select(models.BaselinePEFR).filter(models.BaselinePEFR.owner_id == OWNER_ID),
+    "latest pefr": select(models.PEFRRecord).filter(models.PEFRRecord.owner_id == OWNER_ID)
+        .order_by(desc(models.PEFRRecord.recorded_at)).limit(1),
+    # /pefr/records, /patient/{id}/pefr
+    "pefr history": select(models.PEFRRecord).filter(models.PEFRRecord.owner_id == OWNER_ID)
+        .order_by(models.PEFRRecord.recorded_at.asc()),
+    "latest symptom": select(models.Symptom).filter(models.Symptom.owner_id == OWNER_ID)
+        .order_by(desc(models.Symptom.recorded_at)).limit(1),
+    "symptom history": select(models.Symptom).filter(models.Symptom.owner_id == OWNER_ID)
+        .order_by(models.Symptom.recorded_at.asc()),
+    # keyset pages and time windows on the history endpoints
+    "pefr history page after": history_page(select(models.PEFRRecord).filter(models.PEFRRecord.owner_id == OWNER_ID),
+                                            models.PEFRRecord.recorded_at, models.PEFRRecord.id, after=CURSOR),
+    "pefr history page before, windowed": history_page(
+        select(models.PEFRRecord).filter(models.PEFRRecord.owner_id == OWNER_ID),
+        models.PEFRRecord.recorded_at, models.PEFRRecord.id, before=CURSOR, **WINDOW),
+    "symptom history page": history_page(select(models.Symptom).filter(models.Symptom.owner_id == OWNER_ID),
+                                         models.Symptom.recorded_at, models.Symptom.id, after=CURSOR, **WINDOW),
+    "notifications page": history_page(select(models.Notification).filter(models.Notification.owner_id == OWNER_ID),
+                                       models.Notification.created_at, models.Notification.id,
+                                       newest_first=True, after=CURSOR),
+    "email logs page": history_page(select(models.EmailLog), models.EmailLog.created_at, models.EmailLog.id,
+                                    newest_first=True, before=CURSOR),
+    # /notifications
+    "notifications": select(models.Notification).filter(models.Notification.owner_id == OWNER_ID)
+        .order_by(desc(models.Notification.created_at)),
+    "new notifications since id": history_page(
+        select(models.Notification).filter(models.Notification.owner_id == OWNER_ID, models.Notification.id > 100),
+        models.Notification.created_at, models.Notification.id, newest_first=True),
+    # /notifications/unread-count and bulk mark-read
+    "unread count": select(func.count()).select_from(models.Notification)
+        .filter(models.Notification.owner_id == OWNER_ID, models.Notification.read == False),
+    # retention.purge_read_notifications
+    "old read notifications": select(models.Notification.id, models.Notification.owner_id)
+        .filter(models.Notification.read == True, models.Notification.created_at < datetime.datetime(2024, 1, 1))
+        .limit(500),
+    # /doctor/patient/{id}/medications/history
+    "medication status history": select(models.MedicationStatusHistory)
+        .filter(models.MedicationStatusHistory.medication_id == MED_ID)
+        .order_by(desc(models.MedicationStatusHistory.changed_at)),
+    # /medications
+    "medications by owner": select(models.Medication).filter(models.Medication.owner_id == OWNER_ID),
+    # push fan-out
+    "active devices": select(models.Device.token)
+        .filter(models.Device.owner_id == OWNER_ID, models.Device.active == True),
+    # /doctor/patients in each sort order, first and later pages
+    **{f"doctor patients by {sort}": summary.dashboard_query(DOCTOR_ID).order_by(*summary.dashboard_sort_keys(sort))
+       .limit(101) for sort in ("risk", "stale", "name")},
+    **{f"doctor patients by {sort}, next page": summary.dashboard_query(DOCTOR_ID).filter(
+        pagination.after(summary.dashboard_sort_keys(sort), values)
+    ).order_by(*summary.dashboard_sort_keys(sort)).limit(101)
+       for sort, values in (("risk", [1, 1704096000, 10]), ("stale", [1704096000, 10]), ("name", ["m", 10]))},
+    # linked doctors of a patient (notifications on PEFR / medication events)
+    "patient doctors": select(models.DoctorPatient.doctor_id).filter(models.DoctorPatient.patient_id == OWNER_ID)
+        .order_by(models.DoctorPatient.doctor_id),
+    "link exists": select(models.DoctorPatient).filter(
+        models.DoctorPatient.doctor_id == DOCTOR_ID, models.DoctorPatient.patient_id == OWNER_ID
+    ),
+    # /pefr/aggregate (day/week buckets)
+    "daily rollup range": select(models.PEFRDailyRollup).filter(
+        models.PEFRDailyRollup.owner_id == OWNER_ID,
+        models.PEFRDailyRollup.day >= datetime.date(2024, 1, 1), models.PEFRDailyRollup.day < datetime.date(2024, 3, 1)
+    ).order_by(models.PEFRDailyRollup.day),
+    # /pefr/records/bulk, /symptom/records/bulk: already stored readings in the batch's time span
+    "bulk pefr duplicates": select(models.PEFRRecord.recorded_at, models.PEFRRecord.pefr_value).filter(
+        models.PEFRRecord.owner_id == OWNER_ID,
+        models.PEFRRecord.recorded_at.between(WINDOW["since"], WINDOW["until"])),
+    "bulk symptom duplicates": select(models.Symptom.recorded_at).filter(
+        models.Symptom.owner_id == OWNER_ID,
+        models.Symptom.recorded_at.between(WINDOW["since"], WINDOW["until"])),
+    # Idempotency-Key middleware and its purge
+    "idempotency key": select(models.IdempotencyKey).filter(models.IdempotencyKey.key == b"k" * 32),
+    "expired idempotency keys": select(models.IdempotencyKey.key)
+        .filter(models.IdempotencyKey.created_at < WINDOW["since"]).limit(500),
+    "refresh token": select(models.RefreshToken).filter(models.RefreshToken.token_hash == b"t" * 32),
+    "refresh token family": select(models.RefreshToken).filter(models.RefreshToken.family == b"f" * 16),
+    "refresh tokens of user": select(models.RefreshToken).filter(models.RefreshToken.user_id == OWNER_ID),
+    "pending otp": select(models.OTPCode).filter(models.OTPCode.email == "patient@example.com"),
+    "expired otps": select(models.OTPCode.email).filter(models.OTPCode.expires_at <= WINDOW["since"]),
+    "expired refresh tokens": select(models.RefreshToken.token_hash)
+        .filter(models.RefreshToken.expires_at < WINDOW["since"]).limit(500),
+    # push dispatcher: claim due outbox rows, then the recipients' devices
+    "due pushes": select(models.PushOutbox.id).filter(models.PushOutbox.next_attempt_at <= WINDOW["since"])
+        .order_by(models.PushOutbox.next_attempt_at).limit(100),
+    "devices of push recipients": select(models.Device.owner_id, models.Device.token)
+        .filter(models.Device.active == True, models.Device.owner_id.in_([1, 2, 3])),
+    # digests: the recipient's open digest, and the flush of closed ones
+    "open digest": select(models.NotificationDigest).filter(
+        models.NotificationDigest.owner_id == DOCTOR_ID, models.NotificationDigest.kind == "pefr"),
+    "due digests": select(models.NotificationDigest.owner_id)
+        .filter(models.NotificationDigest.due_at <= WINDOW["since"]),
+    # /admin/audit-logs (one monthly partition) and delete_my_account
+    "audit log page": history_page(audit_store.statement(AUDIT_MONTH), AUDIT.c.timestamp, AUDIT.c.id,
+                                   newest_first=True, after=CURSOR),
+    "audit log page by user": history_page(audit_store.statement(AUDIT_MONTH, user_id=OWNER_ID),
+                                           AUDIT.c.timestamp, AUDIT.c.id, newest_first=True, after=CURSOR, **WINDOW),
+    "audit log page by action": history_page(audit_store.statement(AUDIT_MONTH, action=2),
+                                             AUDIT.c.timestamp, AUDIT.c.id, newest_first=True, **WINDOW),
+    "audit events of user": select(AUDIT.c.id).filter(AUDIT.c.user_id == OWNER_ID),
+    # /sync
+    "changes since token": select(models.ChangeLog.id, models.ChangeLog.entity, models.ChangeLog.entity_id)
+        .filter(models.ChangeLog.owner_id == OWNER_ID, models.ChangeLog.id > 100)
+        .order_by(models.ChangeLog.id).limit(2001),
+    # auth.get_user
+    "user by email": select(models.User).filter(models.User.email == "patient@example.com"),
+    # /admin/email-logs
+    "email logs": select(models.EmailLog).order_by(desc(models.EmailLog.created_at)).limit(50),
+}
+
+
+def create_audit_partition(engine):
+    # partitions are created by the audit writer, not by migrations
+    with engine.begin() as conn:
+        audit_store.create_partition(conn, AUDIT_MONTH)
+
+
+def make_engine():
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    migrations.upgrade(engine)
+    create_audit_partition(engine)
+    return engine
+
+
+def query_plan(engine, stmt):
+    sql = str(stmt.compile(dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}))
+    with engine.connect() as conn:
+        return [row[3] for row in conn.exec_driver_sql("EXPLAIN QUERY PLAN " + sql).fetchall()]
+
+
+def plan_problems(plan):
+    problems = []
+    for detail in plan:
+        # "SCAN <table>" is a full scan; "SCAN <table> USING [COVERING] INDEX" walks an index
+        if detail.startswith("SCAN ") and "USING" not in detail:
+            problems.append(detail)
+        if "TEMP B-TREE" in detail:
+            problems.append(detail)
+    return problems
+
+
+def check_all():
+    engine = make_engine()
+    failures = {}
+    for name, stmt in HOT_QUERIES.items():
+        plan = query_plan(engine, stmt)
+        problems = plan_problems(plan)
+        if problems:
+            failures[name] = plan
+    return failures
+
+
+def test_hot_queries_use_indexes():
+    failures = check_all()
+    assert not failures, "Hot queries without index support: " + "; ".join(
+        f"{name}: {plan}" for name, plan in failures.items()
+    )
+
+
+def test_migrations_create_indexes_on_legacy_schema():
+    # A database created before migration 4 must end up with the same plans after upgrading.
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    with engine.begin() as conn:
+        for table in models.Base.metadata.sorted_tables:
+            table.create(bind=conn)
+            if table.name == "users":
+                continue  # users.email has been indexed since the first release
+            for index in list(table.indexes):
+                index.drop(bind=conn)
+    migrations.upgrade(engine)
+    create_audit_partition(engine)
+    for name, stmt in HOT_QUERIES.items():
+        assert not plan_problems(query_plan(engine, stmt)), name
+
+
+if __name__ == "__main__":
+    failures = check_all()
+    engine = make_engine()
+    for name, stmt in HOT_QUERIES.items():
+        status = "FAIL" if name in failures else "ok"
+        print(f"[{status}] {name}: {' | '.join(query_plan(engine, stmt))}")
+    raise SystemExit(1 if failures else 0)